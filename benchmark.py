@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import multiprocessing
+import argparse
+
+import git
+
+import git_objects
+from tagged_document import TaggedDocument
+
+def create_synthetic_repo(path, files=1000, lines=200, tags=10, steps=5, seed=0):
+    """Creates a git repo at 'path' full of tagged code, for benchmarking:
+    'files' files of about 'lines' lines, each defining 'tags' (sometimes
+    nested) tags. The files are changed over 'steps' commits, which are
+    tagged "step-1", "step-2" and so on. Returns the Repo."""
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    rng = random.Random(seed)
+
+    repo = git.Repo.init(path)
+    committer = git.Actor("Benchmark", "benchmark@example.com")
+
+    paths = ["Sources/Module{}/File{}.swift".format(number % 20, number) for number in range(files)]
+
+    for step in range(1, steps + 1):
+        # every file exists from the start; after that, each step changes
+        # about a fifth of them
+        changed = paths if step == 1 else [file_path for file_path in paths if rng.random() < 0.2]
+
+        for file_path in changed:
+            full_path = os.path.join(path, file_path)
+
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+
+            with open(full_path, "w") as code_file:
+                code_file.write(synthetic_code(rng, file_path, lines, tags, step))
+
+        repo.index.add(changed)
+        repo.index.commit("Step {}".format(step), author=committer, committer=committer)
+        repo.create_tag("step-{}".format(step))
+
+    return repo
+
+def synthetic_code(rng, file_path, lines, tags, step):
+    """Returns the text of a tagged code file."""
+
+    name = os.path.splitext(os.path.basename(file_path))[0]
+
+    output = []
+    lines_per_tag = max(1, lines // max(1, tags))
+
+    for tag_number in range(tags):
+        tag = "{}-{}".format(name.lower(), tag_number)
+
+        output.append("// BEGIN {}".format(tag))
+
+        nested = rng.random() < 0.3
+
+        for line_number in range(lines_per_tag):
+            if nested and line_number == lines_per_tag // 2:
+                output.append("    // BEGIN {}-inner".format(tag))
+
+            indent = "    " * rng.randint(1, 3)
+            output.append("{}let value{} = {} // step {}".format(indent, line_number, rng.randint(0, 1000), step))
+
+        if nested:
+            output.append("    // END {}-inner".format(tag))
+
+        output.append("// END {}".format(tag))
+        output.append("")
+
+    return "\n".join(output)
+
+def create_synthetic_book(path, files=1000, tags=10, steps=5, chapters=50, snippets=40, seed=0):
+    """Creates a directory of chapters at 'path' that refer to the tags in
+    a repo made by create_synthetic_repo, at the working copy and at its
+    "step-N" tags."""
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    rng = random.Random(seed)
+
+    for chapter in range(chapters):
+        output = []
+
+        for snippet in range(snippets):
+            if snippet % 10 == 0:
+                output.append("// tag: {}".format("step-{}".format(rng.randint(1, steps)) if rng.random() < 0.5 else "working-copy"))
+
+            output.append("Some text about the code.\n")
+            output.append("// snip: file{}-{}\n".format(rng.randrange(files), rng.randrange(tags)))
+
+        with open(os.path.join(path, "chapter{}.txt".format(chapter)), "w") as chapter_file:
+            chapter_file.write("\n".join(output))
+
+def best_time(function, repeat=3):
+    """Calls 'function' 'repeat' times, and returns the fastest time in
+    seconds."""
+
+    times = []
+
+    for attempt in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    return min(times)
+
+def benchmark_parse(repo, process_counts, repeat=3):
+    """Times reading and parsing every working copy in 'repo' with each of
+    'process_counts' parsing processes (0 parses in this process). Returns
+    a list of (processes, seconds) tuples."""
+
+    paths = TaggedDocument.find_paths(repo, ["swift"])
+
+    results = []
+
+    for processes in process_counts:
+        def parse():
+            documents = [TaggedDocument(repo, path) for path in paths]
+            TaggedDocument.load_working_copies(documents, processes=processes)
+
+        results.append((processes, best_time(parse, repeat)))
+
+    return results
+
+def benchmark_history(repo, backends, repeat=3):
+    """Times reading every file in 'repo' at every "step-N" tag with each
+    of 'backends' (see git_objects). Returns a list of (backend, seconds)
+    tuples."""
+
+    paths = TaggedDocument.find_paths(repo, ["swift"])
+    refs = sorted(tag.name for tag in repo.tags if tag.name.startswith("step-"))
+    commits = [str(repo.commit(ref).hexsha) for ref in refs]
+
+    results = []
+
+    for backend in backends:
+        def read():
+            # a fresh source each time, so that nothing is cached between
+            # attempts
+            objects = git_objects.object_source(repo, backend)
+
+            try:
+                for commit in commits:
+                    for path in paths:
+                        objects.read_blob(objects.find_blob(commit, path))
+            finally:
+                objects.close()
+
+        results.append((backend, best_time(read, repeat)))
+
+    return results
+
+def benchmark_check(repo, book_path, repeat=3):
+    """Times a dry run that renders every chapter in 'book_path', against
+    only checking them. Returns a list of (name, seconds) tuples."""
+
+    from processor import Processor
+
+    def make_processor():
+        return Processor(book_path, repo.working_dir, tagged_extensions=["swift"], jobs=1)
+
+    def render():
+        make_processor().process(dry_run=True, width_limit=75)
+
+    def check():
+        make_processor().check(width_limit=75)
+
+    return [("render", best_time(render, repeat)), ("check", best_time(check, repeat))]
+
+def benchmark_index(repo, book_path, index_path, repeat=3):
+    """Builds a snippet index for the book in 'book_path', and times a dry
+    run that renders it from 'repo', against one that renders it from the
+    index, and against just opening the index. Returns a list of (name,
+    seconds) tuples."""
+
+    from processor import Processor
+    from snippet_index import SnippetIndex
+
+    Processor(book_path, repo.working_dir, tagged_extensions=["swift"], jobs=1).build_index(index_path)
+
+    def render_from_repo():
+        Processor(book_path, repo.working_dir, tagged_extensions=["swift"], jobs=1).process(dry_run=True, width_limit=75)
+
+    def render_from_index():
+        Processor(book_path, None, tagged_extensions=["swift"], jobs=1, index_path=index_path).process(dry_run=True, width_limit=75)
+
+    def open_index():
+        SnippetIndex(index_path).close()
+
+    return [("repo", best_time(render_from_repo, repeat)), ("index", best_time(render_from_index, repeat)), ("open", best_time(open_index, repeat))]
+
+def main():
+    options = argparse.ArgumentParser(description="Benchmarks the snippet processor against a synthetic code repo.")
+
+    options.add_argument("--repo", default="benchmark-repo", help="Where to create the synthetic repo (default=benchmark-repo).")
+    options.add_argument("--files", type=int, default=1000, help="The number of code files in the synthetic repo.")
+    options.add_argument("--lines", type=int, default=200, help="The number of lines in each code file.")
+    options.add_argument("--repeat", type=int, default=3, help="The number of times to run each benchmark; the fastest is reported.")
+
+    commands = options.add_subparsers(dest="command")
+
+    parse_options = commands.add_parser("parse", help="Time reading and parsing the working copy with different numbers of parsing processes.")
+    parse_options.add_argument("--processes", type=int, nargs="+", default=[0, 2, 4], help="The numbers of parsing processes to try; 0 parses in this process (default=0 2 4).")
+
+    history_options = commands.add_parser("history", help="Time reading every file at every step from git history with each way of reading git objects.")
+    history_options.add_argument("--backends", nargs="+", choices=git_objects.BACKENDS, default=git_objects.BACKENDS, help="The object sources to try.")
+    history_options.add_argument("--packed", action="store_true", help="Repack the repo first, so that objects are read from a pack (with deltas) instead of loose files.")
+
+    check_options = commands.add_parser("check", help="Time checking a synthetic book's snippets, against rendering them.")
+    check_options.add_argument("--book", default="benchmark-book", help="Where to create the synthetic book (default=benchmark-book).")
+    check_options.add_argument("--chapters", type=int, default=50, help="The number of chapters in the synthetic book.")
+
+    index_options = commands.add_parser("index", help="Time rendering a synthetic book from the repo, against rendering it from a snippet index.")
+    index_options.add_argument("--book", default="benchmark-book", help="Where to create the synthetic book (default=benchmark-book).")
+    index_options.add_argument("--chapters", type=int, default=50, help="The number of chapters in the synthetic book.")
+    index_options.add_argument("--index", default="benchmark.idx", help="Where to write the snippet index (default=benchmark.idx).")
+
+    opts = options.parse_args()
+
+    logging.getLogger().setLevel(logging.WARN)
+
+    repo = create_synthetic_repo(opts.repo, files=opts.files, lines=opts.lines)
+
+    if opts.command == "parse":
+        results = benchmark_parse(repo, opts.processes, opts.repeat)
+
+        baseline = results[0][1]
+
+        print("parse  on {} CPUs".format(multiprocessing.cpu_count()))
+
+        for (processes, seconds) in results:
+            print("parse  processes={:<3} {:8.3f}s  {:5.2f}x".format(processes, seconds, baseline / seconds))
+
+    elif opts.command == "check":
+        create_synthetic_book(opts.book, files=opts.files, chapters=opts.chapters)
+
+        results = benchmark_check(repo, opts.book, opts.repeat)
+
+        baseline = results[0][1]
+
+        for (name, seconds) in results:
+            print("check  {:<8} {:8.3f}s  {:5.2f}x".format(name, seconds, baseline / seconds))
+
+    elif opts.command == "index":
+        create_synthetic_book(opts.book, files=opts.files, chapters=opts.chapters)
+
+        results = benchmark_index(repo, opts.book, opts.index, opts.repeat)
+
+        baseline = results[0][1]
+
+        for (name, seconds) in results:
+            print("index  {:<8} {:8.3f}s  {:5.2f}x".format(name, seconds, baseline / seconds))
+
+    elif opts.command == "history":
+        if opts.packed:
+            repo.git.repack("-a", "-d", "-f")
+            repo.git.prune_packed()
+
+        results = benchmark_history(repo, opts.backends, opts.repeat)
+
+        baseline = results[0][1]
+
+        for (backend, seconds) in results:
+            print("history  {:<10} {:8.3f}s  {:5.2f}x".format(backend, seconds, baseline / seconds))
+
+if __name__ == '__main__':
+    main()
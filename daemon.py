@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import logging
+import argparse
+
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.urllib.parse import urlparse, parse_qs
+
+from processor import Processor, SOURCE_FILE_EXTENSIONS
+from source_document import SourceDocument, WORKSPACE_REF
+from tagged_version import TagQuery
+
+class RenderDaemon(object):
+    """Keeps a Processor warm between requests, so that editors and
+    preview servers don't pay for startup, discovery and parsing every
+    time they want a chapter rendered."""
+
+    def __init__(self, processor, refresh_interval=0):
+        assert isinstance(processor, Processor)
+        self.processor = processor
+
+        # looking for changes to the code walks the whole repo, so on a big
+        # repo it's done at most once every this many seconds
+        self.refresh_interval = refresh_interval
+
+        # maps chapter paths to (modification time, SourceDocument)
+        self.chapters = {}
+
+    def chapter(self, path):
+        """Returns the SourceDocument for the chapter at 'path', which must
+        be inside the processor's source directory. It's read again if it
+        has changed on disk."""
+
+        source_root = os.path.realpath(self.processor.source_path)
+        full_path = os.path.realpath(os.path.join(source_root, path))
+
+        if not full_path.startswith(source_root + os.sep):
+            raise RequestError(403, "{} is not in {}".format(path, self.processor.source_path))
+
+        if not os.path.isfile(full_path):
+            raise RequestError(404, "No chapter at {}".format(path))
+
+        modification_time = os.path.getmtime(full_path)
+
+        cached = self.chapters.get(full_path)
+
+        if cached is None or cached[0] != modification_time:
+            cached = (modification_time, SourceDocument(full_path))
+            self.chapters[full_path] = cached
+
+        return cached[1]
+
+    def render(self, chapter):
+        doc = self.chapter(chapter)
+
+        output, dirty = doc.render(
+            self.processor.tagged_documents,
+            language=self.processor.language,
+            file_getter=self.processor.get_file_contents,
+            show_query=self.processor.show_query,
+            as_inline_list_items=self.processor.as_inline_list_items,
+            render_cache=self.processor.render_cache
+            )
+
+        return {"chapter": chapter, "output": output, "dirty": dirty}
+
+    def clean(self, chapter):
+        return {"chapter": chapter, "output": self.chapter(chapter).cleaned_contents}
+
+    def resolve(self, query, ref=WORKSPACE_REF):
+        output = SourceDocument.render_snippet(TagQuery(query, ref=ref), self.processor.tagged_documents)
+
+        return {"query": query, "ref": ref, "output": output}
+
+    def tags(self, ref=WORKSPACE_REF):
+        versions = [doc[ref] for doc in self.processor.tagged_documents]
+
+        tags = set()
+        for version in versions:
+            if version:
+                tags |= version.tags
+
+        return {"ref": ref, "tags": sorted(tags)}
+
+    def handle(self, path, parameters):
+        """Handles a request for 'path' (eg "/render"), and returns a
+        JSON-ready response."""
+
+        # cheap checks that make sure we never serve anything stale
+        self.processor.refresh(self.refresh_interval)
+
+        def parameter(name, default=None):
+            values = parameters.get(name)
+            if not values:
+                if default is None:
+                    raise RequestError(400, "Missing parameter '{}'".format(name))
+                return default
+            return str(values[0])
+
+        if path == "/render":
+            return self.render(parameter("chapter"))
+        elif path == "/clean":
+            return self.clean(parameter("chapter"))
+        elif path == "/resolve":
+            return self.resolve(parameter("query"), parameter("ref", WORKSPACE_REF))
+        elif path == "/tags":
+            return self.tags(parameter("ref", WORKSPACE_REF))
+        else:
+            raise RequestError(404, "Unknown request {}; try /render, /clean, /resolve or /tags".format(path))
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves requests on 'host':'port' until interrupted."""
+        server = self.server(port, host)
+
+        logging.info("Listening on http://%s:%i/", host, server.server_address[1])
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def server(self, port, host="127.0.0.1"):
+        """Returns an HTTPServer that answers requests with this daemon.
+        Requests are handled one at a time, since Processor isn't safe to
+        use from several threads at once."""
+
+        class Handler(RequestHandler):
+            daemon = self
+
+        return HTTPServer((host, port), Handler)
+
+class RequestError(Exception):
+    """An error that should be reported to the client with an HTTP status."""
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    daemon = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.respond(url.path, parse_qs(url.query))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+
+        # accept either a form-encoded or a JSON body
+        if body.startswith("{"):
+            parameters = {key: [value] for (key, value) in json.loads(body).items()}
+        else:
+            parameters = parse_qs(body)
+
+        parameters.update(parse_qs(url.query))
+
+        self.respond(url.path, parameters)
+
+    def respond(self, path, parameters):
+        start = time.time()
+
+        try:
+            status = 200
+            response = self.daemon.handle(path, parameters)
+        except RequestError as error:
+            status = error.status
+            response = {"error": str(error)}
+        except Exception as error:
+            logging.exception("Failed to handle %s", path)
+            status = 500
+            response = {"error": str(error)}
+
+        response["elapsed_ms"] = round((time.time() - start) * 1000, 1)
+
+        body = json.dumps(response).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+def main():
+    options = argparse.ArgumentParser(description="Keeps the snippet processor running, and renders chapters on request over HTTP on localhost.")
+
+    options.add_argument("source_dir", help="Path to the directory containing your book's source text.")
+    options.add_argument("code_dir", nargs="?", default=None, help="Path to the git repo containing source code. Not needed with --index.")
+    options.add_argument("-p", "--port", type=int, default=8765, help="The port to listen on (default=8765)")
+    options.add_argument("-l", "--lang", dest="language", help="Indicate that the source code is in this language when syntax highlighting", default="swift")
+    options.add_argument("-q", "--show_query", action="store_true", help="Include the query in rendered snippets.")
+    options.add_argument("--as_inline_list_items", action="store_true", help="Add a + after the snippet tag, to make the snippets format properly when being used as inline blocks in list items")
+    options.add_argument("--index", default=None, help="Serve snippets from the snippet index at this path, made by processor.py --build-index, instead of from the code repo.")
+    options.add_argument("--refresh-interval", dest="refresh_interval", type=float, default=0.5, help="Look for changes to the code at most once every this many seconds; changes made in between are picked up by the next request after that (default=0.5).")
+    options.add_argument("-v", "--verbose", action="store_true", help="Verbose logging.")
+
+    opts = options.parse_args()
+
+    if opts.code_dir is None and not opts.index:
+        options.error("code_dir is required, unless --index is given")
+
+    logging.getLogger().setLevel(logging.DEBUG if opts.verbose else logging.INFO)
+
+    processor = Processor(
+        opts.source_dir,
+        opts.code_dir,
+        source_extensions=["txt","asciidoc"],
+        tagged_extensions=SOURCE_FILE_EXTENSIONS,
+        language=opts.language,
+        show_query=opts.show_query,
+        as_inline_list_items=opts.as_inline_list_items,
+        index_path=opts.index)
+
+    RenderDaemon(processor, opts.refresh_interval).serve(opts.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1123 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import textwrap
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import git
+from gitdb.exc import BadName
+from fuzzywuzzy import process
+
+import benchmark
+from git_objects import NATIVE
+from processor import Processor
+from source_document import WORKSPACE_REF
+from tagged_version import TaggedDocumentVersion
+
+# Checks that every way of rendering a book (plainly, or with parallel
+# parsing, the render cache, native git objects, sparse history, the
+# bounded version cache, lazy loading or the snippet index) produces
+# exactly what the processor originally did, on randomly generated code
+# repos and books; and that TaggedDocumentVersion.query agrees with a
+# deliberately simple reference implementation of queries. Any mismatch is
+# shrunk to a minimal case.
+
+TAGGED_EXTENSIONS = ["swift", "py"]
+
+# the tags used in generated code; some share prefixes, so that wildcards
+# have something to match, and some differ only in case
+TAGS = ["alpha", "beta", "gamma", "Alpha", "input_a", "input_b", "input_bc"]
+
+QUERY_TAGS = TAGS + ["input_*", "input_?", "*a", "missing"]
+
+INDENTS = ["", "  ", "    ", "        ", "\t", "\t  "]
+
+BEGIN_FORMS = [
+    "{indent}// BEGIN {tag}",
+    "{indent}//BEGIN {tag}",
+    "{indent}# begin {tag}",
+    "{indent}// Begin {tag}  ",
+    "{indent}let opened = 1 // BEGIN {tag}",
+    ]
+
+END_FORMS = [
+    "{indent}// END {tag}",
+    "{indent}//end {tag}",
+    "{indent}# END {tag}",
+    ]
+
+CONTENT_FORMS = [
+    "{indent}let value{number} = {number}",
+    "{indent}print(\"{number}\")",
+    "",
+    "",
+    "    ",
+    "\t",
+    "{indent}hidden{number}() //- not shown",
+    "{indent}/*- hidden -*/",
+    "{indent}let long{number} = \"" + "x" * 90 + "\"",
+    "{indent}\tmixed{number}()",
+    "{indent}// snip: not a real snippet",
+    ]
+
+# the lines that enter and leave tagged regions, as the processor
+# originally found them
+REFERENCE_BEGIN_RE = re.compile(r"\s*(\/\/|\#)\s*BEGIN\s+([^\s]+)", flags=re.IGNORECASE)
+REFERENCE_END_RE = re.compile(r"\s*(\/\/|\#)\s*END\s+([^\s]+)", flags=re.IGNORECASE)
+
+def reference_lines(data):
+    """Returns a (text, tags) tuple for each tagged line in 'data', found
+    one line at a time with no indexes, the way the processor originally
+    found them."""
+
+    lines = []
+    current_tags = []
+
+    for text in data.replace("\r", "").split("\n"):
+        if "/*-" in text or "-*/" in text or "//-" in text:
+            continue
+
+        begin = REFERENCE_BEGIN_RE.search(text)
+        if begin:
+            if begin.group(2) not in current_tags:
+                current_tags.append(begin.group(2))
+            continue
+
+        end = REFERENCE_END_RE.search(text)
+        if end:
+            if end.group(2) in current_tags:
+                current_tags.remove(end.group(2))
+            continue
+
+        if current_tags:
+            lines.append((text, list(current_tags)))
+
+    return lines
+
+def reference_tag_matches(tag, query_tag):
+    """Returns True if 'query_tag', which may contain "*" and "?"
+    wildcards, names 'tag'."""
+
+    if "*" not in query_tag and "?" not in query_tag:
+        return tag == query_tag
+
+    pattern = "".join(".*" if character == "*" else "." if character == "?" else re.escape(character) for character in query_tag)
+
+    return re.match(pattern + r"\Z", tag, flags=re.DOTALL) is not None
+
+def reference_query(data, query_string):
+    """Returns the text that 'query_string' selects from 'data', or None;
+    a plain reimplementation of TaggedDocumentVersion.query."""
+
+    include = []
+    exclude = []
+    isolate = []
+    mode = include
+
+    for token in query_string.split(" "):
+        if token.lower() == "except":
+            mode = exclude
+        elif token.lower() == "highlighting":
+            mode = []
+        elif token.lower() == "isolating":
+            mode = isolate
+        else:
+            mode.append(token)
+
+    def named(tags, query_tags):
+        return any(reference_tag_matches(tag, query_tag) for tag in tags for query_tag in query_tags)
+
+    matched = [
+        text for (text, tags) in reference_lines(data)
+            if named(tags[-1:], isolate) or (named(tags, include) and not named(tags, exclude))
+        ]
+
+    if not matched:
+        return None
+
+    return textwrap.dedent("\n".join(matched))
+
+def optimized_query(data, query_string):
+    """Returns what TaggedDocumentVersion.query selects from 'data', asking
+    twice, so that the cached answer is checked as well."""
+
+    version = TaggedDocumentVersion("code.swift", data, WORKSPACE_REF)
+
+    first = version.query(query_string)
+    second = version.query(query_string)
+
+    if first != second:
+        return ("changed when cached", first, second)
+
+    return first
+
+# How the processor originally rendered chapters, before any of it was
+# optimized; a copy of SourceDocument.render, with reference_query standing
+# in for TaggedDocumentVersion.query, which it reimplements. Don't change
+# it to match newer code: it's what newer code is checked against.
+
+BASELINE_SNIP_PREFIX = "// snip"
+BASELINE_SNIP_FILE_PREFIX = "// snip-file"
+BASELINE_TAG_PREFIX = "// tag"
+
+BASELINE_SNIPPET_RE = re.compile(r"(//.*snip(\-file)*:?.*\n)(\+\n)?(\[.*\]\n)*----\n(.*\n)*?----\n", flags=re.IGNORECASE)
+BASELINE_EMPTY_LINES_RE = re.compile(r"(\s*?\n){2,}")
+
+def baseline_tags(data):
+    """Returns the set of tags in 'data'."""
+    return set(tag for (text, tags) in reference_lines(data) for tag in tags)
+
+def baseline_included_tags(query_string):
+    """Returns the tags that 'query_string' includes, split up the way
+    TagQuery originally split them."""
+
+    include = []
+
+    for token in query_string.split(" "):
+        if token.lower() in ("except", "highlighting", "isolating"):
+            break
+
+        include.append(token)
+
+    return include
+
+def baseline_tagged_files(code_dir, extensions):
+    """Returns a function that takes a ref, and returns the text of each
+    tagged file in the repo at 'code_dir' that exists at that ref, in the
+    order that TaggedDocument.find originally found them."""
+
+    repo = git.Repo(code_dir)
+
+    paths = []
+
+    for (path, dirs, files) in os.walk(code_dir):
+        for filename in files:
+            for extension in extensions:
+                if filename.endswith("." + extension):
+                    if ".git" in path or "old" in path:
+                        continue
+
+                    paths.append(os.path.relpath(os.path.join(path, filename), code_dir))
+
+    files_at_refs = {}
+
+    def files_at(ref):
+        if ref in files_at_refs:
+            return files_at_refs[ref]
+
+        texts = []
+
+        for path in paths:
+            if ref == WORKSPACE_REF:
+                with open(os.path.join(code_dir, path)) as code_file:
+                    texts.append(code_file.read())
+                continue
+
+            try:
+                texts.append(repo.tree(ref)[path.replace(os.sep, "/")].data_stream.read())
+            except KeyError:
+                pass
+            except BadName:
+                # originally, this raised; refs that don't exist are now
+                # treated like files that don't exist at a ref, as
+                # TaggedDocument always meant to
+                pass
+
+        files_at_refs[ref] = texts
+
+        return texts
+
+    return files_at
+
+def baseline_render(contents, files_at, language=None, show_query=True, file_getter=None, as_inline_list_items=False):
+    """Returns a (text, dirty) tuple, like SourceDocument.render: a
+    chapter's 'contents', with its snippets expanded using the tagged files
+    that 'files_at' returns for each ref, and True if it had any snippets."""
+
+    # start with a version of ourself that has no expanded snippets
+    source_lines = re.sub(BASELINE_SNIPPET_RE, r"\1", contents).split("\n")
+
+    # the list of lines we're working with
+    output_lines = []
+
+    # default to working with files at HEAD
+    current_ref = WORKSPACE_REF
+
+    # true if this file rendered any snippets
+    dirty = False
+
+    all_tags_at_current_tag = list({tag for data in files_at(current_ref) for tag in baseline_tags(data)})
+
+    snippet_count = 0
+
+    for line in source_lines:
+        output_lines.append(line)
+
+        # change which tag we're looking at if we hit an instruction to do so
+        if line.startswith(BASELINE_TAG_PREFIX):
+            current_ref = line[len(BASELINE_TAG_PREFIX)+1:].strip()
+
+            all_tags_at_current_tag = list({tag for data in files_at(current_ref) for tag in baseline_tags(data)})
+
+        # expand file snippets as we encounter them
+        if line.startswith(BASELINE_SNIP_FILE_PREFIX):
+            if not file_getter:
+                continue
+
+            dirty = True
+            filename = line[len(BASELINE_SNIP_FILE_PREFIX)+1:].strip()
+
+            file_contents = file_getter(filename)
+
+            output_lines.append("----")
+            output_lines.append(file_contents)
+            output_lines.append("----")
+
+        # expand snippets as we encounter them
+        if line.startswith(BASELINE_SNIP_PREFIX):
+
+            dirty = True
+
+            # figure out what tags we're supposed to be using here
+            query_text = line[len(BASELINE_SNIP_PREFIX)+1:]
+
+            # get the tagged lines that apply from the documents that exist
+            # at this point
+            rendered_content = [reference_query(data, query_text) for data in files_at(current_ref)]
+
+            # any document that produced no lines will have returned None;
+            # remove those
+            rendered_content = filter(None, rendered_content)
+
+            rendered_content = [content.split("\n") for content in rendered_content]
+
+            # we now have a list of list of lines; we want to flatten this
+            # to a plain list of lines
+            rendered_lines = list(itertools.chain.from_iterable(rendered_content))
+
+            if show_query:
+                description = "// Snippet: {}-{}.txt\n".format(snippet_count, query_text.replace(" ", "_"))
+                rendered_lines = [description] + rendered_lines
+
+            if not rendered_lines:
+                # try and find some potential tags that could fit
+                bests = [result[0] for result in process.extractBests(baseline_included_tags(query_text)[0], all_tags_at_current_tag, score_cutoff=80)]
+
+                warning = "No code found for query '{}' at ref '{}'. Possible replacement tags include: {}".format(query_text, current_ref, ", ".join(bests))
+                warning = textwrap.fill(warning, 80)
+                exclamations = "!" * 8
+                rendered_lines = [exclamations, warning, exclamations]
+
+            if as_inline_list_items:
+                output_lines.append("+")
+
+            # add the language tag if one was specified
+            if language:
+                output_lines.append("[source,{}]".format(language))
+
+            # and output the snippet
+            output_lines.append("----")
+            output_lines += rendered_lines
+            output_lines.append("----")
+
+            snippet_count += 1
+
+    # render the output into a string
+    output = "\n".join(output_lines)
+
+    # finally, identify and remove any chain of 2 or more empty lines,
+    # replacing it with a single empty line
+    output = re.sub(BASELINE_EMPTY_LINES_RE, "\n\n", output)
+
+    return output, dirty
+
+class Case(object):
+    """A code repo and book to render: 'versions' is a list of (tag,
+    files) tuples that are committed and tagged in order, where 'files'
+    maps paths to their contents; 'working_copy' maps paths to what's on
+    disk afterwards; 'chapters' maps chapter names to their text; and
+    'options' holds the language, show_query and as_inline_list_items
+    options that the book is rendered with."""
+
+    def __init__(self, versions, working_copy, chapters, options):
+        self.versions = versions
+        self.working_copy = working_copy
+        self.chapters = chapters
+        self.options = options
+
+    def replace(self, **changes):
+        """Returns a copy of this case, with some of its fields changed."""
+
+        fields = dict(versions=self.versions, working_copy=self.working_copy, chapters=self.chapters, options=self.options)
+        fields.update(changes)
+
+        return Case(**fields)
+
+    @property
+    def paths(self):
+        """Every path that exists in any version, or in the working copy."""
+
+        paths = set(self.working_copy)
+        for (tag, files) in self.versions:
+            paths.update(files)
+
+        return sorted(paths)
+
+    def texts(self):
+        """Yields a (where, path, text) tuple for every distinct file in
+        this case."""
+
+        seen = set()
+
+        for (where, files) in list(self.versions) + [(WORKSPACE_REF, self.working_copy)]:
+            for path in sorted(files):
+                if files[path] not in seen:
+                    seen.add(files[path])
+                    yield (where, path, files[path])
+
+    def to_json(self):
+        return OrderedDict([
+            ("versions", [[tag, files] for (tag, files) in self.versions]),
+            ("working_copy", self.working_copy),
+            ("chapters", self.chapters),
+            ("options", self.options),
+            ])
+
+    @staticmethod
+    def from_json(data):
+        return Case([(str(tag), as_str(files)) for (tag, files) in data["versions"]], as_str(data["working_copy"]), as_str(data["chapters"]), as_str(data["options"]))
+
+    def describe(self):
+        """Returns this case as readable text."""
+
+        output = []
+
+        for (tag, files) in self.versions:
+            for path in sorted(files):
+                output.append("=== {} at {} ===\n{}".format(path, tag, files[path]))
+
+        for path in sorted(self.working_copy):
+            output.append("=== {} in the working copy ===\n{}".format(path, self.working_copy[path]))
+
+        for name in sorted(self.chapters):
+            output.append("=== chapter {} ===\n{}".format(name, self.chapters[name]))
+
+        output.append("=== options ===\n{}".format(json.dumps(self.options, sort_keys=True)))
+
+        return "\n".join(output)
+
+def as_str(value):
+    """Turns the unicode strings that json gives back on Python 2 into
+    plain strings."""
+
+    if isinstance(value, dict):
+        return dict((as_str(key), as_str(item)) for (key, item) in value.items())
+
+    if not isinstance(value, str) and not isinstance(value, (bool, int, float, type(None))):
+        return value.encode("utf-8")
+
+    return value
+
+def random_code(rng, length):
+    """Returns the text of a code file with 'length' lines, with nested,
+    overlapping and badly nested tagged regions, in various styles."""
+
+    lines = []
+    open_tags = []
+
+    for number in range(length):
+        roll = rng.random()
+        indent = rng.choice(INDENTS)
+
+        if roll < 0.12:
+            tag = rng.choice(TAGS)
+            lines.append(rng.choice(BEGIN_FORMS).format(indent=indent, tag=tag))
+
+            if tag not in open_tags:
+                open_tags.append(tag)
+
+        elif roll < 0.24 and open_tags:
+            # usually the innermost tag, but not always, so that regions
+            # can overlap
+            tag = open_tags[-1] if rng.random() < 0.7 else rng.choice(open_tags)
+            lines.append(rng.choice(END_FORMS).format(indent=indent, tag=tag))
+            open_tags.remove(tag)
+
+        elif roll < 0.26:
+            # possibly ending a tag that was never begun
+            tag = rng.choice(TAGS)
+            lines.append(rng.choice(END_FORMS).format(indent=indent, tag=tag))
+
+            if tag in open_tags:
+                open_tags.remove(tag)
+
+        elif roll < 0.3:
+            # a region with nothing but whitespace in it, which snippets
+            # leave out
+            tag = rng.choice([tag for tag in TAGS if tag not in open_tags] or TAGS)
+            lines.append(rng.choice(BEGIN_FORMS).format(indent=indent, tag=tag))
+            lines += [rng.choice(["", "    ", "\t"]) for _ in range(rng.randint(1, 2))]
+            lines.append(rng.choice(END_FORMS).format(indent=indent, tag=tag))
+
+            if tag in open_tags:
+                open_tags.remove(tag)
+
+        else:
+            lines.append(rng.choice(CONTENT_FORMS).format(indent=indent, number=number))
+
+    # whatever's still open runs to the end of the file
+    return "\n".join(lines) + rng.choice(["", "\n", "\n\n"])
+
+def random_query(rng):
+    """Returns a random query, which always includes at least one tag."""
+
+    tokens = rng.sample(QUERY_TAGS, rng.randint(1, 2))
+
+    if rng.random() < 0.4:
+        tokens += [rng.choice(["except", "EXCEPT"])] + rng.sample(QUERY_TAGS, rng.randint(1, 2))
+
+    if rng.random() < 0.25:
+        tokens += ["isolating", rng.choice(QUERY_TAGS)]
+
+    if rng.random() < 0.1:
+        tokens += ["highlighting", rng.choice(QUERY_TAGS)]
+
+    # extra spaces don't change what a query selects
+    separator = "  " if rng.random() < 0.1 else " "
+
+    return separator.join(tokens)
+
+def random_chapter(rng, length, refs, file_names):
+    """Returns the text of a chapter with 'length' lines of snippets,
+    '// tag:' switches to 'refs', snip-files of 'file_names', text and
+    blank lines."""
+
+    lines = []
+
+    for number in range(length):
+        roll = rng.random()
+
+        if roll < 0.3:
+            lines.append(rng.choice(["// snip: ", "// snip:", "// snip "]) + random_query(rng))
+
+            # what a previous render left behind, which is removed first
+            if rng.random() < 0.2:
+                lines += ["[source,swift]", "----", "stale {}".format(number), "----"]
+
+        elif roll < 0.4:
+            lines.append("// tag: {}".format(rng.choice(refs)))
+        elif roll < 0.45 and file_names:
+            lines.append("// snip-file: {}".format(rng.choice(file_names)))
+        elif roll < 0.65:
+            lines.append("")
+        else:
+            lines.append("Some text about snippet {}.".format(number))
+
+    return "\n".join(lines) + "\n"
+
+def random_case(rng, files=4, versions=3, file_lines=30, chapters=3, chapter_lines=20):
+    """Returns a random Case."""
+
+    paths = ["Sources/code{}.swift".format(number) for number in range(files - 1)] + ["scripts/tool.py"]
+
+    version_list = []
+    current = {}
+
+    for number in range(1, versions + 1):
+        current = dict(current)
+
+        for path in paths:
+            if path not in current or rng.random() < 0.5:
+                current[path] = random_code(rng, rng.randint(0, file_lines))
+
+        # files come and go
+        if len(current) > 1 and rng.random() < 0.2:
+            del current[rng.choice(sorted(current))]
+
+        version_list.append(("v{}".format(number), current))
+
+    working_copy = dict(current)
+
+    for path in paths:
+        if rng.random() < 0.3:
+            working_copy[path] = random_code(rng, rng.randint(0, file_lines))
+
+    if rng.random() < 0.3:
+        working_copy["Sources/uncommitted.swift"] = random_code(rng, file_lines)
+
+    refs = [tag for (tag, files) in version_list] + [WORKSPACE_REF, "HEAD", "no-such-ref"]
+
+    # snip-file finds files by name anywhere in the working copy
+    file_names = sorted(set(os.path.basename(path) for path in working_copy))
+
+    chapter_texts = dict(("chapter{}.txt".format(number), random_chapter(rng, rng.randint(1, chapter_lines), refs, file_names)) for number in range(chapters))
+
+    options = {
+        "language": rng.choice([None, "swift"]),
+        "show_query": rng.random() < 0.3,
+        "as_inline_list_items": rng.random() < 0.3,
+        }
+
+    return Case(version_list, working_copy, chapter_texts, options)
+
+def write_files(directory, files):
+    for (path, text) in files.items():
+        full_path = os.path.join(directory, path)
+
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+
+        with open(full_path, "w") as output:
+            output.write(text)
+
+def materialise(case, directory):
+    """Creates the code repo and book for 'case' in 'directory'. Returns
+    the paths of the repo and of the book."""
+
+    code_dir = os.path.join(directory, "code")
+    book_dir = os.path.join(directory, "book")
+
+    os.makedirs(book_dir)
+
+    repo = git.Repo.init(code_dir)
+    committer = git.Actor("Differential", "differential@example.com")
+
+    previous = {}
+
+    for (tag, files) in list(case.versions) + [(None, case.working_copy)]:
+        for path in set(previous) - set(files):
+            os.remove(os.path.join(code_dir, path))
+
+        write_files(code_dir, files)
+
+        previous = files
+
+        if tag is None:
+            # the working copy isn't committed
+            break
+
+        repo.git.add("-A")
+        repo.index.commit("Version {}".format(tag), author=committer, committer=committer)
+        repo.create_tag(tag)
+
+    write_files(book_dir, case.chapters)
+
+    return (code_dir, book_dir)
+
+class Engine(object):
+    """One way of rendering a book, given by the options it passes to
+    Processor."""
+
+    def __init__(self, name, render_cache=True, use_index=False, exact=True, **options):
+        self.name = name
+        self.render_cache = render_cache
+        self.use_index = use_index
+        self.options = options
+
+        # engines that aren't exact are allowed to differ (eg sparse
+        # history, which only looks in the files that are expected to have
+        # the code), and are only compared when asked for
+        self.exact = exact
+
+    def prepare(self, code_dir, book_dir, work_dir, options):
+        """Does whatever needs doing before rendering, that isn't part of
+        rendering itself (eg building a snippet index)."""
+
+        if self.use_index:
+            Processor(book_dir, code_dir, tagged_extensions=TAGGED_EXTENSIONS, jobs=1).build_index(self.index_path(work_dir))
+
+    def index_path(self, work_dir):
+        return os.path.join(work_dir, self.name + ".idx")
+
+    def render(self, code_dir, book_dir, work_dir, options):
+        """Renders every chapter in 'book_dir' with the options in
+        'options'. Returns an OrderedDict that maps each chapter to its
+        rendered text, or to None if it wasn't written, or {"error": ...}
+        if rendering failed."""
+
+        suffix = "." + self.name
+
+        options = dict(options, **self.options)
+
+        processor = None
+
+        # the index has to stand in for the repo entirely, so the repo is
+        # moved out of the way while rendering from it
+        hidden_dir = code_dir + ".hidden"
+
+        if self.use_index:
+            os.rename(code_dir, hidden_dir)
+
+        try:
+            if self.use_index:
+                processor = Processor(book_dir, None, tagged_extensions=TAGGED_EXTENSIONS, index_path=self.index_path(work_dir), **options)
+            else:
+                processor = Processor(book_dir, code_dir, tagged_extensions=TAGGED_EXTENSIONS, **options)
+
+            if not self.render_cache:
+                processor.render_cache = None
+
+            processor.process(suffix=suffix)
+        except Exception as error:
+            return {"error": "{}: {}".format(type(error).__name__, error)}
+        finally:
+            if processor is not None and processor.index is not None:
+                processor.index.close()
+
+            if self.use_index:
+                os.rename(hidden_dir, code_dir)
+
+        outputs = OrderedDict()
+
+        for path in sorted(processor.chapter_stats):
+            stats = processor.chapter_stats[path]
+
+            if stats["output"] is None:
+                outputs[stats["key"]] = None
+                continue
+
+            with open(stats["output"]) as output:
+                outputs[stats["key"]] = output.read()
+
+            os.remove(stats["output"])
+
+        return outputs
+
+class BaselineEngine(Engine):
+    """Renders a book with baseline_render, the way the processor
+    originally did, rather than with Processor."""
+
+    def __init__(self, name):
+        super(BaselineEngine, self).__init__(name)
+
+    def prepare(self, code_dir, book_dir, work_dir, options):
+        pass
+
+    def render(self, code_dir, book_dir, work_dir, options):
+
+        def file_getter(name):
+            for (root, dirs, files) in os.walk(code_dir):
+                for file in files:
+                    if file == name:
+                        with open(os.path.join(root, file)) as snip_file:
+                            return snip_file.read()
+
+        outputs = OrderedDict()
+
+        try:
+            files_at = baseline_tagged_files(code_dir, TAGGED_EXTENSIONS)
+
+            chapters = []
+
+            for (path, dirs, files) in os.walk(book_dir):
+                for filename in files:
+                    if filename.endswith(".txt") and ".git" not in path:
+                        chapters.append(os.path.join(path, filename))
+
+            for chapter in sorted(chapters):
+                with open(chapter) as chapter_file:
+                    contents = chapter_file.read()
+
+                (output, dirty) = baseline_render(contents, files_at, language=options.get("language"), show_query=options.get("show_query", False), file_getter=file_getter, as_inline_list_items=options.get("as_inline_list_items", False))
+
+                outputs[os.path.relpath(chapter, book_dir).replace(os.sep, "/")] = output if dirty else None
+        except Exception as error:
+            return {"error": "{}: {}".format(type(error).__name__, error)}
+
+        return outputs
+
+# the way the processor originally rendered comes first; every other engine
+# is compared against it
+ENGINES = [
+    BaselineEngine("reference"),
+    Engine("plain", render_cache=False, jobs=1),
+    Engine("parallel", jobs=4),
+    Engine("native-objects", git_objects=NATIVE),
+    Engine("sparse-history", exact=False, sparse_history=True),
+    Engine("bounded-cache", max_cached_versions=1),
+    Engine("lazy", lazy=True),
+    Engine("index", use_index=True),
+    ]
+
+ENGINE_NAMES = [engine.name for engine in ENGINES]
+
+EXACT_ENGINE_NAMES = [engine.name for engine in ENGINES if engine.exact]
+
+def engines_named(names):
+    return [engine for engine in ENGINES if engine.name in names]
+
+@contextmanager
+def quietly():
+    """Silences logging; snippets that can't be found and badly nested
+    tags are expected in random cases."""
+
+    logging.disable(logging.CRITICAL)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+def outcome(function, *args):
+    """Returns what 'function' returns, or a description of what it
+    raised, so that errors can be compared too."""
+    try:
+        return function(*args)
+    except Exception as error:
+        return "raised {}: {}".format(type(error).__name__, error)
+
+def query_mismatches(case, rng, queries, query_function=optimized_query):
+    """Returns a (text, query, expected, actual) tuple for each of
+    'queries' random queries on each file in 'case' that 'query_function'
+    answers differently from reference_query."""
+
+    mismatches = []
+
+    with quietly():
+        for (where, path, text) in case.texts():
+            for _ in range(queries):
+                query = random_query(rng)
+
+                expected = outcome(reference_query, text, query)
+                actual = outcome(query_function, text, query)
+
+                if actual != expected:
+                    mismatches.append((text, query, expected, actual))
+
+    return mismatches
+
+def render_mismatches(case, engines):
+    """Renders 'case' with each of 'engines', the first of which is the
+    reference. Returns a (engine name, chapter, expected, actual) tuple for
+    each chapter that an engine rendered differently."""
+
+    directory = tempfile.mkdtemp(prefix="differential-")
+
+    try:
+        with quietly():
+            (code_dir, book_dir) = materialise(case, directory)
+
+            results = []
+
+            for engine in engines:
+                engine.prepare(code_dir, book_dir, directory, case.options)
+                results.append(engine.render(code_dir, book_dir, directory, case.options))
+    finally:
+        shutil.rmtree(directory)
+
+    return compare_results(results[0], zip([engine.name for engine in engines[1:]], results[1:]))
+
+def compare_results(expected, named_results):
+    """Returns an (engine name, chapter, expected, actual) tuple for each
+    chapter whose output differs from 'expected'."""
+
+    mismatches = []
+
+    for (name, actual) in named_results:
+        for chapter in sorted(set(expected) | set(actual)):
+            if expected.get(chapter, "(missing)") != actual.get(chapter, "(missing)"):
+                mismatches.append((name, chapter, expected.get(chapter, "(missing)"), actual.get(chapter, "(missing)")))
+
+    return mismatches
+
+def shrink(value, candidates, fails, max_attempts=2000):
+    """Returns the smallest value that 'fails' that can be reached from
+    'value' by repeatedly taking the first of 'candidates(value)' (smaller
+    values, biggest cuts first) that still fails, until none do or
+    'max_attempts' have been tried.
+
+    After each smaller value is found, the search for the next one carries
+    on from the same position among its candidates, since the ones before
+    it are unlikely to start failing; a full pass is made at the end."""
+
+    attempts = 0
+    start = 0
+
+    while attempts < max_attempts:
+        improved = False
+
+        for (position, candidate) in enumerate(candidates(value)):
+            if position < start:
+                continue
+
+            attempts += 1
+
+            if fails(candidate):
+                value = candidate
+                start = position
+                improved = True
+                break
+
+            if attempts >= max_attempts:
+                break
+
+        if not improved:
+            if start == 0:
+                break
+
+            start = 0
+
+    return value
+
+def run_sizes(length):
+    """Returns the lengths of the runs to try removing from a list of
+    'length' items: all of them, then halves, quarters and so on down to
+    single items."""
+
+    sizes = []
+    size = length
+
+    while size >= 1:
+        sizes.append(size)
+        size //= 2
+
+    return sizes
+
+def smaller_lists(items, size=None):
+    """Yields copies of 'items' with a run of them removed; runs of 'size'
+    items, or of every size in run_sizes(), biggest first."""
+
+    for size in ([size] if size is not None else run_sizes(len(items))):
+        for start in range(0, len(items), size):
+            yield items[:start] + items[start + size:]
+
+def smaller_texts(text, size=None):
+    """Yields copies of 'text' with runs of lines removed."""
+
+    for lines in smaller_lists(text.split("\n"), size):
+        smaller = "\n".join(lines)
+
+        # removing the only line of an empty text leaves it as it was
+        if smaller != text:
+            yield smaller
+
+def smaller_cases(case):
+    """Yields cases that are smaller than 'case', removing the most first:
+    whole chapters, versions and files, then options, and then runs of
+    lines from chapters and files.
+
+    Runs of lines are removed from every chapter and file before trying
+    shorter runs, since trying every run in one file before moving to the
+    next rarely gets past the first few files."""
+
+    for name in sorted(case.chapters):
+        yield case.replace(chapters=dict((other, text) for (other, text) in case.chapters.items() if other != name))
+
+    for index in range(len(case.versions)):
+        yield case.replace(versions=case.versions[:index] + case.versions[index + 1:])
+
+    for path in case.paths:
+        without = lambda files: dict((other, text) for (other, text) in files.items() if other != path)
+        yield case.replace(versions=[(tag, without(files)) for (tag, files) in case.versions], working_copy=without(case.working_copy))
+
+    for (option, value) in sorted(case.options.items()):
+        if value:
+            yield case.replace(options=dict(case.options, **{option: None if option == "language" else False}))
+
+    # each text is a (text, function that returns a case with it replaced)
+    # tuple
+    texts = []
+
+    for name in sorted(case.chapters):
+        texts.append((case.chapters[name], lambda text, name=name: case.replace(chapters=dict(case.chapters, **{name: text}))))
+
+    for path in sorted(case.working_copy):
+        texts.append((case.working_copy[path], lambda text, path=path: case.replace(working_copy=dict(case.working_copy, **{path: text}))))
+
+    for (index, (tag, files)) in enumerate(case.versions):
+        for path in sorted(files):
+            def replaced(text, index=index, tag=tag, files=files, path=path):
+                versions = list(case.versions)
+                versions[index] = (tag, dict(files, **{path: text}))
+                return case.replace(versions=versions)
+
+            texts.append((files[path], replaced))
+
+    longest = max([len(text.split("\n")) for (text, _) in texts] or [0])
+
+    for fraction in range(len(run_sizes(longest))):
+        for (text, replaced) in texts:
+            sizes = run_sizes(len(text.split("\n")))
+
+            if fraction < len(sizes):
+                for smaller in smaller_texts(text, sizes[fraction]):
+                    yield replaced(smaller)
+
+def smaller_queries(item):
+    """Yields (text, query) tuples smaller than 'item': with runs of lines
+    removed from the text, or tokens removed from the query."""
+
+    (text, query) = item
+
+    tokens = query.split(" ")
+
+    for index in range(len(tokens)):
+        if len(tokens) > 1:
+            yield (text, " ".join(tokens[:index] + tokens[index + 1:]))
+
+    for smaller in smaller_texts(text):
+        yield (smaller, query)
+
+def shrink_query(text, query, query_function=optimized_query):
+    """Returns the smallest (text, query) tuple that 'query_function' still
+    answers differently from reference_query."""
+
+    def fails(item):
+        with quietly():
+            return outcome(query_function, *item) != outcome(reference_query, *item)
+
+    return shrink((text, query), smaller_queries, fails)
+
+def shrink_case(case, engines):
+    """Returns the smallest case that 'engines' (the reference and one
+    other) still render differently."""
+    return shrink(case, smaller_cases, lambda candidate: bool(render_mismatches(candidate, engines)), max_attempts=500)
+
+def check(seed, cases, queries, engines, failure_path=None, shrinking=True, case=None):
+    """Checks 'cases' random cases (or just 'case'), stopping at the first
+    mismatch, which is shrunk, printed and saved to 'failure_path'.
+    Returns True if everything matched."""
+
+    if case is not None:
+        cases = 1
+
+    for number in range(cases):
+        rng = random.Random(seed * 1000003 + number)
+
+        current = case or random_case(rng)
+
+        mismatches = query_mismatches(current, rng, queries)
+
+        if mismatches:
+            (text, query, expected, actual) = mismatches[0]
+
+            print("Case {} (seed {}): query '{}' differs from the reference".format(number, seed, query))
+
+            if shrinking:
+                (text, query) = shrink_query(text, query)
+
+            print("=== code ===\n{}\n=== query ===\n{}".format(text, query))
+            print("=== expected ===\n{}\n=== actual ===\n{}".format(outcome(reference_query, text, query), outcome(optimized_query, text, query)))
+
+            return False
+
+        mismatches = render_mismatches(current, engines)
+
+        if mismatches:
+            (name, chapter, expected, actual) = mismatches[0]
+
+            print("Case {} (seed {}): {} rendered {} differently from {}".format(number, seed, name, chapter, engines[0].name))
+
+            if shrinking:
+                current = shrink_case(current, [engines[0]] + engines_named([name]))
+                mismatches = render_mismatches(current, [engines[0]] + engines_named([name])) or mismatches
+
+                (name, chapter, expected, actual) = mismatches[0]
+
+            print(current.describe())
+            print("=== expected {} ===\n{}\n=== actual {} ===\n{}".format(chapter, expected, chapter, actual))
+
+            if failure_path:
+                with open(failure_path, "w") as failure_file:
+                    json.dump(current.to_json(), failure_file, indent=2)
+                print("Saved the case to {}; run it again with --replay".format(failure_path))
+
+            return False
+
+    print("{} cases matched across {}".format(cases, ", ".join(engine.name for engine in engines)))
+
+    return True
+
+def scale(sizes, engines, chapters=10, repeat=1, work_dir="differential-scale"):
+    """Renders benchmark.py's synthetic book at each of 'sizes' (numbers
+    of code files) with each engine, printing how long each took and
+    whether it matched the reference. Returns True if they all matched."""
+
+    matched = True
+
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    for size in sizes:
+        repo_dir = os.path.join(work_dir, "repo-{}".format(size))
+        book_dir = os.path.join(work_dir, "book-{}".format(size))
+
+        benchmark.create_synthetic_repo(repo_dir, files=size)
+        benchmark.create_synthetic_book(book_dir, files=size, chapters=chapters)
+
+        results = []
+
+        for engine in engines:
+            with quietly():
+                engine.prepare(repo_dir, book_dir, work_dir, {})
+
+                outputs = []
+                seconds = benchmark.best_time(lambda: outputs.append(engine.render(repo_dir, book_dir, work_dir, {})), repeat)
+
+            results.append((engine, seconds, outputs[-1]))
+
+        (reference, baseline, expected) = results[0]
+
+        for (engine, seconds, outputs) in results:
+            same = not compare_results(expected, [(engine.name, outputs)])
+            matched = matched and same
+
+            print("scale  files={:<6} {:<16} {:8.3f}s  {:5.2f}x  {}".format(size, engine.name, seconds, baseline / seconds, "ok" if same else "MISMATCH"))
+
+    shutil.rmtree(work_dir)
+
+    return matched
+
+def main():
+    options = argparse.ArgumentParser(description="Checks that every optimized way of rendering produces exactly what the processor originally did, on random code and books.")
+
+    commands = options.add_subparsers(dest="command")
+
+    check_options = commands.add_parser("check", help="Render random cases with every engine, and shrink the first mismatch to a minimal case.")
+    check_options.add_argument("--seed", type=int, default=0, help="The seed for the random cases (default=0).")
+    check_options.add_argument("--cases", type=int, default=20, help="The number of random cases to check (default=20).")
+    check_options.add_argument("--queries", type=int, default=20, help="The number of random queries to check against each file (default=20).")
+    check_options.add_argument("--engines", nargs="+", choices=ENGINE_NAMES, default=EXACT_ENGINE_NAMES, help="The engines to compare; the reference is always included. sparse-history only looks in the files expected to have the code, so it can differ, and isn't compared unless it's named here.")
+    check_options.add_argument("--failure", default=None, help="Save the shrunk case that fails, if any, as JSON to this path.")
+    check_options.add_argument("--replay", default=None, help="Check the case in this JSON file (from --failure) instead of random ones.")
+    check_options.add_argument("--no-shrink", dest="shrink", action="store_false", help="Report mismatches as they were found, without shrinking them.")
+
+    scale_options = commands.add_parser("scale", help="Time each engine on bigger and bigger synthetic repos, checking that they all match.")
+    scale_options.add_argument("--sizes", type=int, nargs="+", default=[50, 200], help="The numbers of code files to try (default=50 200).")
+    scale_options.add_argument("--chapters", type=int, default=10, help="The number of chapters in each synthetic book.")
+    scale_options.add_argument("--engines", nargs="+", choices=ENGINE_NAMES, default=ENGINE_NAMES, help="The engines to time; the reference is always included.")
+    scale_options.add_argument("--repeat", type=int, default=1, help="The number of times to run each engine; the fastest is reported.")
+    scale_options.add_argument("--work-dir", dest="work_dir", default="differential-scale", help="Where to create the synthetic repos and books (default=differential-scale).")
+
+    opts = options.parse_args()
+
+    logging.getLogger().setLevel(logging.WARN)
+
+    engines = [ENGINES[0]] + [engine for engine in engines_named(opts.engines) if engine is not ENGINES[0]]
+
+    if opts.command == "check":
+        case = None
+
+        if opts.replay:
+            with open(opts.replay) as replay_file:
+                case = Case.from_json(json.load(replay_file))
+
+        matched = check(opts.seed, opts.cases, opts.queries, engines, opts.failure, opts.shrink, case)
+    else:
+        matched = scale(opts.sizes, engines, opts.chapters, opts.repeat, opts.work_dir)
+
+    sys.exit(0 if matched else 1)
+
+if __name__ == '__main__':
+    main()
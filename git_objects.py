@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+
+import os
+import git
+import mmap
+import zlib
+import struct
+import binascii
+import threading
+from collections import OrderedDict
+
+# The kinds of object source that object_source() can make.
+GITPYTHON = "gitpython"
+NATIVE = "native"
+
+BACKENDS = [GITPYTHON, NATIVE]
+
+# Object types, as numbered in packfiles.
+OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+# Tree entries with these modes are directories and submodules, not files.
+TREE_MODE = b"40000"
+SUBMODULE_MODE = b"160000"
+
+def object_source(repo, backend=GITPYTHON):
+    """Returns an object source for 'repo' that uses 'backend'."""
+
+    if backend == GITPYTHON:
+        return GitPythonObjects(repo)
+    elif backend == NATIVE:
+        return PackedObjects(repo.git_dir)
+    else:
+        raise ValueError("Unknown git object backend '{}'; use one of {}".format(backend, ", ".join(BACKENDS)))
+
+class GitPythonObjects(object):
+    """Reads files from history using GitPython, which asks long-running
+    'git cat-file' processes for each object.
+
+    An object source answers three questions: which tree a commit has
+    (tree_id), which blob is at a path in a commit (find_blob), and what a
+    blob contains (read_blob). Object IDs are hex strings."""
+
+    def __init__(self, repo):
+        assert isinstance(repo, git.Repo)
+        self.repo = repo
+        self.trees = {} # maps commit IDs to git Tree objects
+
+    def tree(self, commit):
+        try:
+            return self.trees[commit]
+        except KeyError:
+            tree = self.trees[commit] = self.repo.tree(commit)
+            return tree
+
+    def tree_id(self, commit):
+        return str(self.tree(commit).hexsha)
+
+    def find_blob(self, commit, path):
+        """Returns the ID of the blob at 'path' in 'commit', or None if
+        there isn't a file there."""
+        try:
+            item = self.tree(commit)[path]
+        except KeyError:
+            return None
+
+        # directories and submodules aren't files
+        return str(item.hexsha) if item.type == "blob" else None
+
+    def read_blob(self, blob):
+        return self.repo.odb.stream(binascii.unhexlify(blob)).read()
+
+    def for_thread(self):
+        """Returns an object source that can be used on another thread.
+        GitPython repos can't be shared between threads, so this opens
+        another one."""
+        return GitPythonObjects(git.Repo(self.repo.working_dir))
+
+    def close(self):
+        self.repo.git.clear_cache()
+
+class PackedObjects(object):
+    """Reads files from history straight out of a repo's object database,
+    in this process: loose objects are inflated with zlib, and packed
+    objects are found with the packs' .idx files and rebuilt from their
+    deltas. Packs are memory-mapped. This is safe to use from several
+    threads at once."""
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+
+        # linked worktrees keep their objects in the main repo
+        common_dir_file = os.path.join(git_dir, "commondir")
+        if os.path.isfile(common_dir_file):
+            with open(common_dir_file) as common_dir:
+                git_dir = os.path.normpath(os.path.join(git_dir, common_dir.read().strip()))
+
+        self.object_dirs = [os.path.join(git_dir, "objects")]
+
+        alternates_path = os.path.join(self.object_dirs[0], "info", "alternates")
+        if os.path.isfile(alternates_path):
+            with open(alternates_path) as alternates:
+                for line in alternates:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        self.object_dirs.append(os.path.normpath(os.path.join(self.object_dirs[0], line)))
+
+        self.packs = []
+        self.lock = threading.Lock()
+        self.load_packs()
+
+        self.tree_ids = {} # maps commit IDs to tree IDs
+        self.trees = {} # maps tree IDs to dictionaries of name: (mode, ID)
+
+    def load_packs(self):
+        """Opens any packs that aren't open yet; called again when an object
+        can't be found, in case the repo has been repacked."""
+
+        with self.lock:
+            known = set(pack.path for pack in self.packs)
+
+            for object_dir in self.object_dirs:
+                pack_dir = os.path.join(object_dir, "pack")
+
+                if not os.path.isdir(pack_dir):
+                    continue
+
+                for filename in sorted(os.listdir(pack_dir)):
+                    path = os.path.join(pack_dir, filename)
+
+                    if filename.endswith(".pack") and path not in known and os.path.isfile(path[:-len(".pack")] + ".idx"):
+                        self.packs.append(Pack(path))
+
+    def read_object(self, object_id):
+        """Returns a tuple of (type, data) for the object 'object_id', where
+        type is "commit", "tree", "blob" or "tag". Raises KeyError if the
+        object doesn't exist."""
+
+        for attempt in range(2):
+            for object_dir in self.object_dirs:
+                loose_path = os.path.join(object_dir, object_id[:2], object_id[2:])
+
+                if os.path.isfile(loose_path):
+                    return read_loose_object(loose_path)
+
+            binary_id = binascii.unhexlify(object_id)
+
+            for pack in self.packs:
+                offset = pack.find(binary_id)
+                if offset is not None:
+                    return pack.read(offset, self)
+
+            if attempt == 0:
+                self.load_packs()
+
+        raise KeyError(object_id)
+
+    def tree_id(self, commit):
+        try:
+            return self.tree_ids[commit]
+        except KeyError:
+            pass
+
+        (object_type, data) = self.read_object(commit)
+
+        # annotated tags point at the commit
+        while object_type == "tag":
+            (object_type, data) = self.read_object(data[len(b"object "):data.index(b"\n")].decode("ascii"))
+
+        if object_type != "commit" or not data.startswith(b"tree "):
+            raise ValueError("{} is not a commit".format(commit))
+
+        tree = self.tree_ids[commit] = data[len(b"tree "):data.index(b"\n")].decode("ascii")
+
+        return tree
+
+    def tree_entries(self, tree):
+        """Returns a dictionary mapping the names in the tree 'tree' to
+        (mode, ID) tuples."""
+
+        try:
+            return self.trees[tree]
+        except KeyError:
+            pass
+
+        (object_type, data) = self.read_object(tree)
+
+        entries = {}
+        position = 0
+
+        # each entry is "<mode> <name>\0<20 byte ID>"
+        while position < len(data):
+            space = data.index(b" ", position)
+            null = data.index(b"\0", space)
+
+            name = data[space + 1:null].decode("utf-8", "surrogateescape") if str is not bytes else data[space + 1:null]
+            entries[name] = (data[position:space], binascii.hexlify(data[null + 1:null + 21]).decode("ascii"))
+
+            position = null + 21
+
+        self.trees[tree] = entries
+
+        return entries
+
+    def find_blob(self, commit, path):
+        """Returns the ID of the blob at 'path' in 'commit', or None if
+        there isn't a file there."""
+
+        tree = self.tree_id(commit)
+
+        parts = path.split("/")
+
+        for (index, part) in enumerate(parts):
+            entry = self.tree_entries(tree).get(part)
+
+            if entry is None:
+                return None
+
+            (mode, object_id) = entry
+
+            if index == len(parts) - 1:
+                if mode in (TREE_MODE, SUBMODULE_MODE):
+                    return None
+                return object_id
+
+            if mode != TREE_MODE:
+                return None
+
+            tree = object_id
+
+    def read_blob(self, blob):
+        (object_type, data) = self.read_object(blob)
+
+        if object_type != "blob":
+            raise ValueError("{} is a {}, not a blob".format(blob, object_type))
+
+        return data
+
+    def for_thread(self):
+        return self
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+
+class Pack(object):
+    """A packfile and its index."""
+
+    # the number of recently rebuilt objects kept, since the same bases
+    # are used by many deltas
+    CACHE_SIZE = 256
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path[:-len(".pack")] + ".idx", "rb") as index_file:
+            self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        with open(path, "rb") as pack_file:
+            self.pack = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.index[:4] == b"\xfftOc":
+            version = struct.unpack(">I", self.index[4:8])[0]
+            if version != 2:
+                raise ValueError("{}: unsupported pack index version {}".format(path, version))
+            self.version = 2
+            self.fanout_offset = 8
+        else:
+            self.version = 1
+            self.fanout_offset = 0
+
+        self.fanout = struct.unpack(">256I", self.index[self.fanout_offset:self.fanout_offset + 1024])
+        self.count = self.fanout[255]
+
+        # where the tables that follow the fanout start
+        self.ids_offset = self.fanout_offset + 1024
+        self.offsets_offset = self.ids_offset + self.count * 24 # version 2: IDs, then CRCs
+        self.large_offsets_offset = self.offsets_offset + self.count * 4
+
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def object_id_at(self, position):
+        if self.version == 2:
+            start = self.ids_offset + position * 20
+        else:
+            start = self.ids_offset + position * 24 + 4
+        return self.index[start:start + 20]
+
+    def find(self, binary_id):
+        """Returns the offset in the pack of the object 'binary_id', or
+        None if it isn't in this pack."""
+
+        first_byte = bytearray(binary_id[:1])[0]
+
+        low = self.fanout[first_byte - 1] if first_byte else 0
+        high = self.fanout[first_byte]
+
+        while low < high:
+            middle = (low + high) // 2
+            found = self.object_id_at(middle)
+
+            if found < binary_id:
+                low = middle + 1
+            elif found > binary_id:
+                high = middle
+            else:
+                return self.offset_at(middle)
+
+        return None
+
+    def offset_at(self, position):
+        if self.version == 1:
+            start = self.ids_offset + position * 24
+            return struct.unpack(">I", self.index[start:start + 4])[0]
+
+        start = self.offsets_offset + position * 4
+        offset = struct.unpack(">I", self.index[start:start + 4])[0]
+
+        # offsets past 2GB are stored in a separate table
+        if offset & 0x80000000:
+            start = self.large_offsets_offset + (offset & 0x7fffffff) * 8
+            offset = struct.unpack(">Q", self.index[start:start + 8])[0]
+
+        return offset
+
+    def read(self, offset, objects):
+        """Returns a tuple of (type, data) for the object at 'offset'.
+        'objects' is used to find the bases of deltas that refer to other
+        objects by ID."""
+
+        # follow the chain of deltas back to a whole object
+        deltas = []
+
+        while True:
+            with self.lock:
+                cached = self.cache.get(offset)
+
+            if cached is not None:
+                (object_type, data) = cached
+                break
+
+            (object_type, data, base) = self.read_entry(offset)
+
+            if object_type == OFS_DELTA:
+                deltas.append((offset, data))
+                offset = base
+            elif object_type == REF_DELTA:
+                deltas.append((offset, data))
+                (object_type, data) = objects.read_object(binascii.hexlify(base).decode("ascii"))
+                break
+            else:
+                object_type = OBJECT_TYPES[object_type]
+                self.remember(offset, object_type, data)
+                break
+
+        for (delta_offset, delta) in reversed(deltas):
+            data = apply_delta(data, delta)
+            self.remember(delta_offset, object_type, data)
+
+        return (object_type, data)
+
+    def remember(self, offset, object_type, data):
+        with self.lock:
+            self.cache[offset] = (object_type, data)
+
+            if len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+    def read_entry(self, offset):
+        """Returns a tuple of (type number, inflated data, base) for the
+        entry at 'offset'; base is the offset of the base object for an
+        OFS_DELTA, its binary ID for a REF_DELTA, and None otherwise."""
+
+        header = bytearray(self.pack[offset:offset + 32])
+
+        byte = header[0]
+        object_type = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        position = 1
+
+        while byte & 0x80:
+            byte = header[position]
+            position += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+
+        base = None
+
+        if object_type == OFS_DELTA:
+            byte = header[position]
+            position += 1
+            distance = byte & 0x7f
+
+            while byte & 0x80:
+                byte = header[position]
+                position += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+
+            base = offset - distance
+        elif object_type == REF_DELTA:
+            base = self.pack[offset + position:offset + position + 20]
+            position += 20
+
+        return (object_type, inflate(self.pack, offset + position, size), base)
+
+    def close(self):
+        self.index.close()
+        self.pack.close()
+
+def inflate(buffer, start, size):
+    """Returns the 'size' bytes that the zlib stream at 'start' in
+    'buffer' inflates to."""
+
+    decompressor = zlib.decompressobj()
+
+    pieces = []
+    inflated = 0
+
+    # compressed data is rarely much bigger than what it inflates to
+    chunk_size = max(size + 64, 4096)
+    position = start
+
+    while inflated < size:
+        chunk = buffer[position:position + chunk_size]
+
+        if not chunk:
+            raise ValueError("Packed object at {} is truncated".format(start))
+
+        piece = decompressor.decompress(chunk)
+        pieces.append(piece)
+        inflated += len(piece)
+        position += chunk_size
+
+    return b"".join(pieces)[:size]
+
+def read_loose_object(path):
+    """Returns a tuple of (type, data) for the loose object at 'path'."""
+
+    with open(path, "rb") as object_file:
+        raw = zlib.decompress(object_file.read())
+
+    null = raw.index(b"\0")
+    (object_type, size) = raw[:null].split(b" ")
+
+    return (object_type.decode("ascii"), raw[null + 1:null + 1 + int(size)])
+
+def apply_delta(base, delta):
+    """Rebuilds an object from its 'base' and a git 'delta'."""
+
+    delta = bytearray(delta)
+    position = 0
+
+    def read_size():
+        size = 0
+        shift = 0
+        while True:
+            byte = delta[position + shift // 7]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return (size, shift // 7)
+
+    (base_size, length) = read_size()
+    position += length
+
+    if base_size != len(base):
+        raise ValueError("Delta expects a base of {} bytes, not {}".format(base_size, len(base)))
+
+    (result_size, length) = read_size()
+    position += length
+
+    pieces = []
+    append = pieces.append
+    end = len(delta)
+
+    while position < end:
+        instruction = delta[position]
+        position += 1
+
+        if instruction & 0x80:
+            # copy a range of the base
+            # (unrolled, since this is the hottest loop when reading packs)
+            copy_offset = 0
+            copy_size = 0
+
+            if instruction & 0x01:
+                copy_offset = delta[position]
+                position += 1
+            if instruction & 0x02:
+                copy_offset |= delta[position] << 8
+                position += 1
+            if instruction & 0x04:
+                copy_offset |= delta[position] << 16
+                position += 1
+            if instruction & 0x08:
+                copy_offset |= delta[position] << 24
+                position += 1
+
+            if instruction & 0x10:
+                copy_size = delta[position]
+                position += 1
+            if instruction & 0x20:
+                copy_size |= delta[position] << 8
+                position += 1
+            if instruction & 0x40:
+                copy_size |= delta[position] << 16
+                position += 1
+
+            append(base[copy_offset:copy_offset + (copy_size or 0x10000)])
+        elif instruction:
+            # insert new data
+            append(bytes(delta[position:position + instruction]))
+            position += instruction
+        else:
+            raise ValueError("Invalid delta instruction")
+
+    result = b"".join(pieces)
+
+    if len(result) != result_size:
+        raise ValueError("Delta produced {} bytes, not {}".format(len(result), result_size))
+
+    return result
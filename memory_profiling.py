@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import logging
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from profiling import NullProfiler
+
+# tracemalloc needs Python 3.4 or later; without it, all we can find out
+# about the whole process is the most memory it has ever used
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+class MemoryProfiler(object):
+    """Records how much memory each phase of processing (eg parse, history,
+    render) allocates and the most it used at once, and writes a report of
+    what's still held at the end: by each version of each tagged document,
+    by each ref, and by each source document.
+
+    It's used in place of another profiler (eg a PhaseProfiler), which it
+    passes every phase on to."""
+
+    def __init__(self, path, top=10, profiler=None):
+        assert isinstance(path, str)
+
+        self.path = path
+        self.top = top
+        self.profiler = profiler or NullProfiler()
+
+        # Processors whose documents are measured when the report is
+        # written; see watch()
+        self.processors = []
+
+        # maps phase names to their measurements, in the order the phases
+        # were first entered
+        self.phases = OrderedDict()
+
+        # the measurements of the phases we're currently inside, innermost
+        # last
+        self.open_phases = []
+
+        # the most memory used at once so far, as of the last note_peak()
+        self.peak = 0
+
+        # tracing slows everything down, so it's stopped again once the
+        # report is written, unless someone else started it
+        self.started_tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+
+        if self.started_tracing:
+            tracemalloc.start()
+
+    def watch(self, processor):
+        """Includes 'processor''s documents in the report."""
+        self.processors.append(processor)
+
+    @contextmanager
+    def phase(self, name):
+        """Measures everything done inside the 'with' block, attributing it
+        to the phase 'name', as well as passing it on to the wrapped
+        profiler. A phase can be entered many times (eg once per chapter),
+        and can be entered inside another."""
+
+        measurements = self.phases.get(name)
+
+        if measurements is None:
+            # without tracemalloc, there's no telling what a phase allocated
+            measurements = self.phases[name] = OrderedDict([("entries", 0), ("allocated", 0 if tracemalloc is not None else None), ("peak", 0)])
+
+        with self.profiler.phase(name):
+            self.note_peak()
+
+            measurements["entries"] += 1
+            self.open_phases.append(measurements)
+
+            start = current_memory()
+
+            try:
+                yield
+            finally:
+                if measurements["allocated"] is not None:
+                    measurements["allocated"] += current_memory() - start
+
+                self.note_peak()
+                self.open_phases.pop()
+
+    def note_peak(self):
+        """Adds the most memory used since the last call to the peak of
+        every open phase, and starts counting again."""
+
+        peak = peak_memory()
+
+        self.peak = max(self.peak, peak)
+
+        for measurements in self.open_phases:
+            measurements["peak"] = max(measurements["peak"], peak)
+
+        # without a way to start counting again, every open phase gets the
+        # peak for the whole run so far
+        if tracemalloc is not None and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def report(self):
+        """Returns the memory report, as an OrderedDict that's ready to be
+        written as JSON."""
+
+        report = OrderedDict()
+
+        report["measured_with"] = "tracemalloc" if tracemalloc is not None else "maxrss"
+        report["current"] = current_memory() if tracemalloc is not None else None
+        report["peak"] = max(self.peak, peak_memory())
+
+        report["phases"] = self.phases
+
+        versions = []
+        refs = defaultdict(int)
+        source_documents = []
+        render_cache = 0
+
+        for processor in self.processors:
+            for doc in processor.tagged_documents:
+                for version in distinct_versions(doc):
+                    sizes = version_sizes(version)
+
+                    versions.append(OrderedDict([
+                        ("path", doc.path),
+                        ("refs", sorted(ref for (ref, other) in doc.versions.items() if other is version)),
+                        ("bytes", sum(sizes.values())),
+                        ] + list(sizes.items())))
+
+                # a version that's at several refs counts towards each of
+                # them, so these add up to more than the total
+                for (ref, version) in doc.versions.items():
+                    if version is not None:
+                        refs[ref] += sum(version_sizes(version).values())
+
+            for doc in processor.source_documents:
+                sizes = source_document_sizes(doc)
+                source_documents.append(OrderedDict([("path", doc.path), ("bytes", sum(sizes.values()))] + list(sizes.items())))
+
+            render_cache += render_cache_size(processor.render_cache)
+
+        report["totals"] = OrderedDict([
+            ("versions", len(versions)),
+            ("version_bytes", sum(version["bytes"] for version in versions)),
+            ("source_documents", len(source_documents)),
+            ("source_document_bytes", sum(doc["bytes"] for doc in source_documents)),
+            ("render_cache_bytes", render_cache),
+            ])
+
+        for field in ("text", "lines", "tags", "indexes"):
+            report["totals"]["version_" + field + "_bytes"] = sum(version[field] for version in versions)
+
+        report["refs"] = OrderedDict(sorted(refs.items(), key=lambda item: (-item[1], item[0])))
+
+        largest = lambda entries: sorted(entries, key=lambda entry: (-entry["bytes"], entry["path"]))[:self.top]
+
+        report["largest_versions"] = largest(versions)
+        report["largest_source_documents"] = largest(source_documents)
+
+        if tracemalloc is not None:
+            report["largest_allocations"] = largest_allocations(self.top)
+
+        return report
+
+    def write(self):
+        """Writes the report to this profiler's path, as well as whatever
+        the wrapped profiler writes. Returns the list of paths written."""
+
+        written = self.profiler.write()
+
+        report = self.report()
+
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+        output_dir = os.path.dirname(self.path)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        with open(self.path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+        logging.info("Wrote memory report %s", self.path)
+
+        for (name, measurements) in report["phases"].items():
+            logging.info("Memory: %s allocated %s, peak %s", name, format_size(measurements["allocated"]), format_size(measurements["peak"]))
+
+        totals = report["totals"]
+        logging.info("Memory: %i versions hold %s; %i source documents hold %s", totals["versions"], format_size(totals["version_bytes"]), totals["source_documents"], format_size(totals["source_document_bytes"]))
+
+        return written + [self.path]
+
+def current_memory():
+    """Returns the number of bytes currently allocated by Python, or 0 if
+    that can't be found out."""
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+def peak_memory():
+    """Returns the most bytes allocated by Python at once since tracing
+    (or counting again) started; without tracemalloc, it's the most memory
+    the whole process has used, or 0 if that can't be found out."""
+
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[1]
+
+    if resource is None:
+        return 0
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def distinct_versions(doc):
+    """Returns each version of the tagged document 'doc' that's loaded,
+    once, no matter how many refs it's at."""
+
+    versions = OrderedDict()
+
+    for version in list(doc.versions.values()) + list(getattr(doc, "versions_by_blob", {}).values()):
+        if version is not None:
+            versions[id(version)] = version
+
+    return list(versions.values())
+
+def version_sizes(version):
+    """Estimates the bytes held by the TaggedDocumentVersion 'version', as
+    an OrderedDict of:
+
+    - text: its contents
+    - lines: its TaggedLine objects, and their text
+    - tags: each line's list of tags, and the tags themselves, their bits,
+      stacks and ranges
+    - indexes: the arrays, indents and cached query results used to answer
+      queries
+    """
+
+    getsizeof = sys.getsizeof
+
+    lines = getsizeof(version.lines)
+    tags = getsizeof(version.tag_bits) + getsizeof(version.stacks) + getsizeof(version.tag_ranges)
+
+    for line in version.lines:
+        lines += getsizeof(line) + getsizeof(line.__dict__) + getsizeof(line.text)
+        tags += getsizeof(line.tags)
+
+    tags += sum(getsizeof(tag) for tag in version.tag_bits)
+    tags += sum(getsizeof(stack) for stack in version.stacks)
+    tags += sum(getsizeof(ranges) + sum(getsizeof(tag_range) for tag_range in ranges) for ranges in version.tag_ranges.values())
+
+    indexes = getsizeof(version.widths) + getsizeof(version.stack_ids) + getsizeof(version.indents) + getsizeof(version.matches)
+    indexes += sum(getsizeof(indent) for indent in version.indents)
+    indexes += sum(getsizeof(indices) for indices in version.matches.values())
+
+    return OrderedDict([
+        ("text", getsizeof(version.data)),
+        ("lines", lines),
+        ("tags", tags),
+        ("indexes", indexes),
+        ])
+
+def source_document_sizes(doc):
+    """Estimates the bytes held by the SourceDocument 'doc', as an
+    OrderedDict of its contents, and of the cleaned copy that's made each
+    time its snippets are looked at or it's rendered."""
+
+    return OrderedDict([
+        ("contents", sys.getsizeof(doc.contents)),
+        ("cleaned", sys.getsizeof(doc.cleaned_contents)),
+        ])
+
+def render_cache_size(render_cache):
+    """Estimates the bytes held by a Processor's render cache."""
+
+    getsizeof = sys.getsizeof
+
+    size = getsizeof(render_cache)
+
+    for (rendered_lines, contributing_paths, long_lines) in render_cache.values():
+        size += getsizeof(rendered_lines) + sum(getsizeof(line) for line in rendered_lines)
+        size += getsizeof(contributing_paths) + getsizeof(long_lines)
+
+    return size
+
+def largest_allocations(top):
+    """Returns the 'top' lines of code that the most memory still
+    allocated was allocated by, according to tracemalloc."""
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+
+    return [
+        OrderedDict([
+            ("location", "{}:{}".format(statistic.traceback[0].filename, statistic.traceback[0].lineno)),
+            ("bytes", statistic.size),
+            ("blocks", statistic.count),
+            ])
+            for statistic in snapshot.statistics("lineno")[:top]
+        ]
+
+def format_size(size):
+    """Returns 'size' bytes in a readable form, eg "1.5 MB"."""
+
+    if size is None:
+        return "unknown"
+
+    for unit in ("bytes", "KB", "MB"):
+        if abs(size) < 1024:
+            return "{:.1f} {}".format(size, unit) if unit != "bytes" else "{} {}".format(size, unit)
+        size /= 1024.0
+
+    return "{:.1f} GB".format(size)
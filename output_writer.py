@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import threading
+import logging
+from multiprocessing.pool import ThreadPool
+
+class OutputWriter(object):
+    """Writes files on a pool of background threads, so that rendering can
+    carry on while earlier output is still being written to disk."""
+
+    def __init__(self, jobs=4, fsync=False):
+        self.jobs = max(1, jobs)
+        self.fsync = fsync
+
+        self.pool = ThreadPool(self.jobs)
+
+        # limits how far rendering can get ahead of writing, so that we
+        # don't end up holding every rendered file in memory at once
+        self.slots = threading.BoundedSemaphore(self.jobs * 2)
+
+        # (path, AsyncResult) for every write, in the order they were asked
+        # for
+        self.pending = []
+
+        # new files get the same permissions that open() would have given
+        # them; the umask can only be read by setting it, so we do that
+        # once, here on the calling thread
+        umask = os.umask(0)
+        os.umask(umask)
+        self.new_file_mode = 0o666 & ~umask
+
+    def write(self, path, contents):
+        """Queues 'contents' to be written to 'path'. Blocks if too many
+        writes are already waiting."""
+        self.slots.acquire()
+        self.pending.append((path, self.pool.apply_async(self._write, (path, contents))))
+
+    def close(self):
+        """Waits for every queued write to finish. Returns a list of
+        (path, error) tuples for the writes that failed, sorted by path."""
+
+        self.pool.close()
+        self.pool.join()
+
+        errors = []
+        written_dirs = set()
+
+        for (path, result) in self.pending:
+            try:
+                result.get()
+                written_dirs.add(os.path.dirname(os.path.abspath(path)))
+            except (IOError, OSError) as error:
+                errors.append((path, error))
+
+        # a rename isn't durable until its directory has been synced; doing
+        # it once per directory, after every file is written, means a
+        # directory of many small files is only synced once
+        if self.fsync:
+            for directory in sorted(written_dirs):
+                try:
+                    sync_directory(directory)
+                except (IOError, OSError) as error:
+                    errors.append((directory, error))
+
+        errors.sort(key=lambda error: error[0])
+
+        for (path, error) in errors:
+            logging.error("Failed to write %s: %s", path, error)
+
+        return errors
+
+    def _write(self, path, contents):
+        try:
+            directory = os.path.dirname(path) or "."
+
+            # write to a temporary file next to the real one, and then
+            # rename it into place, so that nobody ever sees a half-written
+            # file
+            (handle, temp_path) = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+
+            try:
+                with os.fdopen(handle, "w") as temp_file:
+                    temp_file.write(contents)
+
+                    if self.fsync:
+                        temp_file.flush()
+                        os.fsync(temp_file.fileno())
+
+                if os.path.exists(path):
+                    shutil.copymode(path, temp_path)
+                else:
+                    os.chmod(temp_path, self.new_file_mode)
+
+                replace_file(temp_path, path)
+            except:
+                os.remove(temp_path)
+                raise
+        finally:
+            self.slots.release()
+
+def replace_file(source, destination):
+    """Renames 'source' to 'destination', replacing it if it exists."""
+    if hasattr(os, "replace"):
+        os.replace(source, destination)
+    else:
+        # Python 2's rename only replaces existing files on POSIX
+        if os.name == "nt" and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+def sync_directory(path):
+    """Flushes a directory's entries (eg a rename) to disk."""
+    if os.name == "nt":
+        # Windows can't open directories, and doesn't need this
+        return
+
+    handle = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
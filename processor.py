@@ -3,12 +3,28 @@
 
 import git
 from gooey import Gooey, GooeyParser
-from tagged_document import TaggedDocument, TagQuery
-from source_document import SourceDocument
+from tagged_document import TaggedDocument, TagQuery, TagPattern, RefResolver, VersionCache, tags_matching, is_tag_pattern
+from source_document import SourceDocument, SNIP, SNIP_FILE
+from profiling import PhaseProfiler, NullProfiler
+from memory_profiling import MemoryProfiler
+from output_writer import OutputWriter, replace_file
+from git_objects import object_source, BACKENDS, GITPYTHON
+from snippet_index import SnippetIndex, write_index
+import sharding
 import logging
 from argparse import ArgumentParser
 import sys
 import os
+import time
+import json
+import bisect
+from io import BytesIO
+import hashlib
+import tarfile
+import tempfile
+import multiprocessing
+import zipfile
+from collections import OrderedDict
 
 from source_document import WORKSPACE_REF
 
@@ -21,15 +37,67 @@ SOURCE_FILE_EXTENSIONS = [
 
 class Processor(object):
     
-    def __init__(self, source_path, tagged_path, source_extensions=["txt"], tagged_extensions=["swift"], language=None, clean=False, expand_images=False, show_query=False, as_inline_list_items=False):
+    def __init__(self, source_path, tagged_path, source_extensions=["txt"], tagged_extensions=["swift"], language=None, clean=False, expand_images=False, show_query=False, as_inline_list_items=False, profiler=None, jobs=4, fsync=False, lazy=False, sparse_history=False, max_cached_versions=None, git_objects=GITPYTHON, index_path=None, parse_processes=0):
         assert isinstance(source_path, str)
-        assert isinstance(tagged_path, str)
+
+        # cleaning only removes expanded snippets, so it never needs the
+        # code repo, which may not even exist; nor does anything that uses
+        # a snippet index
+        assert isinstance(tagged_path, str) or clean or index_path
         
+        self.profiler = profiler or NullProfiler()
+
+        self.source_path = source_path
+        self.source_extensions = source_extensions
+        self.tagged_extensions = tagged_extensions
+
+        with self.profiler.phase("discovery"):
+            # if set, the snippet index that every version of the tagged
+            # documents comes from, instead of the repo; see snippet_index
+            self.index = SnippetIndex(index_path) if index_path and not clean else None
+
+            if clean or self.index is not None:
+                self.repo = None
+                tagged_paths = []
+            else:
+                self.repo = git.Repo(tagged_path)
+                tagged_paths = TaggedDocument.find_paths(self.repo, tagged_extensions)
+
+            # the directory that snip-files are found in
+            if self.index is not None:
+                self.code_path = self.index.root
+            else:
+                self.code_path = self.repo.working_dir if self.repo else None
+
+            self.source_documents = SourceDocument.find(source_path, source_extensions, jobs=jobs)
 
-        self.repo = git.Repo(tagged_path)
+        # where files from history are read from; see git_objects. An
+        # index already knows which commit each ref named.
+        if self.index is not None:
+            self.resolver = self.index
+        else:
+            self.resolver = RefResolver(self.repo, object_source(self.repo, git_objects)) if self.repo else None
+
+        # if set, limits how many versions from history are kept in memory
+        self.version_cache = VersionCache(max_cached_versions) if max_cached_versions and self.repo else None
+
+        with self.profiler.phase("parse"):
+            if self.index is not None:
+                self.tagged_documents = [doc for doc in self.index.documents if any(doc.path.endswith("." + extension) for extension in tagged_extensions)]
+            else:
+                self.tagged_documents = [TaggedDocument(self.repo, path, self.resolver, self.version_cache) for path in tagged_paths]
+
+            # what HEAD and each tagged document's modification time were
+            # when we last looked, so that refresh() can tell what changed
+            self.head = self.current_head()
+            self.modification_times = {doc.path: self.modification_time(doc) for doc in self.tagged_documents}
+
+            # unless we're being lazy, read every document now; otherwise,
+            # they're read the first time a chapter needs them. An index
+            # reads each version as it's needed anyway.
+            if not lazy and self.index is None:
+                TaggedDocument.load_working_copies(self.tagged_documents, jobs=jobs, processes=parse_processes)
 
-        self.tagged_documents = TaggedDocument.find(self.repo, tagged_extensions)
-        self.source_documents = SourceDocument.find(source_path, source_extensions)
         self.clean = clean
 
         self.language = language
@@ -39,47 +107,581 @@ class Processor(object):
         self.show_query = show_query
 
         self.as_inline_list_items = as_inline_list_items
+
+        self.jobs = jobs
+
+        self.fsync = fsync
+
+        # if true, files are only loaded from history if they're expected
+        # to define the tags that are needed there
+        self.sparse_history = sparse_history
+
+        # maps (ref, query, width limit) to the rendered lines of a snippet,
+        # for renders that use every tagged document; shared between
+        # chapters, and emptied whenever the code changes
+        self.render_cache = {}
+
+        # an entry for each overlong line found by the last call to
+        # process()
+        self.width_report = []
+
+        # maps the path of each chapter rendered by the last call to
+        # process() to how long it took, where it was written, and which
+        # tags it used
+        self.chapter_stats = OrderedDict()
+
+        # when refresh() last looked for changes
+        self.last_refresh = None
     
-    def get_file_contents(self, name):
+    def current_head(self):
+        if self.index is not None:
+            return self.index.head
+
+        if self.repo is None:
+            return None
+
+        try:
+            return self.repo.head.commit.hexsha
+        except ValueError:
+            # the repo has no commits yet
+            return None
+
+    def refresh(self, min_interval=0):
+        """Brings a long-lived Processor up to date with the code repo:
+        forgets everything about history if HEAD has moved, picks up added
+        and removed tagged documents and refs that didn't exist before, and
+        forgets the working copy of any document that's been modified on
+        disk. Everything forgotten is reloaded the next time it's needed.
+        Returns True if anything changed.
+
+        Looking for changes means walking the whole repo, so if the last
+        look was less than 'min_interval' seconds ago, nothing is done."""
+
+        # an index never changes once it's built
+        if self.index is not None:
+            return False
+
+        now = time.time()
+
+        if self.last_refresh is not None and now - self.last_refresh < min_interval:
+            return False
+
+        self.last_refresh = now
+
+        changed = False
+
+        head = self.current_head()
+
+        if head != self.head:
+            logging.debug("HEAD moved from %s to %s", self.head, head)
+
+            # branches (and possibly tags) may point somewhere else now
+            self.resolver.clear()
+
+            for doc in self.tagged_documents:
+                doc.forget_history()
+
+            self.head = head
+            changed = True
+
+        # a ref that didn't exist last time (eg a tag that's just been
+        # made) does now, so documents mustn't keep saying they're not there
+        created = self.resolver.recheck_unknown()
+
+        if created:
+            logging.debug("Refs now exist: %s", ", ".join(created))
+
+            for doc in self.tagged_documents:
+                for ref in created:
+                    doc.forget(ref)
+
+            changed = True
+
+        existing = {doc.path: doc for doc in self.tagged_documents}
+
+        tagged_paths = [path.replace(os.sep, "/") for path in TaggedDocument.find_paths(self.repo, self.tagged_extensions)]
+
+        if set(tagged_paths) != set(existing):
+            changed = True
+
+        self.tagged_documents = [existing.get(path) or TaggedDocument(self.repo, path, self.resolver, self.version_cache) for path in tagged_paths]
+
+        for doc in self.tagged_documents:
+            modification_time = self.modification_time(doc)
+
+            if self.modification_times.get(doc.path) != modification_time:
+                if doc.path in self.modification_times:
+                    changed = True
+
+                doc.forget(WORKSPACE_REF)
+                self.modification_times[doc.path] = modification_time
+
+        if changed:
+            self.render_cache.clear()
+
+        return changed
+
+    def modification_time(self, doc):
+        try:
+            return os.path.getmtime(os.path.join(self.code_path, doc.path))
+        except OSError:
+            return None
 
-        for root, dirs, files in os.walk(self.repo.working_dir):
+    def get_file_contents(self, name, used_paths=None):
+        """Returns the contents of the file in the code repo called 'name'.
+        If 'used_paths' is a set, the file's path in the repo is added to
+        it, so that chapters that include it can be rendered again when it
+        changes."""
+
+        found = self.snip_file(name)
+
+        if found:
+            (path, contents) = found
+
+            if used_paths is not None:
+                used_paths.add(path)
+
+            return contents
+        
+        logging.error("Failed to find %s", name)
+
+    def snip_file(self, name):
+        """Returns a (path, contents) tuple for the file called 'name' that
+        snip-file commands include, where 'path' is relative to the code
+        repo, or None if there isn't one. With an index, it comes from the
+        index, rather than the repo."""
+
+        if self.index is not None:
+            found = self.index.file(name)
+
+            if found is None:
+                logging.error("'%s' is not in the snippet index %s; rebuild it with --build-index", name, self.index.path)
+
+            return found
+
+        path = self.find_file(name)
+
+        if path is None:
+            return None
+
+        with open(path) as snip_file:
+            return (os.path.relpath(path, self.code_path).replace(os.sep, "/"), snip_file.read())
+
+    def find_file(self, name):
+        """Returns the path of the first file in the code repo called
+        'name', or None if there isn't one."""
+
+        for root, dirs, files in os.walk(self.code_path):
             
             for file in files:                
                 if file == name:
-                    path = os.path.join(root, file)
-                    return open(path).read()
-        
-        logging.error("Failed to find %s", name)
+                    return os.path.join(root, file)
     
-    def process(self, dry_run=False, suffix=""):
+    def prewarm(self, source_documents=None, tagged_documents=None):
+        """Loads every version of the tagged documents that the source
+        documents refer to, so that rendering can happen entirely in
+        memory. Defaults to all of the source and tagged documents."""
 
-        file_getter = lambda name: self.get_file_contents(name)
+        if source_documents is None:
+            source_documents = self.source_documents
 
-        for doc in self.source_documents:
+        if tagged_documents is None:
+            tagged_documents = self.tagged_documents
+
+        # an index already has every version that the book uses
+        if self.index is not None:
+            return
+
+        if self.sparse_history:
+            self.prewarm_sparse(source_documents, tagged_documents)
+            return
+
+        refs = set()
+        for doc in source_documents:
+            refs |= doc.refs_used
+
+        with self.profiler.phase("history"):
+            TaggedDocument.prewarm(tagged_documents, sorted(refs), jobs=self.jobs)
+
+    def prewarm_sparse(self, source_documents, tagged_documents):
+        """Like prewarm(), but at each ref, only loads the tagged documents
+        that are expected to define the tags the source documents ask for
+        there (see candidate_documents()). Refs are loaded in the order
+        they're first used, so that what's learned about each one informs
+        the next."""
+
+        tags_by_ref = OrderedDict()
+
+        for doc in source_documents:
+            for directive in doc.directives:
+                if directive.kind == SNIP and directive.ref != WORKSPACE_REF:
+                    tags_by_ref.setdefault(directive.ref, set()).update(query_tags(directive.argument))
+
+        loaded = 0
+
+        with self.profiler.phase("history"):
+            for (ref, tags) in tags_by_ref.items():
+                candidates = self.candidate_documents(tags, tagged_documents)
+
+                TaggedDocument.prewarm(candidates, [ref], jobs=self.jobs)
+                loaded += len(candidates)
+
+        logging.debug("Loaded %i of %i possible document versions at %i refs", loaded, len(tagged_documents) * len(tags_by_ref), len(tags_by_ref))
+
+    def candidate_documents(self, tags, tagged_documents):
+        """Returns the documents in 'tagged_documents' that define any of
+        'tags' (which may include wildcard tags) in the working copy, or in
+        any other version of them that's been loaded so far."""
+
+        candidates = []
+
+        for doc in tagged_documents:
+            # make sure the working copy is among the known versions
+            doc[WORKSPACE_REF]
+
+            if tags_matching(tags, doc.known_tags):
+                candidates.append(doc)
+
+        return candidates
+
+    def document_selector(self, tagged_documents):
+        """Returns a function for SourceDocument.render's
+        'document_selector', which narrows 'tagged_documents' down to the
+        candidates for each query in history, or None if history isn't
+        being loaded sparsely."""
+
+        if not self.sparse_history:
+            return None
+
+        def select(ref, query_text):
+            if ref == WORKSPACE_REF:
+                return tagged_documents
+
+            return self.candidate_documents(query_tags(query_text), tagged_documents)
+
+        return select
+
+    def profile(self, suffix="", state_path=None):
+        """Returns an OutputProfile for the source documents and options
+        this Processor was created with."""
+        return OutputProfile(
+            self.source_path,
+            language=self.language,
+            show_query=self.show_query,
+            as_inline_list_items=self.as_inline_list_items,
+            suffix=suffix,
+            source_extensions=self.source_extensions,
+            state_path=state_path,
+            source_documents=self.source_documents)
+
+    def process_profiles(self, profiles, dry_run=False, since=None, width_limit=None):
+        """Renders every edition in 'profiles', a list of OutputProfiles,
+        one after the other. The tagged documents are only discovered and
+        parsed once, and snippets that several editions share are only
+        rendered once. Returns a list of (path, error) tuples for any
+        files that couldn't be written."""
+
+        errors = []
+        width_report = []
+        chapter_stats = OrderedDict()
+
+        for profile in profiles:
+            if len(profiles) > 1:
+                logging.info("Building %s", profile.name)
+
+            errors += self.process(dry_run=dry_run, since=since, width_limit=width_limit, profile=profile)
+            width_report += self.width_report
+
+            if len(profiles) > 1:
+                for stats in self.chapter_stats.values():
+                    stats["key"] = sharding.stats_key(stats["key"], profile.name)
+
+            chapter_stats.update(self.chapter_stats)
+
+        self.width_report = width_report
+        self.chapter_stats = chapter_stats
+
+        return errors
+
+    def process(self, dry_run=False, suffix="", since=None, state_path=None, width_limit=None, profile=None):
+        """Renders every source document, and writes the ones that changed.
+        Returns a list of (path, error) tuples for any files that couldn't
+        be written.
+
+        If 'profile' is given, its source documents, options, suffix and
+        state path are used instead of this Processor's own and 'suffix'
+        and 'state_path'.
+
+        If 'width_limit' is given, every rendered snippet line wider than
+        that many columns is logged and recorded in self.width_report.
+
+        If 'state_path' is given, the tags, refs and tagged documents that
+        each chapter used are saved there. If 'since' is also given, it's
+        a commit to compare the code repo against: only chapters affected
+        by files changed since then are rendered, using the state saved by
+        the previous run."""
+
+        if profile is None:
+            profile = self.profile(suffix, state_path)
+
+        if self.clean:
+            return self.clean_documents(profile, dry_run)
+
+        suffix = profile.suffix
+        state_path = profile.state_path
+
+        previous_state = load_state(state_path) if state_path else None
+
+        # maps the paths of the chapters we're rendering to the tagged
+        # documents they need
+        plan = None
+
+        if since is not None and not self.clean:
+            plan = self.plan_changes(since, previous_state, profile=profile)
+
+        if plan is None:
+            plan = OrderedDict((doc.path, self.tagged_documents) for doc in profile.source_documents)
+
+        source_documents = [doc for doc in profile.source_documents if doc.path in plan]
+
+        # if history is being kept to a limited number of versions, it's
+        # loaded one chapter at a time, rather than all at once
+        bounded = self.version_cache is not None
+
+        if not self.clean and not bounded:
+            needed = set(tagged.path for doc in source_documents for tagged in plan[doc.path])
+            self.prewarm(source_documents, [tagged for tagged in self.tagged_documents if tagged.path in needed])
+
+        if bounded:
+            # for each chapter, the refs that it and the chapters after it
+            # use; versions at other refs are the first to be forgotten
+            future_refs = [set() for doc in source_documents] + [set()]
+
+            for index in reversed(range(len(source_documents))):
+                future_refs[index] = source_documents[index].refs_used | future_refs[index + 1]
+
+        writer = OutputWriter(jobs=self.jobs, fsync=self.fsync)
+
+        chapter_states = OrderedDict(previous_state["chapters"] if previous_state else [])
+
+        self.width_report = []
+        self.chapter_stats = OrderedDict()
+
+        for (position, doc) in enumerate(source_documents):
             assert isinstance(doc, SourceDocument)
-            rendered_source, dirty = doc.render(
-                self.tagged_documents, 
-                language=self.language, 
-                clean=self.clean, 
-                file_getter=file_getter,
-                show_query=self.show_query,
-                as_inline_list_items=self.as_inline_list_items
-                )
+
+            used_documents = set()
+
+            # the files that snip-file commands include are recorded along
+            # with the tagged documents the chapter used
+            file_getter = lambda name: self.get_file_contents(name, used_documents)
+
+            start_time = time.time()
+
+            if bounded and not self.clean:
+                self.version_cache.future_refs = future_refs[position]
+                self.prewarm([doc], plan[doc.path])
+
+            with self.profiler.phase("render"):
+                rendered_source, dirty = doc.render(
+                    plan[doc.path], 
+                    language=profile.language, 
+                    clean=self.clean, 
+                    file_getter=file_getter,
+                    show_query=profile.show_query,
+                    as_inline_list_items=profile.as_inline_list_items,
+                    used_documents=used_documents,
+                    # chapters rendered against only some of the tagged
+                    # documents can't share results with the others
+                    render_cache=self.render_cache if plan[doc.path] is self.tagged_documents else {},
+                    width_limit=width_limit,
+                    width_report=self.width_report,
+                    document_selector=self.document_selector(plan[doc.path])
+                    )
+
+            chapter_states[doc.path] = OrderedDict([
+                ("hash", content_hash(doc.cleaned_contents)),
+                ("documents", sorted(used_documents)),
+                ("refs", OrderedDict((ref, self.resolver.commit(ref)) for ref in sorted(doc.refs_used) if ref != WORKSPACE_REF)),
+                ])
+
+            self.chapter_stats[doc.path] = OrderedDict([
+                ("key", os.path.relpath(doc.path, profile.source_path).replace(os.sep, "/")),
+                ("seconds", round(time.time() - start_time, 6)),
+                ("output", doc.path + suffix if dirty and not dry_run else None),
+                ("tags_used", sorted(doc.tags_used)),
+                ])
+
+            if dirty:
+                if dry_run:
+                    logging.info("Would write %s", doc.path)
+                else:
+                    writer.write(doc.path + suffix, rendered_source)
+                    logging.info("Writing %s", doc.path)
+
+        if bounded:
+            self.version_cache.future_refs = None
+            logging.debug("Forgot %i versions to stay within %i", self.version_cache.evictions, self.version_cache.max_versions)
+
+        for entry in self.width_report:
+            logging.info("Line too long: %s", format_width_entry(entry))
+
+        errors = writer.close()
+
+        if state_path and not dry_run and not self.clean:
+            if errors:
+                # the chapters that weren't written must be rendered again
+                # next time, so the previous state is kept
+                logging.error("Not saving %s, since some chapters couldn't be written", state_path)
+                return errors
+
+            # chapters that no longer exist are dropped
+            existing = set(doc.path for doc in profile.source_documents)
+
+            state = OrderedDict([
+                ("options", profile.render_options),
+                ("chapters", OrderedDict((path, chapter_states[path]) for path in chapter_states if path in existing)),
+                ])
+
+            writer = OutputWriter(jobs=1, fsync=self.fsync)
+            writer.write(state_path, json.dumps(state, indent=2))
+            errors = writer.close()
+
+        return errors
+
+    def clean_documents(self, profile, dry_run=False):
+        """Removes the expanded snippets from every source document in
+        'profile', without looking at the code repo. Only chapters that had
+        something removed are written back (a chapter is always written if
+        'profile' has a suffix). Returns a list of (path, error) tuples for
+        any files that couldn't be written."""
+
+        writer = OutputWriter(jobs=self.jobs, fsync=self.fsync)
+
+        self.width_report = []
+        self.chapter_stats = OrderedDict()
+
+        for doc in profile.source_documents:
+            start_time = time.time()
+
+            with self.profiler.phase("render"):
+                cleaned = doc.cleaned_contents
+
+            dirty = cleaned != doc.contents or profile.suffix != ""
+
+            self.chapter_stats[doc.path] = OrderedDict([
+                ("key", os.path.relpath(doc.path, profile.source_path).replace(os.sep, "/")),
+                ("seconds", round(time.time() - start_time, 6)),
+                ("output", doc.path + profile.suffix if dirty and not dry_run else None),
+                ("tags_used", []),
+                ])
 
             if dirty:
                 if dry_run:
                     logging.info("Would write %s", doc.path)
                 else:
-                    with open(doc.path + suffix, "w") as output_file:
-                        output_file.write(rendered_source)
+                    writer.write(doc.path + profile.suffix, cleaned)
                     logging.info("Writing %s", doc.path)
+
+        return writer.close()
+
+    def render_options(self, suffix):
+        """Returns the options that affect rendered output; a change to any
+        of these means every chapter must be rendered again."""
+        return self.profile(suffix).render_options
+
+    def changed_paths(self, base):
+        """Returns the set of paths in the code repo that differ between
+        the commit 'base' and the working copy (committed or not), or None
+        if 'base' can't be compared against."""
+
+        if self.repo is None:
+            logging.error("Can't find changes since '%s' without the code repo", base)
+            return None
+
+        try:
+            # comparing against the working tree, rather than HEAD, picks up
+            # uncommitted changes as well as commits
+            output = self.repo.git.diff("--name-only", "--no-renames", base)
+        except git.GitCommandError as error:
+            logging.error("Can't find changes since '%s': %s", base, error)
+            return None
+
+        changed = set(output.splitlines())
+        changed.update(self.repo.untracked_files)
+
+        return changed
+
+    def plan_changes(self, base, state, suffix="", profile=None):
+        """Works out which chapters are affected by the changes to the code
+        repo since 'base', given the state saved by the previous run.
+        Returns an OrderedDict mapping the path of each affected chapter to
+        the tagged documents it should be rendered with, or None if
+        everything needs to be rendered."""
+
+        if profile is None:
+            profile = self.profile(suffix)
+
+        if state is None:
+            logging.info("No saved state from a previous run; rendering everything")
+            return None
+
+        if state.get("options") != profile.render_options:
+            logging.info("Rendering options have changed since the last run; rendering everything")
+            return None
+
+        changed = self.changed_paths(base)
+
+        if changed is None:
+            return None
+
+        changed_documents = [doc for doc in self.tagged_documents if doc.path in changed]
+
+        # a changed file might now define a tag that a chapter is looking
+        # for, even if that chapter didn't use the file last time
+        changed_tags = set()
+        for doc in changed_documents:
+            if doc[WORKSPACE_REF]:
+                changed_tags |= doc[WORKSPACE_REF].tags
+
+        plan = OrderedDict()
+
+        for doc in profile.source_documents:
+            previous = state["chapters"].get(doc.path)
+
+            # chapters that are new, that have been edited, or whose output
+            # has gone missing depend on everything
+            if previous is None or previous["hash"] != content_hash(doc.cleaned_contents) or not os.path.exists(doc.path + profile.suffix):
+                plan[doc.path] = self.tagged_documents
+                continue
+
+            # so do chapters that refer to a tag or branch that has moved
+            if any(self.resolver.commit(str(ref)) != commit for (ref, commit) in previous["refs"].items()):
+                plan[doc.path] = self.tagged_documents
+                continue
+
+            used = set(previous["documents"])
+
+            if used & changed or tags_matching(doc.tags_used, changed_tags):
+                plan[doc.path] = [tagged for tagged in self.tagged_documents if tagged.path in used or tagged.path in changed]
+
+        logging.info("%i changed files affect %i of %i chapters", len(changed), len(plan), len(profile.source_documents))
+
+        return plan
     
     def extract_snippets(self, extract_dir):
+        """Renders each snippet into its own file in 'extract_dir'. Returns
+        a list of (path, error) tuples for any files that couldn't be
+        written."""
         if os.path.isdir(extract_dir) == False:
             logging.error("%s is not a directory.", extract_dir)
-            return
+            return [(extract_dir, "not a directory")]
 
         use_file_prefix = len(self.source_documents) > 1
+
+        self.prewarm()
+
+        writer = OutputWriter(jobs=self.jobs, fsync=self.fsync)
         
         for doc in self.source_documents:
 
@@ -94,60 +696,636 @@ class Processor(object):
 
                 dest_path = os.path.join(extract_dir,filename)
 
-                output = doc.render_snippet(snippet, self.tagged_documents)
+                with self.profiler.phase("render"):
+                    output = doc.render_snippet(snippet, self.tagged_documents)
 
-                with open(dest_path, "w") as f:
-                    f.write(output)
+                writer.write(dest_path, output)
 
+        return writer.close()
 
-    def find_overlong_lines(self, limit):
-        import itertools
-        all_long_lines = itertools.chain(*[doc[WORKSPACE_REF].lines_over_limit(limit) for doc in self.tagged_documents])
 
-        for line in all_long_lines:
-            logging.info("Line too long: %s:%i (%i > %i)", line.source_name, line.line_number, len(line.text), limit)
+    def extract_snippet_archive(self, archive_path):
+        """Renders every distinct snippet in the book once, and writes them
+        all to a single archive at 'archive_path', along with a manifest
+        that maps each chapter's snippets to the content hash of their
+        rendered text.
 
+        The format is picked from the extension: ".zip", ".tar",
+        ".tar.gz"/".tgz", or ".jsonl" for a stream of JSON records."""
 
-    
-    def find_multiply_defined_tags(self):
+        self.prewarm()
+
+        # maps (ref, query) to the hash of its rendered content
+        hashes_by_query = {}
+
+        # maps content hashes to rendered content, in first-seen order
+        contents_by_hash = OrderedDict()
+
+        manifest = []
+
+        for doc in self.source_documents:
+
+            for (count, snippet) in enumerate(doc.snippets):
+
+                # the same query at the same ref renders the same text, no
+                # matter which chapter it's in
+                key = snippet.cache_key
+
+                if key not in hashes_by_query:
+                    with self.profiler.phase("render"):
+                        output = doc.render_snippet(snippet, self.tagged_documents)
+
+                    output_hash = content_hash(output)
+
+                    hashes_by_query[key] = output_hash
+                    contents_by_hash.setdefault(output_hash, output)
+
+                manifest.append(OrderedDict([
+                    ("chapter", doc.path),
+                    ("index", count),
+                    ("ref", snippet.ref),
+                    ("query", snippet.query_string.strip()),
+                    ("hash", hashes_by_query[key]),
+                    ]))
+
+        logging.info("Rendered %i snippets (%i distinct queries, %i distinct contents)", len(manifest), len(hashes_by_query), len(contents_by_hash))
+
+        # write to a temporary file first, so that a failed run doesn't
+        # leave a truncated archive behind
+        (handle, temp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(archive_path)), suffix=".tmp")
+        os.close(handle)
+
+        try:
+            write_snippet_archive(temp_path, archive_path, manifest, contents_by_hash)
+            replace_file(temp_path, archive_path)
+        except:
+            os.remove(temp_path)
+            raise
+
+        logging.info("Writing %s", archive_path)
+
+        return manifest
+
+    def build_index(self, path, profiles=None):
+        """Writes every version of the tagged documents that the source
+        documents (or those of 'profiles') use to a snippet index at
+        'path', along with the working copy and HEAD, so that later runs
+        can render from it without the code repo. Returns the number of
+        distinct versions written."""
+
+        assert self.repo is not None, "Building an index needs the code repo"
+
+        if profiles is None:
+            profiles = [self.profile()]
+
+        refs = set([WORKSPACE_REF, "HEAD"])
+        for profile in profiles:
+            for doc in profile.source_documents:
+                refs |= doc.refs_used
+
+        refs = sorted(refs)
+
+        # the files that snip-file commands include are stored too, so that
+        # the repo isn't needed for them either
+        files = {}
+
+        for profile in profiles:
+            for doc in profile.source_documents:
+                for directive in doc.directives:
+                    if directive.kind == SNIP_FILE and directive.argument not in files:
+                        found = self.snip_file(directive.argument)
+
+                        if found is None:
+                            logging.error("%s:%i: Failed to find %s", doc.path, directive.line_number, directive.argument)
+                        else:
+                            files[directive.argument] = found
+
+        with self.profiler.phase("history"):
+            TaggedDocument.prewarm(self.tagged_documents, refs, jobs=self.jobs)
+
+        commits = dict((ref, self.resolver.commit(ref)) for ref in refs if ref != WORKSPACE_REF)
+
+        with self.profiler.phase("index"):
+            return write_index(path, self.tagged_documents, refs, commits, os.path.abspath(self.code_path), self.current_head(), files)
+
+    def build_graph(self):
+        """Returns a JSON-ready description of which tags, at which refs,
+        each chapter's snippets depend on, and which files and line ranges
+        define those tags. Nothing is rendered; it's built from the
+        snippet commands and each version's tag index."""
+
+        self.prewarm()
+
+        # maps refs to dictionaries that map tags to the places they're
+        # defined at that ref; built once per ref, on demand
+        definitions_by_ref = {}
+
+        def definitions(ref):
+            if ref not in definitions_by_ref:
+                index = {}
+
+                for doc in self.tagged_documents:
+                    version = doc[ref]
+
+                    if version is None:
+                        continue
+
+                    for (tag, ranges) in version.tag_ranges.items():
+                        index.setdefault(tag, []).append(OrderedDict([
+                            ("file", doc.path),
+                            ("lines", [list(line_range) for line_range in ranges]),
+                            ]))
+
+                definitions_by_ref[ref] = index
+
+            return definitions_by_ref[ref]
+
+        chapters = []
+        refs = OrderedDict()
+
+        for doc in self.source_documents:
+
+            snippets = []
+            snippet_count = 0
+
+            for directive in doc.directives:
+
+                if directive.ref not in refs:
+                    refs[directive.ref] = None if directive.ref == WORKSPACE_REF else self.resolver.commit(directive.ref)
+
+                if directive.kind == SNIP_FILE:
+                    found = self.snip_file(directive.argument)
+
+                    snippets.append(OrderedDict([
+                        ("kind", directive.kind),
+                        ("line", directive.line_number),
+                        ("file", directive.argument),
+                        ("path", found[0] if found else None),
+                        ]))
+                    continue
+
+                query = directive.query
+
+                tags = []
+
+                for (role, tag_list) in [("include", query.include), ("exclude", query.exclude), ("isolate", query.isolate)]:
+                    for tag in tag_list:
+                        if not tag:
+                            continue
+
+                        tags.append(OrderedDict([
+                            ("tag", tag),
+                            ("role", role),
+                            ("definitions", definitions(directive.ref).get(tag, [])),
+                            ]))
+
+                snippets.append(OrderedDict([
+                    ("kind", directive.kind),
+                    ("index", snippet_count),
+                    ("line", directive.line_number),
+                    ("ref", directive.ref),
+                    ("query", directive.argument.strip()),
+                    ("tags", tags),
+                    ]))
+
+                snippet_count += 1
+
+            chapters.append(OrderedDict([
+                ("path", doc.path),
+                ("snippets", snippets),
+                ]))
+
+        return OrderedDict([
+            ("refs", refs),
+            ("chapters", chapters),
+            ])
+
+    def write_width_report(self, path):
+        """Writes the overlong lines found by the last call to process() to
+        'path': as JSON if it ends in ".json", and as one line of text per
+        entry otherwise."""
+
+        write_width_report(path, self.width_report)
+
+    def check(self, profiles=None, width_limit=None):
+        """Checks that every snip and snip-file command in 'profiles' (by
+        default, this Processor's own source documents) can be resolved,
+        without rendering anything. Queries are answered from each tagged
+        document's tag index, and only the lines wider than 'width_limit'
+        columns are ever dedented or measured. Returns a JSON-ready report
+        of the missing snippets and files, the tags defined in more than
+        one file, and the overlong lines; its "ok" is False if there were
+        any of those."""
+
+        if profiles is None:
+            profiles = [self.profile()]
+
+        # the names of the files that snip-file commands can refer to; see
+        # snip_file()
+        if self.index is not None:
+            file_names = set(self.index.files)
+        else:
+            file_names = set(name for (root, dirs, files) in os.walk(self.code_path) for name in files)
+
+        # maps (ref, query) to the result of check_query(), so that each is
+        # only looked up once
+        results = {}
+
+        # maps refs to the tag_index() of every tagged document there
+        indexes = {}
+
+        chapters = 0
+        snippets = 0
+        missing_snippets = []
+        missing_files = []
+        width_report = []
+
+        for profile in profiles:
+            self.prewarm(profile.source_documents)
+
+            for doc in profile.source_documents:
+                chapters += 1
+                snippet_count = 0
+
+                for directive in doc.directives:
+                    if directive.kind == SNIP_FILE:
+                        if directive.argument not in file_names:
+                            logging.error("%s:%i: Failed to find %s", doc.path, directive.line_number, directive.argument)
+
+                            missing_files.append(OrderedDict([
+                                ("chapter", doc.path),
+                                ("line", directive.line_number),
+                                ("file", directive.argument),
+                                ]))
+
+                        # render() numbers these along with the snippets
+                        snippet_count += 1
+                        continue
+
+                    query_text = directive.argument
+
+                    key = (directive.ref, TagQuery.normalise(query_text))
+
+                    if key not in results:
+                        results[key] = self.check_query(directive.ref, query_text, width_limit, indexes)
+
+                    (found, long_lines) = results[key]
+
+                    if not found:
+                        logging.error("%s:%i: No code found for query '%s' at ref '%s'", doc.path, directive.line_number, query_text.strip(), directive.ref)
+
+                        missing_snippets.append(OrderedDict([
+                            ("chapter", doc.path),
+                            ("line", directive.line_number),
+                            ("ref", directive.ref),
+                            ("query", query_text.strip()),
+                            ]))
+
+                    for (offset, path, width, text) in long_lines:
+                        width_report.append(OrderedDict([
+                            ("chapter", doc.path),
+                            ("line", directive.line_number),
+                            ("snippet", snippet_count),
+                            ("offset", offset),
+                            ("ref", directive.ref),
+                            ("query", query_text.strip()),
+                            ("file", path),
+                            ("width", width),
+                            ("limit", width_limit),
+                            ("text", text),
+                            ]))
+
+                    snippet_count += 1
+                    snippets += 1
+
+        for entry in width_report:
+            logging.info("Line too long: %s", format_width_entry(entry))
+
+        duplicate_tags = self.multiply_defined_tags()
+
+        report_multiply_defined_tags(duplicate_tags, {doc.path: doc.tags_used for profile in profiles for doc in profile.source_documents})
+
+        return OrderedDict([
+            ("ok", not (missing_snippets or missing_files or duplicate_tags or width_report)),
+            ("chapters", chapters),
+            ("snippets", snippets),
+            ("missing_snippets", missing_snippets),
+            ("missing_files", missing_files),
+            ("duplicate_tags", OrderedDict((tag, duplicate_tags[tag]) for tag in sorted(duplicate_tags))),
+            ("width_report", width_report),
+            ])
+
+    def check_query(self, ref, query_text, width_limit=None, indexes=None):
+        """Returns a tuple of (found, long_lines) for the query 'query_text'
+        at 'ref': whether any tagged document has lines for it, and an
+        (offset, path, width, text) tuple for each line of the snippet that
+        would be wider than 'width_limit' columns. Offsets count from 1,
+        as they do in render's width report.
+
+        'indexes' maps refs to the tag_index() of every tagged document at
+        that ref, and is filled in as refs are needed."""
+
+        documents = None
+
+        # look where rendering would look first; see document_selector()
+        if self.sparse_history and ref != WORKSPACE_REF:
+            candidates = self.candidate_documents(query_tags(query_text), self.tagged_documents)
+
+            if any(doc[ref] and doc[ref].matching_indices(query_text) for doc in candidates):
+                documents = candidates
+
+        if documents is None:
+            # only documents with one of the tags the query asks for can
+            # have lines for it
+            if indexes is None:
+                indexes = {}
+
+            if ref not in indexes:
+                indexes[ref] = self.tag_index(ref)
+
+            (positions_by_tag, sorted_tags) = indexes[ref]
+
+            query = TagQuery.parse(TagQuery.normalise(query_text))
+
+            positions = set()
+
+            for tag in query.include + query.isolate:
+                if is_tag_pattern(tag):
+                    for expanded in TagPattern.parse(tag).expand(sorted_tags):
+                        positions.update(positions_by_tag[expanded])
+                else:
+                    positions.update(positions_by_tag.get(tag, ()))
+
+            documents = [self.tagged_documents[position] for position in sorted(positions)]
+
+        found = False
+        long_lines = []
+
+        # the number of lines that earlier documents add to the snippet
+        offset = 0
+
+        for doc in documents:
+            version = doc[ref]
+
+            if version is None:
+                continue
+
+            indices = version.matching_indices(query_text)
+
+            if not indices:
+                continue
+
+            found = True
+
+            if width_limit is not None:
+                margin = len(version.margin(indices))
+
+                for (index, width) in version.indices_over_limit(width_limit, query_text):
+                    position = bisect.bisect_left(indices, index)
+                    long_lines.append((offset + position + 1, doc.path, width, version.lines[index].text[margin:]))
+
+            offset += len(indices)
+
+        return (found, long_lines)
+
+    def tag_index(self, ref):
+        """Returns a tuple of (positions by tag, sorted tags) for the tagged
+        documents at 'ref': a dictionary mapping each tag to the positions
+        in self.tagged_documents of the documents with lines in that tag,
+        and a sorted list of every tag, for expanding wildcards."""
+
+        positions_by_tag = {}
+
+        for (position, doc) in enumerate(self.tagged_documents):
+            version = doc[ref]
+
+            if version is None:
+                continue
+
+            for tag in version.tag_bits:
+                positions_by_tag.setdefault(tag, []).append(position)
+
+        return (positions_by_tag, sorted(positions_by_tag))
+
+    def multiply_defined_tags(self):
+        """Returns a dictionary mapping each tag that's defined in more than
+        one tagged document, in the working copy, to the sorted list of
+        the paths of those documents."""
 
-        from itertools import combinations
         from collections import defaultdict
 
-        duplicate_tags = defaultdict(set)
+        files_by_tag = defaultdict(list)
 
-        docs_at_head = filter(lambda d: d[WORKSPACE_REF], self.tagged_documents)
+        for doc in self.tagged_documents:
+            version = doc[WORKSPACE_REF]
 
-        tag_groups = {doc.path: doc[WORKSPACE_REF].tags for doc in self.tagged_documents}
+            if version is None:
+                continue
 
-        for group_pair_keys in combinations(tag_groups, 2):
+            for tag in version.tags:
+                files_by_tag[tag].append(doc.path)
+
+        return {tag: sorted(paths) for (tag, paths) in files_by_tag.items() if len(paths) > 1}
+
+    def find_multiply_defined_tags(self):
 
-            tags_in_both = tag_groups[group_pair_keys[0]] & tag_groups[group_pair_keys[1]]
+        tags_used = {doc.path: doc.tags_used for doc in self.source_documents}
 
-            for tag in tags_in_both:
-                duplicate_tags[tag].add(group_pair_keys[0])
-                duplicate_tags[tag].add(group_pair_keys[1])
+        report_multiply_defined_tags(self.multiply_defined_tags(), tags_used)
+
+
+def report_multiply_defined_tags(duplicate_tags, tags_used):
+    """Warns about each tag in 'duplicate_tags' (which maps tags to the
+    files that define them), and the chapters that use it, given
+    'tags_used', which maps chapter paths to the tags they use."""
+
+    logging.debug("\nChecking for multiple tag definitions.")
         
-        logging.debug("\nChecking for multiple tag definitions.")
-            
-        for tag in duplicate_tags:
-            
-            doc_list = []
+    for tag in sorted(duplicate_tags):
+        
+        doc_list = []
 
-            for doc in duplicate_tags[tag]:
-                doc_list.append(" - {0}\n".format(doc))            
-            
-            logging.warn("Tag '{0}' is defined in multiple files:\n{1}".format(tag, "".join(doc_list)))
+        for doc in duplicate_tags[tag]:
+            doc_list.append(" - {0}\n".format(doc))            
+        
+        logging.warn("Tag '{0}' is defined in multiple files:\n{1}".format(tag, "".join(doc_list)))
+
+        ref_list = []
+
+        for path in sorted(tags_used):
+            if tags_matching(tags_used[path], [tag]):
+                ref_list.append("\t - {0}\n".format(path))
+
+        logging.warn("\t'{0}' is used in documents:\n{1}".format(tag, "".join(ref_list)))
+
+class OutputProfile(object):
+    """One edition of a book: a directory of source text, and the options
+    used to render it. Several editions can be built from the same code by
+    one Processor."""
+
+    def __init__(self, source_path, language=None, show_query=False, as_inline_list_items=False, suffix="", source_extensions=["txt"], state_path=None, name=None, source_documents=None):
+        assert isinstance(source_path, str)
+
+        self.source_path = source_path
+        self.language = language
+        self.show_query = show_query
+        self.as_inline_list_items = as_inline_list_items
+        self.suffix = suffix
+        self.source_extensions = source_extensions
+        self.state_path = state_path
+        self.name = name or source_path
+
+        # found the first time they're needed
+        self._source_documents = source_documents
+
+    @property
+    def source_documents(self):
+        if self._source_documents is None:
+            self._source_documents = SourceDocument.find(self.source_path, self.source_extensions)
+        return self._source_documents
+
+    @source_documents.setter
+    def source_documents(self, documents):
+        self._source_documents = documents
+
+    @property
+    def render_options(self):
+        """Returns the options that affect rendered output; a change to any
+        of these means every chapter must be rendered again."""
+        return OrderedDict([
+            ("language", self.language),
+            ("show_query", self.show_query),
+            ("as_inline_list_items", self.as_inline_list_items),
+            ("suffix", self.suffix),
+            ])
+
+def load_profiles(path, defaults):
+    """Reads a list of OutputProfiles from the JSON file at 'path'. Each
+    entry is an object whose keys are OutputProfile's arguments (eg
+    "source_path", "language", "suffix"); anything left out is taken
+    from the OutputProfile 'defaults'."""
+
+    with open(path) as profiles_file:
+        entries = json.load(profiles_file)
+
+    if not isinstance(entries, list):
+        raise ValueError("{} should contain a list of profiles".format(path))
+
+    profiles = []
+
+    for entry in entries:
+        options = OrderedDict([
+            ("source_path", defaults.source_path),
+            ("language", defaults.language),
+            ("show_query", defaults.show_query),
+            ("as_inline_list_items", defaults.as_inline_list_items),
+            ("suffix", defaults.suffix),
+            ("source_extensions", defaults.source_extensions),
+            ("state_path", None),
+            ("name", None),
+            ])
 
-            referenced_doc = [source_document for source_document in self.source_documents if tag in source_document.tags_used]
+        for (key, value) in entry.items():
+            if key not in options:
+                raise ValueError("Unknown option '{}' in profile in {}".format(key, path))
 
-            ref_list = []
+            # JSON strings are unicode on Python 2
+            if isinstance(value, type(u"")):
+                value = str(value)
+            elif isinstance(value, list):
+                value = [str(item) for item in value]
 
-            for ref in referenced_doc:
-                ref_list.append("\t - {0}\n".format(ref.path))
+            options[str(key)] = value
 
-            logging.warn("\t'{0}' is used in documents:\n{1}".format(tag, "".join(ref_list)))
+        profiles.append(OutputProfile(**options))
 
+    return profiles
+
+def query_tags(query_text):
+    """Returns the set of tags that can cause the query 'query_text' to
+    include a line."""
+    query = TagQuery(query_text)
+    return set(tag for tag in query.include + query.isolate if tag)
+
+def load_state(path):
+    """Returns the state saved by a previous run at 'path', or None."""
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as state_file:
+        return json.load(state_file, object_pairs_hook=OrderedDict)
+
+def write_width_report(path, entries):
+    """Writes the width report 'entries' to 'path', as JSON if it ends in
+    ".json", and as one line of text per entry otherwise."""
+
+    with open(path, "w") as report_file:
+        if path.endswith(".json"):
+            json.dump(entries, report_file, indent=2)
+        else:
+            for entry in entries:
+                report_file.write(format_width_entry(entry) + "\n")
+
+    logging.info("Writing %s", path)
+
+def format_width_entry(entry):
+    """Returns a one-line description of an entry in a width report."""
+
+    if entry["ref"] == WORKSPACE_REF:
+        source = entry["file"]
+    else:
+        source = "{} at {}".format(entry["file"], entry["ref"])
+
+    return "{}:{} snippet {} line {} ({}) is {} > {} columns".format(entry["chapter"], entry["line"], entry["snippet"], entry["offset"], source, entry["width"], entry["limit"])
+
+def content_hash(text):
+    if not isinstance(text, bytes):
+        text = text.encode("utf-8")
+    return hashlib.sha1(text).hexdigest()
+
+def write_snippet_archive(path, archive_name, manifest, contents_by_hash):
+    """Writes the snippets in 'contents_by_hash', plus 'manifest', to
+    'path' in the format implied by 'archive_name'."""
+
+    manifest_json = json.dumps(manifest, indent=2)
+
+    if archive_name.endswith(".jsonl"):
+        with open(path, "w") as archive:
+            for snippet_hash in contents_by_hash:
+                record = OrderedDict([("type", "snippet"), ("hash", snippet_hash), ("content", contents_by_hash[snippet_hash])])
+                archive.write(json.dumps(record) + "\n")
+
+            for entry in manifest:
+                record = OrderedDict([("type", "use")] + list(entry.items()))
+                archive.write(json.dumps(record) + "\n")
+
+    elif archive_name.endswith(".zip"):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("manifest.json", manifest_json)
+            for snippet_hash in contents_by_hash:
+                archive.writestr("snippets/{}.txt".format(snippet_hash), contents_by_hash[snippet_hash])
+
+    elif archive_name.endswith((".tar", ".tar.gz", ".tgz")):
+        mode = "w" if archive_name.endswith(".tar") else "w:gz"
+
+        archive = tarfile.open(path, mode)
+        try:
+            add_to_tar(archive, "manifest.json", manifest_json)
+            for snippet_hash in contents_by_hash:
+                add_to_tar(archive, "snippets/{}.txt".format(snippet_hash), contents_by_hash[snippet_hash])
+        finally:
+            archive.close()
+
+    else:
+        raise ValueError("Don't know what kind of archive to write for {}; use .zip, .tar, .tar.gz or .jsonl".format(archive_name))
+
+def add_to_tar(archive, name, contents):
+    if not isinstance(contents, bytes):
+        contents = contents.encode("utf-8")
+
+    info = tarfile.TarInfo(name)
+    info.size = len(contents)
+    archive.addfile(info, BytesIO(contents))
 
 @Gooey(
     program_name="Snippet Processor",
@@ -157,33 +1335,72 @@ def main():
     options = GooeyParser()
 
     options.add_argument("source_dir", help="Path to the directory containing your book's source text.", widget="DirChooser")
-    options.add_argument("code_dir", help="Path to the git repo containing source code.", widget="DirChooser")
+    options.add_argument("code_dir", nargs="?", default=None, help="Path to the git repo containing source code. Not needed with --clean or --index.", widget="DirChooser")
 
     
     options.add_argument("-l", "--lang", dest="language", help="Indicate that the source code is in this language when syntax highlighting", default="swift")
     options.add_argument("-n", "--dry-run", action="store_true", help="Don't actually modify any files")
     options.add_argument("--clean", action="store_true", help="Remove snippets from files, instead of adding their contents to files")
-    options.add_argument("--length", default=75, help="The maximum length permitted for snippet lines. Lines longer than this will be warned about.")
+    options.add_argument("--length", type=int, default=75, help="The maximum length permitted for snippet lines. Lines longer than this will be warned about.")
 
     advanced_options = options.add_argument_group("Advanced Options")
 
     
     advanced_options.add_argument("--suffix", default="", help="Append this to the file name of written files (default=none)")
     advanced_options.add_argument("-x", "--extract-snippets", dest="extract_dir", default=None, help="Render each snippet to a file, and store it in this directory.", widget="DirChooser")
+    advanced_options.add_argument("--extract-archive", dest="extract_archive", default=None, help="Render each distinct snippet once, and store them all with a manifest in this .zip, .tar, .tar.gz or .jsonl file.")
+    advanced_options.add_argument("--profiles", default=None, help="Build several editions in one run, from a JSON file containing a list of profiles. Each profile can set source_path, language, show_query, as_inline_list_items, suffix, source_extensions, state_path and name; anything left out comes from the other options.")
+    advanced_options.add_argument("--shard", default=None, help="Only render part of the book, given as i/N (eg 2/4) to render the 2nd of 4 parts. Combine each part's --manifest with 'sharding.py merge'.")
+    advanced_options.add_argument("--shard-stats", dest="shard_stats", default=None, help="Balance the parts made by --shard using the chapter timings in this manifest from a previous run, instead of by path.")
+    advanced_options.add_argument("--check", action="store_true", help="Don't write anything; just check that every snippet and snip-file can be found, that no tag is defined in more than one file, and that no snippet line is longer than --length. Exits with status 1 if there are any problems.")
+    advanced_options.add_argument("--check-report", dest="check_report", default=None, help="With --check, write the problems found to this JSON file, instead of to standard output.")
+    advanced_options.add_argument("--manifest", default=None, help="Write a JSON manifest of the chapters rendered, the files written, and the tag and width problems found to this path.")
+    advanced_options.add_argument("--width-report", dest="width_report", default=None, help="Write every snippet line longer than --length to this file, as JSON if it ends in .json and as text otherwise.")
+    advanced_options.add_argument("--graph", default=None, help="Write a JSON graph of which tags, files and line ranges each chapter's snippets depend on to this path.")
+    advanced_options.add_argument("--state", default=None, help="Save which tags and files each chapter used to this file, for use by --since.")
+    advanced_options.add_argument("--since", default=None, help="Only render chapters affected by changes to the code since this commit. Requires --state from a previous run.")
     advanced_options.add_argument("-v", "--verbose", action="store_true", help="Verbose logging.")
     advanced_options.add_argument("-q", "--show_query", action="store_true", help="Include the query in rendered snippets.")
     advanced_options.add_argument("--as_inline_list_items", action="store_true", help="Add a + after the snippet tag, to make the snippets format properly when being used as inline blocks in list items")
+    advanced_options.add_argument("-j", "--jobs", type=int, default=4, help="The number of worker threads used to read files, load them from git history and write output.")
+    advanced_options.add_argument("--parse-processes", dest="parse_processes", type=int, default=0, help="Parse the code in this many worker processes, rather than in this one. Starting them takes a while, so this only helps with big repos on machines with plenty of cores; see benchmark.py parse (default=0).")
+    advanced_options.add_argument("--sparse-history", dest="sparse_history", action="store_true", help="At each // tag: ref, only load the files from git that are expected to define the tags used there, falling back to every file when none of them do.")
+    advanced_options.add_argument("--max-cached-versions", dest="max_cached_versions", type=int, default=None, help="Keep at most this many versions of files from git history in memory, forgetting the least recently used ones (default=no limit).")
+    advanced_options.add_argument("--git-objects", dest="git_objects", choices=BACKENDS, default=GITPYTHON, help="How to read files from git history: 'gitpython' asks git for each one, and 'native' reads the repo's object files directly, which avoids talking to git (default=gitpython).")
+    advanced_options.add_argument("--build-index", dest="build_index", default=None, help="Don't render anything; instead, write every version of the code that the book uses, already parsed, to a snippet index at this path, for use by --index.")
+    advanced_options.add_argument("--index", default=None, help="Read the code from the snippet index at this path, made by --build-index, instead of from the code repo, which then isn't needed.")
+    advanced_options.add_argument("--fsync", action="store_true", help="Flush every written file to disk before finishing. Slower, but safe against power loss.")
+    advanced_options.add_argument("--profile", default=None, help="Profile each phase of processing, and write .prof and flamegraph-ready .collapsed files using this path as a prefix.")
+    advanced_options.add_argument("--memory-report", dest="memory_report", default=None, help="Write a JSON report of how much memory each phase used, and of the memory held by each version of each code file, each ref and each chapter, to this path. Per-phase figures need Python 3.4 or later; earlier versions only report the process's peak.")
+    advanced_options.add_argument("--memory-top", dest="memory_top", type=int, default=10, help="The number of largest versions, chapters and allocations to list in the --memory-report (default=10).")
     #options.add_argument("-i", "--expand-images", action="store_true", help="Expand img: shortcuts (CURRENTLY BROKEN!)")
 
     
     
     opts = options.parse_args()
+
+    if opts.code_dir is None and not opts.clean and not opts.index:
+        options.error("code_dir is required, unless --clean or --index is given")
+
+    if opts.build_index and (opts.clean or opts.index):
+        options.error("--build-index needs the code repo, so it can't be used with --clean or --index")
+
+    if opts.index and opts.since:
+        options.error("--since needs the code repo, so it can't be used with --index")
+
+    if opts.check and opts.clean:
+        options.error("--check and --clean can't be used together")
     
     logging.getLogger().setLevel(logging.INFO)
 
     if opts.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    profiler = PhaseProfiler(opts.profile) if opts.profile else NullProfiler()
+
+    if opts.memory_report:
+        profiler = MemoryProfiler(opts.memory_report, top=opts.memory_top, profiler=profiler)
+
     processor = Processor(
         opts.source_dir, 
         opts.code_dir,
@@ -192,7 +1409,19 @@ def main():
         language=opts.language, 
         clean=opts.clean, 
         show_query=opts.show_query,
-        as_inline_list_items=opts.as_inline_list_items)
+        as_inline_list_items=opts.as_inline_list_items,
+        profiler=profiler,
+        jobs=opts.jobs,
+        fsync=opts.fsync,
+        lazy=bool(opts.since),
+        sparse_history=opts.sparse_history,
+        max_cached_versions=opts.max_cached_versions,
+        git_objects=opts.git_objects,
+        index_path=opts.index,
+        parse_processes=opts.parse_processes)
+
+    if opts.memory_report:
+        profiler.watch(processor)
 
     logging.debug("Found %i source files:", len(processor.source_documents))
     for doc in processor.source_documents:
@@ -202,15 +1431,81 @@ def main():
     for doc in processor.tagged_documents:
         logging.debug(" - %s", doc.path)
 
-    processor.find_multiply_defined_tags()
+    # these look at every tagged document, which an incremental build is
+    # trying to avoid; a sharded build leaves them to the merge step
+    if not opts.since and not opts.shard and not opts.clean and not opts.check and not opts.build_index:
+        with profiler.phase("check"):
+            processor.find_multiply_defined_tags()
 
-    processor.find_overlong_lines(opts.length)
-    
-    processor.process(dry_run=opts.dry_run, suffix=opts.suffix)
+    # line widths are checked as each snippet is rendered, so only the
+    # chapters that are actually rendered are checked
+    width_limit = None if opts.clean else opts.length
+
+    if opts.profiles:
+        profiles = load_profiles(opts.profiles, processor.profile(opts.suffix))
+    else:
+        profiles = [processor.profile(opts.suffix, opts.state)]
+
+    if opts.shard:
+        (shard_index, shard_count) = sharding.parse_shard(opts.shard)
+        stats = sharding.load_stats(opts.shard_stats) if opts.shard_stats else None
+
+        for profile in profiles:
+            # with several editions, timings are recorded by edition too;
+            # see process_profiles()
+            profile_name = profile.name if len(profiles) > 1 else None
+
+            profile.source_documents = sharding.select_shard(profile.source_documents, profile.source_path, shard_index, shard_count, stats, profile_name)
+
+    if opts.build_index:
+        processor.build_index(opts.build_index, profiles)
+        profiler.write()
+        return
+
+    if opts.check:
+        with profiler.phase("check"):
+            report = processor.check(profiles, width_limit=opts.length)
+
+        if opts.check_report:
+            with open(opts.check_report, "w") as report_file:
+                json.dump(report, report_file, indent=2)
+            logging.info("Writing %s", opts.check_report)
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+
+        profiler.write()
+
+        sys.exit(0 if report["ok"] else 1)
+
+    write_errors = processor.process_profiles(profiles, dry_run=opts.dry_run, since=opts.since, width_limit=width_limit)
+
+    if opts.manifest:
+        shard = sharding.parse_shard(opts.shard) if opts.shard else (1, 1)
+        sharding.write_manifest(opts.manifest, sharding.build_manifest(processor, shard))
+
+    if opts.width_report:
+        processor.write_width_report(opts.width_report)
 
     if opts.extract_dir:
-        processor.extract_snippets(opts.extract_dir)
+        write_errors += processor.extract_snippets(opts.extract_dir)
+
+    if opts.extract_archive:
+        processor.extract_snippet_archive(opts.extract_archive)
+
+    if opts.graph:
+        with open(opts.graph, "w") as graph_file:
+            json.dump(processor.build_graph(), graph_file, indent=2)
+        logging.info("Writing %s", opts.graph)
+
+    profiler.write()
+
+    if write_errors:
+        sys.exit(1)
 
     
 if __name__ == '__main__':
+    # the parsing processes of a frozen build (eg with PyInstaller) start
+    # by running this script, and must stop here instead of running main()
+    multiprocessing.freeze_support()
     main()
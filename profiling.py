@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import cProfile
+import pstats
+import sys
+import os
+import threading
+import time
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+
+class PhaseProfiler(object):
+    """Profiles the processor one phase at a time (eg discovery, parse,
+    render), and writes cProfile and flamegraph-ready output for each."""
+
+    def __init__(self, path, sample_interval=0.001):
+        assert isinstance(path, str)
+
+        # "book.prof" and "book" both produce "book.prof",
+        # "book-render.prof", "book.collapsed" and so on
+        self.base_path = os.path.splitext(path)[0] if path.endswith(".prof") else path
+
+        self.sample_interval = sample_interval
+
+        # maps phase names to the list of cProfile.Profile objects that
+        # were recorded for it, in the order the phases were entered
+        self.profiles = defaultdict(list)
+        self.phase_order = []
+
+        # maps collapsed stacks ("phase;frame;frame") to sample counts
+        self.collapsed_stacks = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        """Profiles everything done on this thread inside the 'with' block,
+        attributing it to the phase 'name'."""
+
+        if name not in self.phase_order:
+            self.phase_order.append(name)
+
+        profile = cProfile.Profile()
+        sampler = StackSampler(threading.current_thread(), name, self.sample_interval)
+
+        sampler.start()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            sampler.stop()
+
+            self.profiles[name].append(profile)
+
+            for (stack, count) in sampler.stacks.items():
+                self.collapsed_stacks[stack] += count
+
+    def write(self):
+        """Writes a .prof file for each phase, a combined .prof file for
+        the whole run, and a .collapsed file of sampled stacks. Returns the
+        list of paths written."""
+
+        written = []
+
+        output_dir = os.path.dirname(self.base_path)
+        if output_dir and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        combined = None
+
+        for name in self.phase_order:
+            stats = self._stats(self.profiles[name])
+
+            phase_path = "{}-{}.prof".format(self.base_path, name)
+            stats.dump_stats(phase_path)
+            written.append(phase_path)
+
+            if combined is None:
+                combined = self._stats(self.profiles[name])
+            else:
+                combined.add(stats)
+
+        if combined is not None:
+            combined_path = self.base_path + ".prof"
+            combined.dump_stats(combined_path)
+            written.append(combined_path)
+
+        # the collapsed format is "frame;frame;frame count", one stack per
+        # line, which is what flamegraph.pl, speedscope and inferno expect
+        collapsed_path = self.base_path + ".collapsed"
+        with open(collapsed_path, "w") as collapsed_file:
+            for stack in sorted(self.collapsed_stacks):
+                collapsed_file.write("{} {}\n".format(stack, self.collapsed_stacks[stack]))
+        written.append(collapsed_path)
+
+        for path in written:
+            logging.info("Wrote profile %s", path)
+
+        return written
+
+    @staticmethod
+    def _stats(profiles):
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+class NullProfiler(object):
+    """A profiler that does nothing; used when profiling is turned off."""
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def write(self):
+        return []
+
+class StackSampler(threading.Thread):
+    """Periodically samples the stack of another thread, counting each
+    distinct stack it sees in collapsed ("a;b;c") form."""
+
+    def __init__(self, target_thread, root_name, interval):
+        threading.Thread.__init__(self, name="StackSampler")
+        self.daemon = True
+
+        self.target_ident = target_thread.ident
+        self.root_name = root_name
+        self.interval = interval
+
+        self.stacks = defaultdict(int)
+
+        self._finished = threading.Event()
+
+    def run(self):
+        while not self._finished.is_set():
+            frame = sys._current_frames().get(self.target_ident)
+
+            if frame is not None:
+                self.stacks[self._collapse(frame)] += 1
+
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._finished.set()
+        self.join()
+
+    def _collapse(self, frame):
+        frames = []
+
+        while frame is not None:
+            code = frame.f_code
+
+            # skip the profiler's own context manager frames
+            if code.co_filename != __file__.replace(".pyc", ".py"):
+                frames.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+
+            frame = frame.f_back
+
+        frames.append(self.root_name)
+
+        # semicolons separate frames in the collapsed format, so they must
+        # not appear inside a frame's name
+        return ";".join(name.replace(";", ":") for name in reversed(frames))
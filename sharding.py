@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+from collections import OrderedDict
+
+import six
+
+def parse_shard(text):
+    """Parses a shard given as "i/N", where i counts from 1 to N, and
+    returns the tuple (i, N)."""
+
+    try:
+        (index, count) = [int(part) for part in text.split("/")]
+    except ValueError:
+        raise ValueError("Shards are given as i/N (eg 2/4), not '{}'".format(text))
+
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError("Shard {} is out of range; i must be between 1 and N".format(text))
+
+    return (index, count)
+
+def shard_key(document, base_path):
+    """Returns the name used to place 'document' in a shard: its path
+    relative to the book's directory, so that every machine agrees on it
+    no matter where the book is checked out."""
+    return os.path.relpath(document.path, base_path).replace(os.sep, "/")
+
+def stats_key(key, profile_name=None):
+    """Returns the name that a chapter's timings are recorded under, given
+    its shard key. When several editions are built at once, they often
+    have chapters at the same paths, so the key is preceded by the name of
+    the edition ('profile_name')."""
+    return key if profile_name is None else "{}:{}".format(profile_name, key)
+
+def plan_shards(documents, base_path, count, stats=None, profile_name=None):
+    """Splits 'documents' into 'count' lists. Without 'stats', each
+    document goes in the shard picked by the hash of its path. With
+    'stats' (a dictionary mapping stats keys to the seconds they took last
+    time), the documents are spread so that each shard should take about
+    as long as the others; documents that weren't in the previous run are
+    estimated from their size. Either way, the same inputs always give the
+    same plan. 'profile_name' is the edition the documents belong to, if
+    several are being built; see stats_key()."""
+
+    shards = [[] for index in range(count)]
+
+    if stats is None:
+        for document in documents:
+            key = shard_key(document, base_path)
+
+            # paths are already bytes on Python 2
+            if isinstance(key, six.text_type):
+                key = key.encode("utf-8")
+
+            shards[int(hashlib.sha1(key).hexdigest(), 16) % count].append(document)
+
+        return shards
+
+    sizes = {document.path: len(document.contents) for document in documents}
+
+    keys = {document.path: stats_key(shard_key(document, base_path), profile_name) for document in documents}
+
+    # work out how long a byte of source took to render last time, for
+    # estimating documents we have no timings for
+    known = [document for document in documents if keys[document.path] in stats]
+
+    known_seconds = sum(stats[keys[document.path]] for document in known)
+    known_bytes = sum(sizes[document.path] for document in known)
+
+    seconds_per_byte = known_seconds / known_bytes if known_seconds and known_bytes else 1.0
+
+    def cost(document):
+        return stats.get(keys[document.path], sizes[document.path] * seconds_per_byte)
+
+    # place the most expensive documents first, each in whichever shard
+    # has the least work so far
+    totals = [0.0] * count
+
+    for document in sorted(documents, key=lambda document: (-cost(document), shard_key(document, base_path))):
+        index = totals.index(min(totals))
+        shards[index].append(document)
+        totals[index] += cost(document)
+
+    # keep each shard in the original order
+    order = {document.path: position for (position, document) in enumerate(documents)}
+
+    return [sorted(shard, key=lambda document: order[document.path]) for shard in shards]
+
+def select_shard(documents, base_path, index, count, stats=None, profile_name=None):
+    """Returns the documents in shard 'index' (counting from 1) of
+    'count'."""
+
+    selected = plan_shards(documents, base_path, count, stats, profile_name)[index - 1]
+
+    logging.info("Shard %i/%i has %i of %i chapters", index, count, len(selected), len(documents))
+
+    return selected
+
+def load_stats(path):
+    """Returns a dictionary mapping stats keys (see stats_key()) to the
+    seconds each chapter took to render, from a manifest (or merged
+    manifest) at 'path'."""
+
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    stats = {}
+
+    for chapter in manifest["chapters"]:
+        key = chapter["key"]
+
+        # JSON strings are unicode on Python 2, but shard keys aren't
+        if not isinstance(key, str):
+            key = key.encode("utf-8")
+
+        stats[key] = chapter["seconds"]
+
+    return stats
+
+def build_manifest(processor, shard):
+    """Returns a JSON-ready manifest of what 'processor' did in its last
+    run, as shard 'shard' (an (i, N) tuple): the chapters it rendered, how
+    long each took, where they were written and which tags they used, plus
+    the tags defined in more than one file and the overlong lines that
+    were found."""
+
+    chapters = []
+
+    for (path, stats) in processor.chapter_stats.items():
+        chapters.append(OrderedDict([("chapter", path)] + list(stats.items())))
+
+    duplicate_tags = processor.multiply_defined_tags()
+
+    return OrderedDict([
+        ("shard", list(shard)),
+        ("chapters", chapters),
+        ("duplicate_tags", OrderedDict((tag, duplicate_tags[tag]) for tag in sorted(duplicate_tags))),
+        ("width_report", processor.width_report),
+        ])
+
+def write_manifest(path, manifest):
+    with open(path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    logging.info("Writing %s", path)
+
+def merge_manifests(manifests):
+    """Combines the manifests written by each shard of a build into one.
+    Raises ValueError if they aren't all from the same build, or if a
+    shard is missing or appears twice."""
+
+    if not manifests:
+        raise ValueError("No manifests to merge")
+
+    counts = set(manifest["shard"][1] for manifest in manifests)
+
+    if len(counts) != 1:
+        raise ValueError("The manifests are from builds with different numbers of shards: {}".format(", ".join(str(count) for count in sorted(counts))))
+
+    count = counts.pop()
+
+    indices = sorted(manifest["shard"][0] for manifest in manifests)
+
+    if indices != list(range(1, count + 1)):
+        missing = sorted(set(range(1, count + 1)) - set(indices))
+        repeated = sorted(set(index for index in indices if indices.count(index) > 1))
+        raise ValueError("Expected one manifest for each of {} shards (missing: {}; repeated: {})".format(count, missing or "none", repeated or "none"))
+
+    chapters = []
+    duplicate_tags = {}
+    width_report = []
+
+    for manifest in manifests:
+        chapters += manifest["chapters"]
+        width_report += manifest["width_report"]
+
+        # every shard sees the whole code repo, so these should agree; a
+        # union covers shards that were run against different checkouts
+        for (tag, paths) in manifest["duplicate_tags"].items():
+            duplicate_tags[tag] = sorted(set(duplicate_tags.get(tag, [])) | set(paths))
+
+    chapters.sort(key=lambda chapter: chapter["chapter"])
+    width_report.sort(key=lambda entry: (entry["chapter"], entry["line"], entry["offset"]))
+
+    return OrderedDict([
+        ("shards", count),
+        ("chapters", chapters),
+        ("duplicate_tags", OrderedDict((tag, duplicate_tags[tag]) for tag in sorted(duplicate_tags))),
+        ("width_report", width_report),
+        ])
+
+def report(manifest):
+    """Logs the duplicate tags and overlong lines in a merged manifest,
+    the same way an unsharded build would."""
+
+    from processor import report_multiply_defined_tags, format_width_entry
+
+    tags_used = {chapter["chapter"]: set(chapter["tags_used"]) for chapter in manifest["chapters"]}
+
+    report_multiply_defined_tags(manifest["duplicate_tags"], tags_used)
+
+    for entry in manifest["width_report"]:
+        logging.info("Line too long: %s", format_width_entry(entry))
+
+def merge(manifest_paths, output_path=None, width_report_path=None):
+    """Merges the manifests at 'manifest_paths', reports on the result,
+    and optionally writes it (and its width report) out. Returns the
+    merged manifest."""
+
+    from processor import write_width_report
+
+    manifests = []
+
+    for path in manifest_paths:
+        with open(path) as manifest_file:
+            manifests.append(json.load(manifest_file, object_pairs_hook=OrderedDict))
+
+    manifest = merge_manifests(manifests)
+
+    written = [chapter for chapter in manifest["chapters"] if chapter["output"]]
+    logging.info("%i shards rendered %i chapters, and wrote %i", manifest["shards"], len(manifest["chapters"]), len(written))
+
+    report(manifest)
+
+    if output_path:
+        write_manifest(output_path, manifest)
+
+    if width_report_path:
+        write_width_report(width_report_path, manifest["width_report"])
+
+    return manifest
+
+def main():
+    options = argparse.ArgumentParser(description="Combines the results of a book built in several parts with processor.py --shard.")
+
+    commands = options.add_subparsers(dest="command")
+
+    merge_options = commands.add_parser("merge", help="Merge the manifests written by each shard, and report on the whole book.")
+    merge_options.add_argument("manifests", nargs="+", help="The manifest written by each shard.")
+    merge_options.add_argument("-o", "--output", default=None, help="Write the merged manifest to this path; it can be given to --shard-stats to balance the next build.")
+    merge_options.add_argument("--width-report", dest="width_report", default=None, help="Write every overlong line to this file, as JSON if it ends in .json and as text otherwise.")
+    merge_options.add_argument("-v", "--verbose", action="store_true", help="Verbose logging.")
+
+    opts = options.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG if opts.verbose else logging.INFO)
+
+    try:
+        merge(opts.manifests, opts.output, opts.width_report)
+    except ValueError as error:
+        logging.error("%s", error)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
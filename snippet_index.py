@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+
+import sys
+import mmap
+import struct
+import logging
+from array import array
+
+from tagged_version import TaggedDocumentVersion
+from output_writer import replace_file
+
+# A snippet index holds every version of every tagged document that a book
+# uses, already parsed, in a single file that's read through mmap; opening
+# it only reads the names of its refs, documents and tags, and each version
+# is only decoded the first time it's asked for. Since the file is mapped
+# rather than read, processes that open the same index share its pages.
+#
+# Nothing here needs git, so tools that only render or look up snippets can
+# use an index without importing GitPython.
+#
+# Everything is little-endian. The file starts with a header (see
+# HEADER_FORMAT), which gives the number of refs, documents, tags, versions
+# and files, and the offset of each section:
+#
+# - strings: a u32 count, count + 1 u32 offsets, and then the UTF-8 bytes
+#   of every name in the index (refs, commits, paths and tags), one after
+#   another
+# - refs: a (name, commit) pair of u32 string IDs for each ref; refs that
+#   aren't commits (eg the working copy) have NO_ID as their commit
+# - documents: the u32 string ID of each document's path
+# - ref map: a u32 version ID for each document at each ref, in document
+#   order, with the refs of each document next to each other; NO_ID means
+#   the document doesn't exist at that ref
+# - tags: the u32 string ID of every tag, in sorted order
+# - versions: a VERSION_FORMAT record for each distinct version (see
+#   VersionRecord)
+# - files: a FILE_FORMAT record for each file that a '// snip-file:'
+#   command includes: the string IDs of its name and its path in the repo,
+#   and where its contents are in the data section
+# - ints: the i32 tables that version records point into
+# - data: the text of every version, then of every file
+
+MAGIC = b"SNIPIDX1"
+FORMAT_VERSION = 2
+
+HEADER_FORMAT = struct.Struct("<8sIIIIIIIIQQQQQQQQQ")
+VERSION_FORMAT = struct.Struct("<IQQIIIIII")
+FILE_FORMAT = struct.Struct("<IIQQ")
+
+NO_ID = 0xFFFFFFFF
+
+class VersionRecord(object):
+    """Where a version's parsed form is kept in an index: which document
+    it's a version of, where its text is in the data section, and where its
+    tables are in the ints section. The ints section holds, in order:
+
+    - line_count tagged line numbers, then their stack IDs, widths and
+      indent lengths (see parse_tagged_data), starting at lines_offset
+    - stack_count stacks of tags, each as a count followed by that many tag
+      IDs, starting at stacks_offset
+    - range_count (tag ID, first line, last line) triples, starting at
+      ranges_offset
+    """
+
+    def __init__(self, document, data_offset, data_length, line_count, lines_offset, stack_count, stacks_offset, range_count, ranges_offset):
+        self.document = document
+        self.data_offset = data_offset
+        self.data_length = data_length
+        self.line_count = line_count
+        self.lines_offset = lines_offset
+        self.stack_count = stack_count
+        self.stacks_offset = stacks_offset
+        self.range_count = range_count
+        self.ranges_offset = ranges_offset
+
+    def pack(self):
+        return VERSION_FORMAT.pack(self.document, self.data_offset, self.data_length, self.line_count, self.lines_offset, self.stack_count, self.stacks_offset, self.range_count, self.ranges_offset)
+
+class SnippetIndex(object):
+    """A snippet index file, opened for reading. It can stand in for a
+    RefResolver (see commit()), and its documents for TaggedDocuments."""
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as index_file:
+            self.map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self.read_header()
+        except:
+            self.map.close()
+            raise
+
+    def read_header(self):
+        if len(self.map) < HEADER_FORMAT.size:
+            raise ValueError("{} is too short to be a snippet index".format(self.path))
+
+        # the magic and format version are checked first, since the rest of
+        # the header of an older index has a different layout
+        (magic, format_version) = struct.unpack_from("<8sI", self.map, 0)
+
+        if magic != MAGIC:
+            raise ValueError("{} is not a snippet index".format(self.path))
+
+        if format_version != FORMAT_VERSION:
+            raise ValueError("{} is a version {} snippet index, but only version {} can be read; rebuild it with --build-index".format(self.path, format_version, FORMAT_VERSION))
+
+        (magic, format_version, ref_count, document_count, tag_count, version_count, file_count, root_id, head_id,
+            strings_offset, refs_offset, documents_offset, ref_map_offset, tags_offset, versions_offset, files_offset, ints_offset, data_offset) = HEADER_FORMAT.unpack_from(self.map, 0)
+
+        self.strings = read_strings(self.map, strings_offset)
+
+        ref_ids = read_ints(self.map, refs_offset, ref_count * 2, "I")
+
+        # maps ref names to their position in the ref map, and to commit IDs
+        self.refs = {}
+        self.commits = {}
+
+        for position in range(ref_count):
+            name = self.strings[ref_ids[position * 2]]
+            commit_id = ref_ids[position * 2 + 1]
+
+            self.refs[name] = position
+            self.commits[name] = None if commit_id == NO_ID else self.strings[commit_id]
+
+        self.tags = [self.strings[tag_id] for tag_id in read_ints(self.map, tags_offset, tag_count, "I")]
+
+        # the directory of the code repo that this index was built from
+        self.root = self.strings[root_id]
+
+        # the commit that HEAD was at when this index was built
+        self.head = None if head_id == NO_ID else self.strings[head_id]
+
+        # maps the names of the files that snip-file commands include to
+        # (path, offset, length) tuples
+        self.files = {}
+
+        for position in range(file_count):
+            (name_id, path_id, offset, length) = FILE_FORMAT.unpack_from(self.map, files_offset + position * FILE_FORMAT.size)
+            self.files[self.strings[name_id]] = (self.strings[path_id], offset, length)
+
+        self.ref_count = ref_count
+        self.version_count = version_count
+        self.ref_map_offset = ref_map_offset
+        self.versions_offset = versions_offset
+        self.ints_offset = ints_offset
+        self.data_offset = data_offset
+
+        # refs that have been asked for but aren't in the index
+        self.missing_refs = set()
+
+        paths = [self.strings[path_id] for path_id in read_ints(self.map, documents_offset, document_count, "I")]
+
+        self.documents = [IndexedDocument(self, position, path) for (position, path) in enumerate(paths)]
+
+    def commit(self, ref):
+        """Returns the ID of the commit that 'ref' named when the index was
+        built, or None if it wasn't a commit, or isn't in the index."""
+
+        if ref not in self.refs and ref not in self.missing_refs:
+            # only complain once, no matter how many documents ask about it
+            logging.error("'%s' is not in the snippet index %s; rebuild it with --build-index", ref, self.path)
+            self.missing_refs.add(ref)
+
+        return self.commits.get(ref)
+
+    def clear(self):
+        """Does nothing; an index never changes once it's built. This lets
+        an index be used where a RefResolver is expected."""
+        pass
+
+    def version_id(self, document, ref):
+        """Returns the ID of the version of the document at position
+        'document' at 'ref', or None if it doesn't exist there."""
+
+        position = self.refs.get(ref)
+
+        if position is None:
+            self.commit(ref)
+            return None
+
+        (version_id,) = struct.unpack_from("<I", self.map, self.ref_map_offset + (document * self.ref_count + position) * 4)
+
+        return None if version_id == NO_ID else version_id
+
+    def read_version(self, version_id, path, ref):
+        """Builds the TaggedDocumentVersion with the ID 'version_id' from the
+        parsed form stored in the index, without parsing it again."""
+
+        assert version_id < self.version_count
+
+        record = VersionRecord(*VERSION_FORMAT.unpack_from(self.map, self.versions_offset + version_id * VERSION_FORMAT.size))
+
+        start = self.data_offset + record.data_offset
+        data = self.map[start:start + record.data_length]
+
+        if not isinstance(data, str):
+            data = data.decode("utf-8")
+
+        def ints(offset, count):
+            return read_ints(self.map, self.ints_offset + offset * 4, count, "i")
+
+        count = record.line_count
+        lines = ints(record.lines_offset, count * 4)
+
+        line_numbers = to_array(lines[0:count])
+        stack_ids = to_array(lines[count:count * 2])
+        widths = to_array(lines[count * 2:count * 3])
+        indent_lengths = to_array(lines[count * 3:count * 4])
+
+        stack_tags = []
+        offset = record.stacks_offset
+
+        for _ in range(record.stack_count):
+            (length,) = ints(offset, 1)
+            stack_tags.append(tuple(self.tags[tag_id] for tag_id in ints(offset + 1, length)))
+            offset += length + 1
+
+        tag_ranges = {}
+        ranges = ints(record.ranges_offset, record.range_count * 3)
+
+        for position in range(0, len(ranges), 3):
+            tag_ranges.setdefault(self.tags[ranges[position]], []).append((ranges[position + 1], ranges[position + 2]))
+
+        # warnings were logged when the index was built
+        parsed = (line_numbers, stack_ids, stack_tags, widths, indent_lengths, tag_ranges, [])
+
+        return TaggedDocumentVersion(path, data, ref, parsed)
+
+    def file(self, name):
+        """Returns a (path, contents) tuple for the file called 'name' that
+        a snip-file command included when the index was built, or None if
+        there wasn't one."""
+
+        if name not in self.files:
+            return None
+
+        (path, offset, length) = self.files[name]
+
+        start = self.data_offset + offset
+        contents = self.map[start:start + length]
+
+        if not isinstance(contents, str):
+            contents = contents.decode("utf-8")
+
+        return (path, contents)
+
+    def close(self):
+        self.map.close()
+
+class IndexedDocument(object):
+    """A tagged document whose versions come from a SnippetIndex; it can be
+    used wherever a TaggedDocument is, but only knows about the refs that
+    were indexed, and never changes."""
+
+    def __init__(self, index, position, path):
+        self.index = index
+        self.position = position
+        self.path = path
+
+        self.versions = {} # maps refs to TaggedDocumentVersion objects
+        self.versions_by_id = {} # maps version IDs to TaggedDocumentVersion objects
+
+        # every tag that any version of this document defines; filled in
+        # when it's first asked for, since it means decoding every version
+        self._known_tags = None
+
+    def __getitem__(self, revision):
+        assert isinstance(revision, str)
+
+        try:
+            return self.versions[revision]
+        except KeyError:
+            pass
+
+        version_id = self.index.version_id(self.position, revision)
+
+        if version_id is None:
+            version = None
+        else:
+            version = self.version(version_id, revision)
+
+        self.versions[revision] = version
+
+        return version
+
+    def version(self, version_id, revision):
+        try:
+            return self.versions_by_id[version_id]
+        except KeyError:
+            version = self.versions_by_id[version_id] = self.index.read_version(version_id, self.path, revision)
+            return version
+
+    @property
+    def known_tags(self):
+        if self._known_tags is None:
+            tags = set()
+
+            for ref in self.index.refs:
+                version_id = self.index.version_id(self.position, ref)
+
+                if version_id is not None:
+                    tags.update(self.version(version_id, ref).tag_ranges)
+
+            self._known_tags = tags
+
+        return self._known_tags
+
+    def forget(self, revision):
+        # nothing in an index ever changes, so there's nothing to forget
+        pass
+
+    def forget_history(self):
+        pass
+
+def write_index(path, tagged_documents, refs, commits, root, head=None, files=None):
+    """Writes a snippet index to 'path', holding the versions of each of
+    'tagged_documents' at each of 'refs'. 'commits' maps refs to the commit
+    IDs they named (or None), 'root' is the directory of the code repo,
+    'head' the commit HEAD was at, and 'files' maps the names of the files
+    that snip-file commands include to (path, contents) tuples. The documents' versions should already
+    be loaded (see TaggedDocument.prewarm), or they'll be loaded one at a
+    time. Returns the number of distinct versions written."""
+
+    strings = StringTable()
+
+    refs = list(refs)
+
+    ref_ids = array("I")
+    for ref in refs:
+        ref_ids.append(strings.add(ref))
+        ref_ids.append(NO_ID if commits.get(ref) is None else strings.add(commits[ref]))
+
+    document_ids = array("I", [strings.add(doc.path) for doc in tagged_documents])
+
+    # every distinct version, in the order they're first seen; versions
+    # are shared between refs (and TaggedDocuments share them between
+    # identical blobs), so each is only stored once
+    versions = []
+    version_ids = {}
+    ref_map = array("I")
+
+    for (position, doc) in enumerate(tagged_documents):
+        for ref in refs:
+            version = doc[ref]
+
+            if version is None:
+                ref_map.append(NO_ID)
+                continue
+
+            if id(version) not in version_ids:
+                version_ids[id(version)] = len(versions)
+                versions.append((position, version))
+
+            ref_map.append(version_ids[id(version)])
+
+    tags = set()
+    for (position, version) in versions:
+        tags.update(version.tag_ranges)
+
+    sorted_tags = sorted(tags)
+    tag_ids = dict((tag, tag_id) for (tag_id, tag) in enumerate(sorted_tags))
+
+    tag_string_ids = array("I", [strings.add(tag) for tag in sorted_tags])
+
+    records = []
+    ints = array("i")
+    data = []
+    data_length = 0
+
+    for (position, version) in versions:
+        text = version.data if isinstance(version.data, bytes) else version.data.encode("utf-8")
+
+        # the stack of tags each line is in, outermost first, in the order
+        # the stacks were made when parsing; every stack has at least one
+        # line in it, so they can all be recovered from the lines
+        stack_tags = {}
+        for (line, stack_id) in zip(version.lines, version.stack_ids):
+            stack_tags.setdefault(stack_id, line.tags)
+
+        record = VersionRecord(position, data_length, len(text), len(version.lines), len(ints), len(stack_tags), 0, 0, 0)
+
+        ints.extend(line.line_number for line in version.lines)
+        ints.extend(list(version.stack_ids))
+        ints.extend(list(version.widths))
+        ints.extend(len(indent) for indent in version.indents)
+
+        record.stacks_offset = len(ints)
+        for stack_id in range(len(stack_tags)):
+            ints.append(len(stack_tags[stack_id]))
+            ints.extend(tag_ids[tag] for tag in stack_tags[stack_id])
+
+        record.ranges_offset = len(ints)
+        for tag in sorted(version.tag_ranges):
+            for (first, last) in version.tag_ranges[tag]:
+                ints.extend((tag_ids[tag], first, last))
+                record.range_count += 1
+
+        records.append(record)
+        data.append(text)
+        data_length += len(text)
+
+    file_records = []
+
+    for name in sorted(files or {}):
+        (file_path, contents) = files[name]
+
+        text = contents if isinstance(contents, bytes) else contents.encode("utf-8")
+
+        file_records.append(FILE_FORMAT.pack(strings.add(name), strings.add(file_path), data_length, len(text)))
+        data.append(text)
+        data_length += len(text)
+
+    root_id = strings.add(root)
+    head_id = NO_ID if head is None else strings.add(head)
+
+    # lay the sections out one after another, after the header
+    sections = [
+        strings.pack(),
+        to_little_endian(ref_ids),
+        to_little_endian(document_ids),
+        to_little_endian(ref_map),
+        to_little_endian(tag_string_ids),
+        b"".join(record.pack() for record in records),
+        b"".join(file_records),
+        to_little_endian(ints),
+        ]
+
+    offsets = []
+    offset = HEADER_FORMAT.size
+
+    for section in sections + [None]:
+        offsets.append(offset)
+        if section is not None:
+            offset += len(section)
+
+    header = HEADER_FORMAT.pack(MAGIC, FORMAT_VERSION, len(refs), len(tagged_documents), len(sorted_tags), len(versions), len(file_records), root_id, head_id, *offsets)
+
+    # write next to the real file and rename it into place, so that
+    # nobody ever maps a half-written index
+    temp_path = path + ".tmp"
+
+    with open(temp_path, "wb") as index_file:
+        index_file.write(header)
+
+        for section in sections:
+            index_file.write(section)
+
+        for text in data:
+            index_file.write(text)
+
+    replace_file(temp_path, path)
+
+    logging.info("Wrote %i versions of %i documents at %i refs to %s", len(versions), len(tagged_documents), len(refs), path)
+
+    return len(versions)
+
+class StringTable(object):
+    """Collects the distinct strings that an index refers to by ID."""
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, string):
+        try:
+            return self.ids[string]
+        except KeyError:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string if isinstance(string, bytes) else string.encode("utf-8"))
+            return string_id
+
+    def pack(self):
+        ends = array("I")
+        end = 0
+
+        for string in self.strings:
+            end += len(string)
+            ends.append(end)
+
+        return struct.pack("<II", len(self.strings), 0) + to_little_endian(ends) + b"".join(self.strings)
+
+def read_strings(buffer, offset):
+    """Reads the strings section at 'offset' in 'buffer'."""
+
+    (count,) = struct.unpack_from("<I", buffer, offset)
+
+    offsets = read_ints(buffer, offset + 4, count + 1, "I")
+    start = offset + 4 + (count + 1) * 4
+
+    strings = []
+    for position in range(count):
+        string = buffer[start + offsets[position]:start + offsets[position + 1]]
+
+        if not isinstance(string, str):
+            string = string.decode("utf-8")
+
+        strings.append(string)
+
+    return strings
+
+def read_ints(buffer, offset, count, type_code):
+    """Reads 'count' little-endian 32-bit integers, signed ("i") or
+    unsigned ("I"), from 'offset' in 'buffer'."""
+    return struct.unpack_from("<{}{}".format(count, type_code), buffer, offset)
+
+def to_array(values):
+    """Turns a tuple of integers into the kind of array that
+    parse_tagged_data makes."""
+    return array("l", values)
+
+def to_little_endian(values):
+    """Returns the bytes of the 32-bit array 'values', in little-endian
+    order."""
+
+    assert values.itemsize == 4
+
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return values.tostring() if not hasattr(values, "tobytes") else values.tobytes()
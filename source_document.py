@@ -4,6 +4,8 @@ import re
 import itertools
 import os
 import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from fuzzywuzzy import process
 
 SNIP_PREFIX="// snip"
@@ -16,6 +18,9 @@ TAG_PREFIX="// tag"
 # seen in commit hashes.
 WORKSPACE_REF = "working-copy"
 
+SNIP = "snip"
+SNIP_FILE = "snip-file"
+
 class SourceDocument(object):
     """A document, containing snippets that refer to tagged code."""
     
@@ -27,15 +32,18 @@ class SourceDocument(object):
 
     @property
     def filename(self):
-        return os.path.splitext(os.path.basename)[0]
+        return os.path.splitext(os.path.basename(self.path))[0]
         
 
     @staticmethod
-    def find(base_path, extensions):
+    def find(base_path, extensions, jobs=1):
+        """Returns a SourceDocument for every file under 'base_path' with
+        one of 'extensions'. The files are read on a pool of 'jobs'
+        threads."""
         assert isinstance(base_path, str)
         assert isinstance(extensions, list)
 
-        documents = []
+        paths = []
 
         starting_dir = base_path
 
@@ -50,105 +58,141 @@ class SourceDocument(object):
                             continue
 
                         
-                        documents.append(SourceDocument(file_path))
-        
-        return documents  
+                        paths.append(file_path)
+
+        if jobs <= 1 or len(paths) <= 1:
+            return [SourceDocument(path) for path in paths]
+
+        pool = ThreadPool(min(jobs, len(paths)))
+
+        try:
+            return pool.map(SourceDocument, paths)
+        finally:
+            pool.close()
+            pool.join()
 
     @property 
     def cleaned_contents(self):
         """Returns a version of 'text' that has no expanded snippets."""
-        snip_with_code = re.compile("(//.*snip(\-file)*:?.*\n)(\+\n)?(\[.*\]\n)*----\n(.*\n)*?----\n", flags=re.IGNORECASE)
-        cleaned = re.sub(snip_with_code, r'\1', self.contents)
-        return cleaned
+        return clean_text(self.contents)
     
     @property
-    def snippets(self):
-        """Returns the list of snippets in this document, as a TagQuery."""
+    def directives(self):
+        """Returns the list of snip and snip-file commands in this
+        document, as Directive objects, in the order they appear."""
 
-        queries = []
-
-        from tagged_document import TagQuery
+        directives = []
 
         # start with a version of ourself that has no expanded snippets
         source_lines = self.cleaned_contents.split("\n")
 
-        # the list of lines we're working with
-        output_lines = []
-
         # default to working with files at the current state on disk; this
         # can change to specific refs when a // tag: instruction is
         # encountered in the document
         current_ref = WORKSPACE_REF
 
-        tag_regex = re.compile(r"$\/\/\s*tag:?\s*(.*)^", flags=re.IGNORECASE)
-        snip_regex = re.compile(r"$\/\/\s*tag:?\s*(.*)^", flags=re.IGNORECASE)
-
-        for line in source_lines:
-            output_lines.append(line)
+        for (line_number, line) in enumerate(source_lines, 1):
 
             # change which tag we're looking at if we hit an instruction to
-            # do so
-            tag = tag_regex.match(line)
+            # do so; this is interpreted the same way as in render()
+            if line.startswith(TAG_PREFIX):
+                current_ref = line[len(TAG_PREFIX)+1:].strip()
 
-            if tag:
-                current_ref = tag.groups(1).strip()
+            # snip-file commands refer to whole files, not tags
+            if line.startswith(SNIP_FILE_PREFIX):
+                filename = line[len(SNIP_FILE_PREFIX)+1:].strip()
+                directives.append(Directive(SNIP_FILE, line_number, current_ref, filename))
 
             # is this a snippet?
-            snippet = snip_regex.match(line)
-            if snippet:
+            elif line.startswith(SNIP_PREFIX):
 
                 # figure out what tags we're supposed to be using here
-                query_text = snippet.groups(1)
+                query_text = line[len(SNIP_PREFIX)+1:]
+                directives.append(Directive(SNIP, line_number, current_ref, query_text))
 
-                # build the tag query from this
-                query = TagQuery(query_text, ref=current_ref)
+        return directives
 
-                queries.append(query)
+    @property
+    def snippets(self):
+        """Returns the list of snippets in this document, as a TagQuery."""
 
-        return queries
+        return [directive.query for directive in self.directives if directive.kind == SNIP]
 
     @property
     def tags_used(self):
         """Returns the set of all tags referred to in this document."""
-        return set([query.all_referenced_tags for query in self.snippets])
+        return set(itertools.chain.from_iterable(query.all_referenced_tags for query in self.snippets))
 
-    def render_snippet(self, query, tagged_documents):
+    @property
+    def refs_used(self):
+        """Returns the set of refs that this document's tag commands switch
+        to."""
+        return {
+            line[len(TAG_PREFIX)+1:].strip() for line in self.cleaned_contents.split("\n")
+                if line.startswith(TAG_PREFIX)
+            }
 
-        from tagged_document import TagQuery
+    @staticmethod
+    def render_query(query_text, ref, tagged_documents, width_limit=None):
+        """Returns a tuple of (lines, paths, long_lines) for the query
+        'query_text' at 'ref': the rendered lines of the snippet, the paths
+        of the tagged documents that contributed to it, and an (offset,
+        path, width) tuple for each line wider than 'width_limit' columns.
+        Offsets count from 1."""
 
-        assert isinstance(query, TagQuery)
+        from tagged_version import display_width
 
-        # get the list of documents that actually exist at this point
-        documents_at_current_tag = filter(None, [document[query.ref] for document in tagged_documents])
+        lines = []
+        paths = []
+        long_lines = []
 
-        # get the tagged lines that apply from these documents
-        rendered_content = [document.query(query.query_string) for document in documents_at_current_tag]
+        for document in tagged_documents:
 
-        # any document that produced no lines will have returned None;
-        # remove those
-        rendered_content = filter(None, rendered_content)
+            # skip documents that don't exist at this point
+            version = document[ref]
+            if version is None:
+                continue
 
-        rendered_content = [content.split("\n") for content in rendered_content]
+            # get the tagged lines that apply from this document; a single
+            # blank line counts as none, since it once came back as an
+            # empty string
+            content = version.query_lines(query_text)
+            if not content or content == [""]:
+                continue
 
-        # we now have a list of list of lines; we want to flatten this to a
-        # plain list of lines
-        rendered_lines = list(itertools.chain.from_iterable(rendered_content))
+            paths.append(document.path)
 
-        rendered_lines = "\n".join(rendered_lines)
+            for line in content:
+                lines.append(line)
 
-        # finally, identify and remove any chain of 2 or more empty lines,
-        # replacing it with a single empty line
-        empty_lines = re.compile(r"(\s*?\n){2,}")
+                # a line can't be wider than its length unless it has tabs
+                if width_limit is not None and (len(line) > width_limit or "\t" in line):
+                    width = display_width(line)
+                    if width > width_limit:
+                        long_lines.append((len(lines), document.path, width))
 
-        rendered_lines = re.sub(empty_lines, "\n\n", rendered_lines)
+        return lines, paths, long_lines
 
-        return rendered_lines
+    @staticmethod
+    def render_snippet(query, tagged_documents):
+        """Returns the text of a single snippet, for 'query' at its ref."""
 
-        
+        from tagged_version import TagQuery
+
+        assert isinstance(query, TagQuery)
 
-    def render(self, tagged_documents, language=None, clean=False, show_query=True, file_getter=None, as_inline_list_items=False):
+        rendered_lines = CollapsedLines()
+        rendered_lines.extend(SourceDocument.render_query(query.query_string, query.ref, tagged_documents)[0])
 
-        """Returns a tuple of (string,bool): a version of itself after expanding snippets with code found in 'tagged_documents', and True if any snippets were rendered"""
+        return rendered_lines.text()
+
+    def render(self, tagged_documents, language=None, clean=False, show_query=True, file_getter=None, as_inline_list_items=False, used_documents=None, render_cache=None, width_limit=None, width_report=None, document_selector=None):
+
+        """Returns a tuple of (string,bool): a version of itself after expanding snippets with code found in 'tagged_documents', and True if any snippets were rendered. If 'used_documents' is a set, the paths of the tagged documents that contributed code are added to it.
+
+        If 'render_cache' is a dictionary, each query's rendered lines are stored in it, and reused by any later render with the same query, ref and 'tagged_documents'. If 'width_report' is a list, an entry is added to it for every rendered line wider than 'width_limit' columns.
+
+        If 'document_selector' is given, it's called with a ref and a query, and returns the tagged documents that are likely to contain code for it; only those are looked at, unless none of them do."""
         assert isinstance(tagged_documents, list)
         assert isinstance(language, str) or language is None
 
@@ -158,8 +202,9 @@ class SourceDocument(object):
         # start with a version of ourself that has no expanded snippets
         source_lines = self.cleaned_contents.split("\n")
 
-        # the list of lines we're working with
-        output_lines = []
+        # the list of lines we're working with; chains of empty lines are
+        # collapsed as they're added
+        output_lines = CollapsedLines()
 
         # default to working with files at HEAD
         current_ref = WORKSPACE_REF
@@ -167,21 +212,15 @@ class SourceDocument(object):
         # true if this file rendered any snippets
         dirty = False 
 
-        all_tags_at_current_tag = list({tag for doc in tagged_documents for tag in doc[current_ref].tags})
-
         snippet_count = 0
 
-        for line in source_lines:
+        for (line_number, line) in enumerate(source_lines, 1):
             output_lines.append(line)
 
             # change which tag we're looking at if we hit an instruction to do so
             if line.startswith(TAG_PREFIX):
                 current_ref = line[len(TAG_PREFIX)+1:].strip()
 
-                all_valid_docs_at_current_ref = [doc for doc in tagged_documents if doc[current_ref]]
-
-                all_tags_at_current_tag = list({tag for doc in all_valid_docs_at_current_ref for tag in doc[current_ref].tags})
-
             # expand file snippets as we encounter them
             if line.startswith(SNIP_FILE_PREFIX):
                 if not file_getter:
@@ -205,25 +244,48 @@ class SourceDocument(object):
                 # figure out what tags we're supposed to be using here
                 query_text = line[len(SNIP_PREFIX)+1:]
 
-                # get the list of documents that actually exist at this
-                # point
-                documents_at_current_tag = filter(None, [document[current_ref] for document in tagged_documents])
-
-                # get the tagged lines that apply from these documents
-                rendered_content = [document.query(query_text) for document in documents_at_current_tag]
-
-                # any document that produced no lines will have returned
-                # None; remove those
-                rendered_content = filter(None, rendered_content)
-
-                rendered_content = [content.split("\n") for content in rendered_content]
-
-                # we now have a list of list of lines; we want to flatten
-                # this to a plain list of lines
-                rendered_lines = list(itertools.chain.from_iterable(rendered_content))
+                # the same query at the same ref always renders the same
+                # lines, so they only need to be worked out once
+                from tagged_version import TagQuery
+                cache_key = (current_ref, TagQuery.normalise(query_text), width_limit)
+
+                if render_cache is not None and cache_key in render_cache:
+                    (rendered_lines, contributing_paths, long_lines) = render_cache[cache_key]
+                else:
+                    documents = tagged_documents
+
+                    if document_selector is not None:
+                        documents = document_selector(current_ref, query_text)
+
+                    (rendered_lines, contributing_paths, long_lines) = self.render_query(query_text, current_ref, documents, width_limit)
+
+                    if not rendered_lines and documents is not tagged_documents:
+                        logging.debug("%s: No code for '%s' at '%s' in the expected files; looking in all of them", self.path, query_text.strip(), current_ref)
+                        (rendered_lines, contributing_paths, long_lines) = self.render_query(query_text, current_ref, tagged_documents, width_limit)
+
+                    if render_cache is not None:
+                        render_cache[cache_key] = (rendered_lines, contributing_paths, long_lines)
+
+                if used_documents is not None:
+                    used_documents.update(contributing_paths)
+
+                if width_report is not None:
+                    for (offset, path, width) in long_lines:
+                        width_report.append(OrderedDict([
+                            ("chapter", self.path),
+                            ("line", line_number),
+                            ("snippet", snippet_count),
+                            ("offset", offset),
+                            ("ref", current_ref),
+                            ("query", query_text.strip()),
+                            ("file", path),
+                            ("width", width),
+                            ("limit", width_limit),
+                            ("text", rendered_lines[offset - 1]),
+                            ]))
 
                 if show_query:
-                    from tagged_document import TagQuery
+                    from tagged_version import TagQuery
                     query_obj = TagQuery(query_text)
                     description = "// Snippet: {}-{}\n".format(snippet_count, query_obj.as_filename)
                     rendered_lines = [description] + rendered_lines
@@ -234,10 +296,14 @@ class SourceDocument(object):
                     # proofreader can spot it)
 
                     # try and find some potential tags that could fit
-                    from tagged_document import TagQuery
+                    from tagged_version import TagQuery
 
                     query = TagQuery(query_text)
 
+                    # this looks at every document at this ref, which is
+                    # only worth doing when something's gone wrong
+                    all_tags_at_current_tag = list({tag for doc in tagged_documents if doc[current_ref] for tag in doc[current_ref].tags})
+
                     bests = [result[0] for result in process.extractBests(query.include[0], all_tags_at_current_tag, score_cutoff=80)]
                     
                     import textwrap
@@ -258,27 +324,143 @@ class SourceDocument(object):
 
                 # and output the snippet
                 output_lines.append("----")
-                output_lines += rendered_lines
+                output_lines.extend(rendered_lines)
                 output_lines.append("----")
 
                 snippet_count += 1
         
         # render the output into a string
-        output = "\n".join(output_lines)
+        output = output_lines.text()
 
-        # finally, identify and remove any chain of 2 or more empty lines,
-        # replacing it with a single empty line
-        empty_lines = re.compile(r"(\s*?\n){2,}")
+        return output, dirty
 
-        output = re.sub(empty_lines, "\n\n", output)
 
-        
-        return output, dirty
+class CollapsedLines(object):
+    r"""A list of lines that is built up one line at a time, in which every
+    chain of 2 or more empty (or whitespace-only) lines is replaced with a
+    single empty line. The result is the same as joining the lines and
+    replacing the regular expression (\s*?\n){2,} with two newlines, but
+    without another pass over the text."""
 
+    def __init__(self):
+        self.lines = []
 
+        # the whitespace-only lines seen since the last line with something
+        # in it; what happens to them depends on what comes next
+        self.pending = []
 
-                
+        # true once a line with something in it has been added
+        self.started = False
+
+    def append(self, line):
+        if "\n" in line:
+            self.extend(line.split("\n"))
+            return
+
+        if not line.strip():
+            self.pending.append(line)
+            return
+
+        if self.pending:
+            if self.started:
+                # the whitespace at the end of the previous line goes too
+                self.lines[-1] = self.lines[-1].rstrip()
+                self.lines.append("")
+            elif len(self.pending) > 1:
+                self.lines += ["", ""]
+            else:
+                self.lines += self.pending
+
+            self.pending = []
+
+        self.started = True
+        self.lines.append(line)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def text(self):
+        """Returns the lines, joined with newlines."""
+
+        lines = self.lines
+        pending = self.pending
+
+        # a chain of empty lines at the end is collapsed up to (but not
+        # including) the last one, since there's no newline after it
+        if self.started and len(pending) > 1:
+            lines = lines[:-1] + [lines[-1].rstrip(), "", pending[-1]]
+        elif not self.started and len(pending) > 2:
+            lines = ["", "", pending[-1]]
+        else:
+            lines = lines + pending
 
+        return "\n".join(lines)
 
+# A line that may be followed by an expanded snippet.
+SNIP_LINE_RE = re.compile(r"//.*snip", flags=re.IGNORECASE)
 
+def clean_text(text):
+    """Returns 'text' without the expanded snippets that follow its snip
+    and snip-file commands: an optional "+" line, any number of "[...]"
+    attribute lines, and a block delimited by "----" lines. Works through
+    the text one line at a time, rather than with a regular expression
+    over the whole thing, so that chapters with many snippets are cleaned
+    in a single pass."""
+
+    lines = text.split("\n")
+
+    # the last item is whatever follows the final newline, so it's the only
+    # line that doesn't end in one
+    last = len(lines) - 1
+
+    output = []
+    index = 0
+
+    while index <= last:
+        line = lines[index]
+        output.append(line)
+        index += 1
+
+        if index > last or "//" not in line or not SNIP_LINE_RE.search(line):
+            continue
+
+        block = index
+
+        if block < last and lines[block] == "+":
+            block += 1
+
+        while block < last and len(lines[block]) >= 2 and lines[block][0] == "[" and lines[block][-1] == "]":
+            block += 1
+
+        if block < last and lines[block] == "----":
+            end = block + 1
+
+            while end < last and lines[end] != "----":
+                end += 1
+
+            if end < last:
+                # skip the whole expansion, up to and including its
+                # closing line
+                index = end + 1
+
+    return "\n".join(output)
+
+class Directive(object):
+    """A snip or snip-file command in a source document."""
+
+    def __init__(self, kind, line_number, ref, argument):
+        assert kind in (SNIP, SNIP_FILE)
+
+        self.kind = kind
+        self.line_number = line_number # counting from 1, in the cleaned document
+        self.ref = ref # the ref that was current when the command appeared
+        self.argument = argument # the query, or the file name
+
+    @property
+    def query(self):
+        """Returns the TagQuery for a snip command."""
+        from tagged_version import TagQuery
 
+        assert self.kind == SNIP
+        return TagQuery(self.argument, ref=self.ref)
@@ -2,13 +2,22 @@
 
 import git
 import re
-import copy
 import logging
 from six import StringIO
-import textwrap
 import os
+import hashlib
+import threading
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from source_document import WORKSPACE_REF
+from git_objects import GitPythonObjects
+
+# versions and queries don't need git, so they live in their own module;
+# they're available from here too
+from tagged_version import TaggedDocumentVersion, TaggedLine, TagQuery, TagPattern, parse_tagged_data, display_width, is_tag_pattern, tags_matching
 
 class TaggedDocument(object):
     """A document containing tagged regions."""
@@ -18,7 +27,18 @@ class TaggedDocument(object):
         assert isinstance(repo, git.Repo)
         assert isinstance(extensions, list)
 
-        documents = []
+        resolver = RefResolver(repo)
+
+        return [TaggedDocument(repo, path, resolver) for path in TaggedDocument.find_paths(repo, extensions)]
+
+    @staticmethod
+    def find_paths(repo, extensions):
+        """Returns the paths, relative to the repo, of the documents that
+        find() would load, without loading them."""
+        assert isinstance(repo, git.Repo)
+        assert isinstance(extensions, list)
+
+        paths = []
 
         starting_dir = repo.working_dir
 
@@ -41,29 +61,33 @@ class TaggedDocument(object):
                         # documents we're using
                         logging.debug("Adding %s", path_relative_to_repo)
 
-                        documents.append(TaggedDocument(repo, path_relative_to_repo))                        
-                        
-                            
-
+                        paths.append(path_relative_to_repo)
                         
-        if len(documents) == 0:
+        if len(paths) == 0:
             logging.warn("No tagged documents were found.")
-        return documents
+        return paths
         
         
 
-    def __init__(self, repo, path):
+    def __init__(self, repo, path, resolver=None, cache=None):
         assert isinstance(repo, git.Repo)
         assert isinstance(path, str)
         self.path = path.replace(os.sep, "/")
         self.versions = {} # maps git refs to TaggedDocumentVersion objects
+        self.versions_by_blob = {} # maps git blob IDs to TaggedDocumentVersion objects
+        self.known_tags = set() # the tags defined by any version loaded so far
         self.repo = repo
 
-        # Add the current-on-disk version
-        path_on_disk = os.path.join(repo.working_dir, path)
-        with open(path_on_disk) as file_on_disk:
-            data_on_disk = file_on_disk.read()
-            self.versions[WORKSPACE_REF] = TaggedDocumentVersion(self.path, data_on_disk, WORKSPACE_REF)
+        # documents from the same repo should share a resolver, so that
+        # each ref is only looked up once
+        self.resolver = resolver or RefResolver(repo)
+
+        # if given, a VersionCache shared by every document, which limits
+        # how many versions from history are kept
+        self.cache = cache
+
+        # the current-on-disk version is loaded the first time it's asked
+        # for, so that documents nobody needs are never read
         
     
     def __getitem__(self, revision):
@@ -73,220 +97,496 @@ class TaggedDocument(object):
         
         try:
             version = self.versions[revision]
+
+            if self.cache is not None and version is not None:
+                self.cache.touch(self, version)
         except KeyError:
+            if revision == WORKSPACE_REF:
+                self.versions[revision] = self.load_working_copy()
+                return self.versions[revision]
+
             # attempt to get the file at this path, at this version
-            try:
-                # get the data of the file at this ref; may raise KeyError
-                data = self.repo.tree(revision)[self.path].data_stream.read()
+            blob = self.blob(revision)
 
+            if blob is None:
+                version = None
+            elif blob in self.versions_by_blob:
+                # the file is unchanged from a version we already have
+                version = self.versions_by_blob[blob]
+            else:
                 # create the version from this data
-                version = TaggedDocumentVersion(self.path, data, revision)
+                version = self.add_version(blob, self.resolver.objects.read_blob(blob), revision)
 
-                # cache it
-                self.versions[revision] = version
-            except KeyError:
-                # there's no commit of this type in the repo at this name
-                return None
+            # cache it; a None is cached too, so that we don't keep asking
+            # git for a file that doesn't exist at this ref
+            self.versions[revision] = version
 
-        assert isinstance(version, TaggedDocumentVersion) 
+            if self.cache is not None and version is not None:
+                self.cache.touch(self, version)
 
-        return self.versions[revision]
+        assert version is None or isinstance(version, TaggedDocumentVersion) 
 
-class TaggedDocumentVersion(object):
-    """A specific version of a tagged document."""
+        return version
 
-    def __init__(self, path, data, version):
-        self.path = path
-        self.data = data.replace(b"\r", b"")
-        self.version = version
-        self.lines = []
+    def forget(self, revision):
+        """Forgets this document's version at 'revision', so that it's
+        looked up again next time. The parsed version is kept (by blob ID)
+        only while another ref still has it, so that a long-lived document
+        doesn't hold on to every version it's ever seen."""
+        version = self.versions.pop(revision, None)
 
-        self.parse_lines(self.data)
+        if version is None or any(other is version for other in self.versions.values()):
+            return
 
-        logging.debug("Loaded %s (%i lines)", self.path, len(self.lines))
+        if self.versions_by_blob.get(version.blob_id) is version:
+            del self.versions_by_blob[version.blob_id]
 
-    @property
-    def tags(self):
+        if self.cache is not None:
+            self.cache.discard(self, version)
 
-        tags = set()
+    def forget_history(self):
+        """Forgets the version at every ref except the working copy, eg
+        because branches may have moved."""
+        for revision in list(self.versions):
+            if revision != WORKSPACE_REF:
+                self.forget(revision)
 
-        for line in self.lines:
+    def read_working_copy(self):
+        """Returns the current-on-disk contents of this document, or None
+        if the file no longer exists."""
 
-            assert isinstance(line, TaggedLine)
+        path_on_disk = os.path.join(self.repo.working_dir, self.path)
 
-            tags = tags.union(set(line.tags))
-        
-        # return the set of all tags in this document
-        return tags
+        try:
+            with open(path_on_disk) as file_on_disk:
+                return file_on_disk.read()
+        except IOError:
+            if os.path.exists(path_on_disk):
+                raise
+            return None
 
-    
-    def query(self, query_string):
-        """Given a query string, returns the lines of text that match the specified query."""
+    def load_working_copy(self):
+        """Reads and parses the current-on-disk version of this document.
+        Returns None if the file no longer exists."""
 
-        assert isinstance(query_string, str)
+        data_on_disk = self.read_working_copy()
 
-        query = TagQuery(query_string)
+        if data_on_disk is None:
+            return None
 
-        has_content = False
+        data_id = blob_id(data_on_disk)
 
-        snippet_contents = []
+        # share the version from git if it's unchanged on disk
+        if data_id in self.versions_by_blob:
+            return self.versions_by_blob[data_id]
 
-        for line in self.lines:
+        return self.add_version(data_id, data_on_disk, WORKSPACE_REF)
 
-            assert isinstance(line, TaggedLine)
+    def blob(self, revision, objects=None):
+        """Returns the ID of the git blob for this document at 'revision',
+        or None if it didn't exist at that point. 'objects' can be used to
+        read from a different object source than this document's (eg on
+        another thread), in which case 'revision' must be a commit ID."""
 
-            # If its LAST tag is the same as any of the isolating tags, include it
-            if set(line.tags[-1:]).intersection(query.isolate):
-                snippet_contents.append (line.text)
-                
-                has_content = True
-            # Otherwise, if it has tags that we want, and none of the tags we don't, include it
-            elif set(line.tags).intersection(query.include) and not set(line.tags).intersection(query.exclude):
-                snippet_contents.append(line.text)
-                
-                has_content = True
-            else:
-                # This line doesn't match the tags we're looking for. Move on to the next.
-                pass
-        
-        if not has_content:
+        if objects is None:
+            objects = self.resolver.objects
+            commit = self.resolver.commit(revision)
+        else:
+            commit = revision
+
+        if commit is None:
+            # there's no commit of this type in the repo at this name
             return None
 
-        rendered_snippet = "\n".join(snippet_contents)
-        
-        rendered_snippet = textwrap.dedent(rendered_snippet)
+        # None if the file doesn't exist in this commit
+        return objects.find_blob(commit, self.path)
 
-        return rendered_snippet
+    def add_version(self, blob_id, data, revision, parsed=None):
+        """Parses 'data' (unless 'parsed' is what parse_tagged_data already
+        returned for it), and stores it as the version for 'blob_id', so
+        that every ref containing this blob can share it."""
+        version = TaggedDocumentVersion(self.path, data, revision, parsed)
+        version.blob_id = blob_id
+        self.versions_by_blob[blob_id] = version
+        self.known_tags.update(version.tag_ranges)
+        return version
 
+    @staticmethod
+    def load_working_copies(documents, jobs=4, processes=0, chunk_size=16):
+        """Loads the working copies of 'documents' that haven't been loaded
+        yet. If 'processes' is more than 1, files are read on a pool of
+        'jobs' threads, and parsed in chunks of 'chunk_size' on a pool of
+        'processes' processes, so that reading and parsing overlap; the
+        results are added in order, so that any warnings come out the same
+        way every time. Otherwise, they're read and parsed one at a time.
+
+        Starting processes takes long enough that it only pays off for big
+        repos on machines with plenty of cores, so it's off by default."""
+
+        documents = [document for document in documents if WORKSPACE_REF not in document.versions]
+
+        # starting processes isn't worth it for a handful of files
+        if processes <= 1 or len(documents) <= chunk_size:
+            for document in documents:
+                document[WORKSPACE_REF]
+            return
+
+        logging.debug("Parsing %i documents in %i processes", len(documents), processes)
+
+        # the process pool is started first, so that its processes aren't
+        # forked from a process that's already running threads
+        process_pool = multiprocessing.Pool(processes)
+        thread_pool = ThreadPool(max(1, jobs))
+
+        # maps the index of each document to its contents as read from
+        # disk, until the parsed result comes back
+        contents = {}
+
+        def read(index):
+            # errors are passed along rather than raised, since on Python 2
+            # an error in chunks() would leave the process pool waiting
+            # forever; they're raised when the document's turn comes
+            try:
+                return (index, documents[index].read_working_copy())
+            except Exception as error:
+                return (index, error)
 
+        def chunks():
+            chunk = []
 
-    def parse_lines(self, data):
+            for (index, data) in thread_pool.imap(read, range(len(documents))):
+                contents[index] = data
 
-        assert isinstance(data, str)
+                if data is None or isinstance(data, Exception):
+                    chunk.append((documents[index].path, None))
+                else:
+                    chunk.append((documents[index].path, data.replace(b"\r", b"")))
 
-        # begin_re = re.compile(r"\s*(\/\/|#)\s*BEGIN\s+([^\s]+)")
-        # end_re = re.compile(r"\s*(\/\/|#)\s*END\s+([^\s]+)")
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
 
-        begin_re = re.compile(r"\s*(\/\/|\#)\s*BEGIN\s+([^\s]+)", flags=re.IGNORECASE)
-        end_re = re.compile(r"\s*(\/\/|\#)\s*END\s+([^\s]+)", flags=re.IGNORECASE)
+            if chunk:
+                yield chunk
 
+        try:
+            index = 0
 
-        current_tags = []
+            for results in process_pool.imap(parse_tagged_chunk, chunks()):
+                for parsed in results:
+                    document = documents[index]
+                    data = contents.pop(index)
+                    index += 1
 
-        for (line_number, line_text) in enumerate(data.split("\n")):
-            
-            # If this line contains "//-", "/*-" or "-*/", it's a comment
-            # that should not be included in rendered snippets.
-            if "/*-" in line_text or "-*/" in line_text or "//-" in line_text:
-                pass
-            
-            # If we entered a tag, add it to the list
-            elif begin_re.search(line_text):
-                tag = begin_re.search(line_text).group(2)
-                
-                if tag in current_tags:
-                    logging.warn("{0}:{1}: \"{2}\" was entered twice without exiting it".format(self.path, line_number, tag))
-                else:
-                    current_tags.append(tag)
-                
-                
-            # If we left a tag, remove it
-            elif end_re.search(line_text):
-                tag = end_re.search(line_text).group(2)
-                
-                if tag not in current_tags:
-                    logging.warn("{0}:{1}: \"{2}\" was exited, but had not yet been entered".format(self.path, line_number, tag))
-                else:
-                    current_tags.remove(tag)
-                
-            
-            # If it's neither, and we're inside any tagged region, 
-            # add it to the list of tagged lines 
-            elif current_tags:
-                self.lines.append(TaggedLine(self.path, line_number, line_text, copy.copy(current_tags)))
-    
-    def lines_over_limit(self, limit):
-        # Returns the collection of lines in this document that go over the
-        # specified limit. The characters are counted in Unicode, not
-        # individual codes.
-        return [
-            line for line in self.lines 
-                if len(line.text.decode("utf-8")) > limit
+                    if isinstance(data, Exception):
+                        raise data
+
+                    if data is None:
+                        document.versions[WORKSPACE_REF] = None
+                        continue
+
+                    data_id = blob_id(data)
+
+                    # share a version from git if it's unchanged on disk
+                    if data_id in document.versions_by_blob:
+                        version = document.versions_by_blob[data_id]
+                    else:
+                        version = document.add_version(data_id, data, WORKSPACE_REF, unpack_parsed(parsed))
+
+                    document.versions[WORKSPACE_REF] = version
+        finally:
+            process_pool.close()
+            process_pool.join()
+            thread_pool.close()
+            thread_pool.join()
+
+    @staticmethod
+    def prewarm(documents, refs, jobs=4):
+        """Loads the versions of 'documents' at each of 'refs' ahead of
+        time, fetching from git on a pool of 'jobs' threads, so that
+        rendering doesn't stall on git each time it reaches a new ref."""
+        assert isinstance(documents, list)
+
+        if not documents:
+            return
+
+        resolver = documents[0].resolver
+
+        # refs that name the same tree (eg a tag, and the commit it points
+        # to) have identical contents, so we only load them once
+        refs_by_tree = OrderedDict()
+
+        # maps tree IDs to a commit that contains it, which is what we
+        # actually ask git for
+        commits_by_tree = {}
+
+        for ref in refs:
+            if ref == WORKSPACE_REF:
+                continue
+
+            commit = resolver.commit(ref)
+
+            if commit is None:
+                continue
+
+            tree = resolver.tree(commit)
+
+            refs_by_tree.setdefault(tree, []).append(ref)
+            commits_by_tree.setdefault(tree, commit)
+
+        work = [
+            (document, tree) for tree in refs_by_tree for document in documents
+                if any(ref not in document.versions for ref in refs_by_tree[tree])
             ]
 
-    
-class TaggedLine(object):
-    """A line in a document, with its associated tags."""
-    def __init__(self, source_name, line_number, text, tags):
+        if not work:
+            return
 
-        assert isinstance(source_name, str)
-        assert isinstance(line_number, int)
-        assert isinstance(text, str)
-        assert isinstance(tags, list)
+        logging.debug("Loading %i document versions at %i refs", len(work), len(refs_by_tree))
 
-        assert tags, "Expected a non-empty list of tags when creating a TaggedLine"
+        # some object sources can't be shared between threads, so each
+        # worker asks for its own
+        worker_sources = []
+        local = threading.local()
 
-        self.source_name = source_name
-        self.line_number = line_number
-        self.text = text
-        self.tags = tags
+        def fetch(item):
+            (document, tree) = item
 
-INCLUDE_TAGS = 0
-EXCLUDE_TAGS = 1
-HIGHLIGHT_TAGS = 2
-ISOLATE_TAGS = 3
+            if not hasattr(local, "objects"):
+                local.objects = resolver.objects.for_thread()
+                if local.objects is not resolver.objects:
+                    worker_sources.append(local.objects)
 
-class TagQuery(object):
-    """Represents a query for a specific set of tags."""
-    def __init__(self, query_string, ref="HEAD"):
+            blob = document.blob(commits_by_tree[tree], objects=local.objects)
 
-        assert isinstance(query_string, str)
-        tokens = query_string.split(" ")
+            if blob is None:
+                return None
 
-        mode = INCLUDE_TAGS
-        
-        # The context at which we 
-        self.query_string = query_string 
-        self.ref = ref 
-
-        # The specific tags this query deals with
-        self.include = []
-        self.exclude = []
-        self.highlight = []
-        self.isolate = []
-        
-        
-        # Interpret the list of tokens
-        for token in tokens:
-            
-            # Change mode if we have to
-            if token.lower() == "except":
-                mode = EXCLUDE_TAGS
-            elif token.lower() == "highlighting":
-                mode = HIGHLIGHT_TAGS
-            elif token.lower() == "isolating":
-                mode = ISOLATE_TAGS
-            
-            # Otherwise, add it to the list of tokens
-            else:
-                if mode == INCLUDE_TAGS:
-                    self.include.append(token)
-                elif mode == EXCLUDE_TAGS:
-                    self.exclude.append(token)
-                elif mode == HIGHLIGHT_TAGS:
-                    self.highlight.append(token)
-                elif mode == ISOLATE_TAGS:
-                    self.isolate.append(token)
-        
-        logging.debug("Query includes tags %s", self.include)
-    
-    @property
-    def as_filename(self):
-        if self.ref == "HEAD":
-            return "{}.txt".format(self.query_string.replace(" ", "_"))
+            # don't bother reading blobs we've already parsed
+            if blob in document.versions_by_blob:
+                return (blob, None)
+
+            return (blob, local.objects.read_blob(blob))
+
+        pool = ThreadPool(max(1, jobs))
+
+        try:
+            # the workers only fetch; parsing happens here, in order, so that
+            # any warnings come out the same way every time
+            for (index, fetched) in enumerate(pool.imap(fetch, work)):
+                (document, tree) = work[index]
+
+                aliases = refs_by_tree[tree]
+
+                if fetched is None:
+                    version = None
+                elif fetched[0] in document.versions_by_blob:
+                    version = document.versions_by_blob[fetched[0]]
+                else:
+                    (blob, data) = fetched
+
+                    # the blob was loaded when the worker looked, but the
+                    # version cache has forgotten it since
+                    if data is None:
+                        data = resolver.objects.read_blob(blob)
+
+                    version = document.add_version(blob, data, aliases[0])
+
+                for ref in aliases:
+                    document.versions[ref] = version
+
+                if document.cache is not None and version is not None:
+                    document.cache.touch(document, version)
+        finally:
+            pool.close()
+            pool.join()
+
+            for worker_source in worker_sources:
+                worker_source.close()
+
+class VersionCache(object):
+    """Limits how many versions loaded from git history are kept in memory,
+    across every document that shares it. When there are too many, the
+    least recently used version is forgotten (and loaded again if it's
+    needed), preferring versions that are only at refs that won't be
+    needed again. Working copies are never forgotten."""
+
+    def __init__(self, max_versions):
+        assert max_versions > 0
+
+        self.max_versions = max_versions
+
+        # (document, blob ID) for each version, least recently used first
+        self.entries = OrderedDict()
+
+        # if not None, the refs that are still going to be used; versions
+        # that aren't at any of them are forgotten first
+        self.future_refs = None
+
+        self.evictions = 0
+
+    def touch(self, document, version):
+        """Records that 'version' of 'document' was just used."""
+
+        # working copies aren't counted
+        if document.versions.get(WORKSPACE_REF) is version:
+            return
+
+        key = (document, version.blob_id)
+
+        if self.entries.pop(key, None) is None:
+            while len(self.entries) >= self.max_versions:
+                self.evict()
+
+        self.entries[key] = True
+
+    def evict(self):
+        victim = None
+
+        if self.future_refs is not None:
+            for (document, blob) in self.entries:
+                version = document.versions_by_blob[blob]
+
+                if not any(ref in self.future_refs for (ref, other) in document.versions.items() if other is version):
+                    victim = (document, blob)
+                    break
+
+        if victim is None:
+            victim = next(iter(self.entries))
+
+        del self.entries[victim]
+
+        (document, blob) = victim
+        version = document.versions_by_blob.pop(blob)
+
+        for (ref, other) in list(document.versions.items()):
+            if other is version and ref != WORKSPACE_REF:
+                del document.versions[ref]
+
+        self.evictions += 1
+
+    def discard(self, document, version):
+        """Stops tracking 'version' of 'document', which it's forgotten."""
+        self.entries.pop((document, version.blob_id), None)
+
+    def clear(self):
+        """Stops tracking every version; they stay loaded."""
+        self.entries.clear()
+
+class RefResolver(object):
+    """Resolves the refs named in '// tag:' commands (tags, branches, short
+    or full commit IDs) to commits, once for the whole repo. Files are read
+    from those commits with 'objects', an object source from git_objects
+    (by default, GitPython)."""
+
+    def __init__(self, repo, objects=None):
+        assert isinstance(repo, git.Repo)
+        self.repo = repo
+        self.objects = objects or GitPythonObjects(repo)
+        self.commits = {} # maps ref names to commit IDs, or None for unknown refs
+        self.trees = {} # maps commit IDs to tree IDs
+
+    def commit(self, ref):
+        """Returns the ID of the commit that 'ref' names, or None if there
+        isn't one."""
+
+        assert isinstance(ref, str)
+
+        try:
+            return self.commits[ref]
+        except KeyError:
+            pass
+
+        try:
+            commit = str(self.repo.commit(ref).hexsha)
+        except (git.BadName, git.BadObject, ValueError):
+            # only complain once, no matter how many documents ask about it
+            logging.error("'%s' is not a tag, branch or commit in %s", ref, self.repo.working_dir)
+            commit = None
+
+        self.commits[ref] = commit
+
+        return commit
+
+    def tree(self, ref):
+        """Returns the ID of the git tree at 'ref', or None if there isn't
+        one."""
+
+        commit = self.commit(ref)
+
+        if commit is None:
+            return None
+
+        try:
+            return self.trees[commit]
+        except KeyError:
+            tree = self.objects.tree_id(commit)
+            self.trees[commit] = tree
+            return tree
+
+    def recheck_unknown(self):
+        """Looks up every ref that didn't name a commit last time again,
+        eg because it's a tag that's been made since. Returns the list of
+        refs that do now."""
+
+        created = []
+
+        for ref in sorted(ref for (ref, commit) in self.commits.items() if commit is None):
+            try:
+                self.commits[ref] = str(self.repo.commit(ref).hexsha)
+                created.append(ref)
+            except (git.BadName, git.BadObject, ValueError):
+                pass
+
+        return created
+
+    def clear(self):
+        """Forgets everything resolved so far, eg because a branch moved."""
+        self.commits = {}
+        self.trees = {}
+
+# the fields of parse_tagged_data's result that are arrays
+PARSED_ARRAYS = (0, 1, 3, 4)
+
+def parse_tagged_chunk(items):
+    """Runs parse_tagged_data on each (path, data) tuple in 'items'; used
+    to parse documents in a pool of worker processes. Arrays are sent back
+    as bytes, which pickle far faster."""
+
+    results = []
+
+    for (path, data) in items:
+        if data is None:
+            results.append(None)
+            continue
+
+        parsed = list(parse_tagged_data(path, data))
+
+        for field in PARSED_ARRAYS:
+            parsed[field] = parsed[field].tostring() if hasattr(parsed[field], "tostring") else parsed[field].tobytes()
+
+        results.append(tuple(parsed))
+
+    return results
+
+def unpack_parsed(parsed):
+    """Turns the bytes that parse_tagged_chunk sent back into arrays."""
+
+    parsed = list(parsed)
+
+    for field in PARSED_ARRAYS:
+        values = array("l")
+        if hasattr(values, "frombytes"):
+            values.frombytes(parsed[field])
         else:
-            return "{}_{}.txt".format(self.ref, self.query_string.replace(" ", "_"))
+            values.fromstring(parsed[field])
+        parsed[field] = values
+
+    return tuple(parsed)
+
+def blob_id(data):
+    """Returns the ID that git would give a blob containing 'data'."""
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
 
-    @property
-    def all_referenced_tags(self):
-        return set(self.include) |  set(self.exclude) |  set(self.highlight) | set(self.isolate)
+    return hashlib.sha1(b"blob " + str(len(data)).encode("ascii") + b"\0" + data).hexdigest()
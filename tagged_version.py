@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+
+import re
+import os
+import logging
+import bisect
+from array import array
+from collections import OrderedDict
+
+from source_document import WORKSPACE_REF
+
+# The number of columns a tab advances to when measuring line widths.
+TAB_WIDTH = 8
+
+# The leading whitespace of a line, as textwrap.dedent sees it.
+INDENT_RE = re.compile(r"[ \t]*")
+
+# Characters that make a tag in a query match many tags: "*" matches any
+# run of characters, and "?" matches any one character.
+WILDCARD_RE = re.compile(r"[*?]")
+
+# Lines that enter and leave tagged regions.
+BEGIN_RE = re.compile(r"\s*(\/\/|\#)\s*BEGIN\s+([^\s]+)", flags=re.IGNORECASE)
+END_RE = re.compile(r"\s*(\/\/|\#)\s*END\s+([^\s]+)", flags=re.IGNORECASE)
+
+def parse_tagged_data(path, data):
+    """Finds the tagged lines in 'data', the contents of the document at
+    'path'. Returns a tuple of plain values, which can be cheaply sent
+    between processes (the text itself isn't included, since the receiver
+    already has it):
+
+    - line_numbers, stack_ids, widths and indent_lengths: arrays with, for
+      each tagged line, its line number (counting from 0), the index of its
+      stack of tags in stack_tags, its width in columns, and the length of
+      its leading whitespace
+    - stack_tags: each distinct stack of tags, as a tuple, outermost first
+    - tag_ranges: maps each tag to a list of (first, last) line numbers,
+      counting from 1, of the regions from its BEGIN to its END
+    - warnings: messages about badly nested tags, to be logged by the
+      caller
+    """
+
+    line_numbers = array("l")
+    stack_ids = array("l")
+    stack_tags = []
+    widths = array("l")
+    indent_lengths = array("l")
+    tag_ranges = {}
+    warnings = []
+
+    current_tags = []
+
+    # the line number (counting from 1) of the BEGIN for each entered tag
+    region_starts = {}
+
+    # maps tuples of tags to their index in stack_tags
+    stack_ids_by_tags = {}
+
+    # the stack that the current tags form, or None if they've changed
+    # since it was last looked up
+    stack_id = None
+
+    for (line_number, line_text) in enumerate(data.split("\n")):
+        
+        # If this line contains "//-", "/*-" or "-*/", it's a comment
+        # that should not be included in rendered snippets.
+        if "/*-" in line_text or "-*/" in line_text or "//-" in line_text:
+            pass
+        
+        # If we entered a tag, add it to the list
+        elif BEGIN_RE.search(line_text):
+            tag = BEGIN_RE.search(line_text).group(2)
+            
+            if tag in current_tags:
+                warnings.append("{0}:{1}: \"{2}\" was entered twice without exiting it".format(path, line_number, tag))
+            else:
+                current_tags.append(tag)
+                region_starts[tag] = line_number + 1
+                stack_id = None
+            
+        # If we left a tag, remove it
+        elif END_RE.search(line_text):
+            tag = END_RE.search(line_text).group(2)
+            
+            if tag not in current_tags:
+                warnings.append("{0}:{1}: \"{2}\" was exited, but had not yet been entered".format(path, line_number, tag))
+            else:
+                current_tags.remove(tag)
+                tag_ranges.setdefault(tag, []).append((region_starts.pop(tag), line_number + 1))
+                stack_id = None
+        
+        # If it's neither, and we're inside any tagged region, 
+        # add it to the list of tagged lines 
+        elif current_tags:
+            if stack_id is None:
+                stack = tuple(current_tags)
+                stack_id = stack_ids_by_tags.get(stack)
+
+                if stack_id is None:
+                    stack_id = stack_ids_by_tags[stack] = len(stack_tags)
+                    stack_tags.append(stack)
+
+            line_numbers.append(line_number)
+            stack_ids.append(stack_id)
+            widths.append(display_width(line_text))
+            indent_lengths.append(INDENT_RE.match(line_text).end())
+
+    # tags that were never exited run to the end of the file
+    for tag in current_tags:
+        tag_ranges.setdefault(tag, []).append((region_starts[tag], line_number + 1))
+
+    return (line_numbers, stack_ids, stack_tags, widths, indent_lengths, tag_ranges, warnings)
+
+def display_width(text):
+    """Returns the number of columns 'text' takes up, counting each
+    character (not each UTF-8 byte) as one column, and expanding tabs."""
+    if isinstance(text, bytes):
+        text = text.decode("utf-8", "replace")
+
+    return len(text.expandtabs(TAB_WIDTH))
+
+class TaggedDocumentVersion(object):
+    """A specific version of a tagged document."""
+
+    def __init__(self, path, data, version, parsed=None):
+        self.path = path
+        self.data = data.replace(b"\r", b"")
+        self.version = version
+        self.lines = []
+
+        # for each tagged line, its width in columns with tabs expanded,
+        # and its leading whitespace; kept side by side with self.lines so
+        # that width checks don't need to look at the text at all
+        self.widths = array("l")
+        self.indents = []
+
+        # maps each tag to a list of (first, last) line numbers, counting
+        # from 1, of the regions from its BEGIN to its END
+        self.tag_ranges = {}
+
+        # each tag that appears on a line gets its own bit; each distinct
+        # stack of tags that lines are in is stored once, as a (mask of all
+        # of its tags, bit of its innermost tag) tuple, and each line just
+        # stores the index of its stack
+        self.tag_bits = {}
+        self.stacks = []
+        self.stack_ids = array("l")
+
+        # maps normalised query strings to the indices of the lines they
+        # match
+        self.matches = {}
+
+        # this version's tags in sorted order, made when a wildcard tag is
+        # first looked up, and a map of each wildcard tag to what it matched
+        self.sorted_tags = None
+        self.expansions = {}
+
+        self.parse_lines(self.data, parsed)
+
+        logging.debug("Loaded %s (%i lines)", self.path, len(self.lines))
+
+    @property
+    def tags(self):
+        # return the set of all tags in this document
+        return set(self.tag_bits)
+
+    
+    def query(self, query_string):
+        """Given a query string, returns the lines of text that match the specified query."""
+
+        snippet_lines = self.query_lines(query_string)
+
+        if not snippet_lines:
+            return None
+
+        return "\n".join(snippet_lines)
+
+    def query_lines(self, query_string):
+        """Returns the list of lines that match the specified query, dedented
+        the same way textwrap.dedent would dedent them: lines that are only
+        whitespace become empty, and the indent common to the rest is
+        removed."""
+
+        assert isinstance(query_string, str)
+
+        indices = self.matching_indices(query_string)
+
+        # the indents were stored when parsing, so neither finding the
+        # margin nor removing it needs to look for whitespace again
+        margin = len(self.margin(indices))
+
+        lines = self.lines
+        indents = self.indents
+
+        snippet_lines = []
+
+        for index in indices:
+            text = lines[index].text
+
+            if len(indents[index]) == len(text):
+                snippet_lines.append("")
+            else:
+                snippet_lines.append(text[margin:])
+
+        return snippet_lines
+
+    def matching_indices(self, query_string):
+        """Returns the indices in self.lines of the lines that match the
+        specified query, as a tuple."""
+
+        key = TagQuery.normalise(query_string)
+
+        try:
+            return self.matches[key]
+        except KeyError:
+            pass
+
+        (include, exclude, isolate) = TagQuery.parse(key).masks(self.tag_bits, self.expand)
+
+        # a line is included if its innermost tag is being isolated, or if
+        # it has tags that we want and none of the tags we don't; every
+        # line in the same stack of tags gets the same answer
+        matching_stacks = [
+            bool(innermost & isolate or (mask & include and not mask & exclude))
+                for (mask, innermost) in self.stacks
+            ]
+
+        if any(matching_stacks):
+            indices = tuple(index for (index, stack_id) in enumerate(self.stack_ids) if matching_stacks[stack_id])
+        else:
+            indices = ()
+
+        self.matches[key] = indices
+
+        return indices
+
+    def expand(self, pattern):
+        """Returns the tags in this version that the wildcard tag 'pattern'
+        (eg "input_*") matches, as a tuple."""
+
+        try:
+            return self.expansions[pattern]
+        except KeyError:
+            pass
+
+        if self.sorted_tags is None:
+            self.sorted_tags = sorted(self.tag_bits)
+
+        tags = self.expansions[pattern] = tuple(TagPattern.parse(pattern).expand(self.sorted_tags))
+
+        return tags
+
+    def margin(self, indices):
+        """Returns the leading whitespace that textwrap.dedent would remove
+        from the lines at 'indices' (ie, the longest common prefix of the
+        indents of the lines that aren't blank)."""
+
+        return os.path.commonprefix([
+            self.indents[index] for index in indices
+                if len(self.indents[index]) != len(self.lines[index].text)
+            ])
+
+    def parse_lines(self, data, parsed=None):
+        """Fills in this version's lines and indexes from 'data'. If
+        'parsed' is given, it's what parse_tagged_data returned for 'data'
+        (eg in another process), and it's used instead of parsing again."""
+
+        assert isinstance(data, str)
+
+        if parsed is None:
+            parsed = parse_tagged_data(self.path, data)
+
+        (line_numbers, stack_ids, stack_tags, widths, indent_lengths, tag_ranges, warnings) = parsed
+
+        for warning in warnings:
+            logging.warn(warning)
+
+        for stack in stack_tags:
+            mask = 0
+            for tag in stack:
+                mask |= self.tag_bits.setdefault(tag, 1 << len(self.tag_bits))
+
+            self.stacks.append((mask, self.tag_bits[stack[-1]]))
+
+        texts = data.split("\n")
+        path = self.path
+        lines = self.lines
+        indents = self.indents
+
+        for (line_number, stack_id, indent_length) in zip(line_numbers, stack_ids, indent_lengths):
+            text = texts[line_number]
+            lines.append(TaggedLine(path, line_number, text, list(stack_tags[stack_id])))
+            indents.append(text[:indent_length])
+
+        self.stack_ids = stack_ids
+        self.widths = widths
+        self.tag_ranges = tag_ranges
+
+    def lines_over_limit(self, limit, query_string=None):
+        """Returns a list of (TaggedLine, width) tuples for the lines that
+        are wider than 'limit' columns. If 'query_string' is given, only
+        the lines it selects are checked, at the width they'll have after
+        being dedented in the rendered snippet."""
+
+        return [(self.lines[index], width) for (index, width) in self.indices_over_limit(limit, query_string)]
+
+    def indices_over_limit(self, limit, query_string=None):
+        """Like lines_over_limit(), but returns (index in self.lines, width)
+        tuples."""
+
+        if query_string is None:
+            indices = range(len(self.lines))
+            margin = ""
+        else:
+            indices = self.matching_indices(query_string)
+            margin = self.margin(indices)
+
+        # dedenting can only make a line narrower, so the width we worked
+        # out when parsing rules out almost every line without having to
+        # look at its text
+        widths = self.widths
+        candidates = [index for index in indices if widths[index] > limit]
+
+        over_limit = []
+
+        for index in candidates:
+            # lines that are only whitespace are rendered empty
+            if len(self.indents[index]) == len(self.lines[index].text):
+                continue
+
+            width = display_width(self.lines[index].text[len(margin):]) if margin else widths[index]
+
+            if width > limit:
+                over_limit.append((index, width))
+
+        return over_limit
+
+    
+class TaggedLine(object):
+    """A line in a document, with its associated tags."""
+    def __init__(self, source_name, line_number, text, tags):
+
+        assert isinstance(source_name, str)
+        assert isinstance(line_number, int)
+        assert isinstance(text, str)
+        assert isinstance(tags, list)
+
+        assert tags, "Expected a non-empty list of tags when creating a TaggedLine"
+
+        self.source_name = source_name
+        self.line_number = line_number
+        self.text = text
+        self.tags = tags
+
+# the most queries, and the most patterns, that are kept parsed; a daemon
+# that runs for days sees queries come and go, so the least recently used
+# ones are forgotten
+MAX_PARSED = 4096
+
+# maps normalised query strings to TagQuery objects, least recently used
+# first; see TagQuery.parse
+PARSED_QUERIES = OrderedDict()
+
+# maps wildcard tags to TagPattern objects, least recently used first; see
+# TagPattern.parse
+PARSED_PATTERNS = OrderedDict()
+
+def parsed(cache, key, parse):
+    """Returns the object for 'key' in 'cache' (PARSED_QUERIES or
+    PARSED_PATTERNS), making it with 'parse' if it isn't there, and
+    forgetting the least recently used one if the cache is full."""
+
+    try:
+        value = cache.pop(key)
+    except KeyError:
+        value = parse(key)
+
+        if len(cache) >= MAX_PARSED:
+            cache.popitem(last=False)
+
+    cache[key] = value
+
+    return value
+
+INCLUDE_TAGS = 0
+EXCLUDE_TAGS = 1
+HIGHLIGHT_TAGS = 2
+ISOLATE_TAGS = 3
+
+class TagQuery(object):
+    """Represents a query for a specific set of tags."""
+    def __init__(self, query_string, ref="HEAD"):
+
+        assert isinstance(query_string, str)
+        tokens = query_string.split(" ")
+
+        mode = INCLUDE_TAGS
+        
+        # The context at which we 
+        self.query_string = query_string 
+        self.ref = ref 
+
+        # The specific tags this query deals with
+        self.include = []
+        self.exclude = []
+        self.highlight = []
+        self.isolate = []
+        
+        
+        # Interpret the list of tokens
+        for token in tokens:
+            
+            # Change mode if we have to
+            if token.lower() == "except":
+                mode = EXCLUDE_TAGS
+            elif token.lower() == "highlighting":
+                mode = HIGHLIGHT_TAGS
+            elif token.lower() == "isolating":
+                mode = ISOLATE_TAGS
+            
+            # Otherwise, add it to the list of tokens
+            else:
+                if mode == INCLUDE_TAGS:
+                    self.include.append(token)
+                elif mode == EXCLUDE_TAGS:
+                    self.exclude.append(token)
+                elif mode == HIGHLIGHT_TAGS:
+                    self.highlight.append(token)
+                elif mode == ISOLATE_TAGS:
+                    self.isolate.append(token)
+        
+        logging.debug("Query includes tags %s", self.include)
+    
+    @staticmethod
+    def normalise(query_string):
+        """Returns 'query_string' without any extra spaces; queries that
+        differ only in spacing select the same lines."""
+        return " ".join(token for token in query_string.split(" ") if token)
+
+    @staticmethod
+    def parse(query_string):
+        """Returns a TagQuery for 'query_string', reusing the one made the
+        last time the same query was parsed."""
+        return parsed(PARSED_QUERIES, query_string, TagQuery)
+
+    def masks(self, tag_bits, expand=None):
+        """Returns a tuple of (include, exclude, isolate) masks for this
+        query, given 'tag_bits', which maps tags to their bits. Tags that
+        aren't in 'tag_bits' can't match anything, and are left out.
+        'expand' is a function that returns the tags in 'tag_bits' that a
+        wildcard tag matches; without it, wildcards are taken literally."""
+
+        def mask(tags):
+            bits = 0
+            for tag in tags:
+                if expand is not None and is_tag_pattern(tag):
+                    for expanded in expand(tag):
+                        bits |= tag_bits[expanded]
+                else:
+                    bits |= tag_bits.get(tag, 0)
+            return bits
+
+        return (mask(self.include), mask(self.exclude), mask(self.isolate))
+
+    @property
+    def cache_key(self):
+        """Returns a (ref, query) tuple that is the same for any two queries
+        that select the same lines, regardless of spacing."""
+        return (self.ref, TagQuery.normalise(self.query_string))
+
+    @property
+    def as_filename(self):
+        if self.ref in ("HEAD", WORKSPACE_REF):
+            return "{}.txt".format(self.query_string.replace(" ", "_"))
+        else:
+            return "{}_{}.txt".format(self.ref, self.query_string.replace(" ", "_"))
+
+    @property
+    def all_referenced_tags(self):
+        return set(self.include) |  set(self.exclude) |  set(self.highlight) | set(self.isolate)
+
+class TagPattern(object):
+    """A tag in a query that contains wildcards, and matches every tag that
+    fits it; eg "input_*" or "chapter3/*"."""
+
+    def __init__(self, pattern):
+        assert is_tag_pattern(pattern)
+
+        self.pattern = pattern
+
+        # everything before the first wildcard; only tags that start with
+        # this can match
+        self.prefix = pattern[:WILDCARD_RE.search(pattern).start()]
+
+        # a prefix followed by a single "*" matches every tag that starts
+        # with the prefix, so it doesn't need checking any further
+        if pattern == self.prefix + "*":
+            self.regex = None
+        else:
+            parts = [".*" if part == "*" else "." if part == "?" else re.escape(part) for part in re.split(r"([*?])", pattern)]
+            self.regex = re.compile("".join(parts) + r"\Z", flags=re.DOTALL)
+
+    @staticmethod
+    def parse(pattern):
+        """Returns a TagPattern for 'pattern', reusing the one made the last
+        time the same pattern was parsed."""
+        return parsed(PARSED_PATTERNS, pattern, TagPattern)
+
+    def matches(self, tag):
+        return tag.startswith(self.prefix) and (self.regex is None or self.regex.match(tag) is not None)
+
+    def expand(self, sorted_tags):
+        """Returns the tags in 'sorted_tags', a sorted list, that this
+        pattern matches. Only the range of tags that start with the
+        pattern's prefix is looked at, which is found by bisection."""
+
+        matched = []
+
+        for index in range(bisect.bisect_left(sorted_tags, self.prefix), len(sorted_tags)):
+            tag = sorted_tags[index]
+
+            if not tag.startswith(self.prefix):
+                break
+
+            if self.regex is None or self.regex.match(tag) is not None:
+                matched.append(tag)
+
+        return matched
+
+def is_tag_pattern(tag):
+    """Returns True if 'tag' contains wildcards."""
+    return WILDCARD_RE.search(tag) is not None
+
+def tags_matching(query_tags, tags):
+    """Returns the set of 'tags' that are named by any of 'query_tags',
+    which may include wildcard tags."""
+
+    matched = set(query_tags).intersection(tags)
+
+    patterns = [TagPattern.parse(tag) for tag in query_tags if is_tag_pattern(tag)]
+
+    if patterns:
+        sorted_tags = sorted(tags)
+
+        for pattern in patterns:
+            matched.update(pattern.expand(sorted_tags))
+
+    return matched
@@ -0,0 +1,108 @@
+import unittest
+import threading
+import json
+import os
+import shutil
+import tempfile
+
+from six.moves.urllib.request import urlopen
+
+from processor import Processor
+from daemon import RenderDaemon
+from test_tagged_document import create_test_repo, REPO_DIR
+
+class RenderDaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = create_test_repo()
+
+        self.book_dir = tempfile.mkdtemp()
+        shutil.copy("tests/sample.txt", self.book_dir)
+
+        processor = Processor(self.book_dir, self.repo.working_dir, tagged_extensions=["txt"], language="swift")
+
+        self.server = RenderDaemon(processor).server(0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        shutil.rmtree(self.book_dir)
+
+    def request(self, path):
+        url = "http://127.0.0.1:{}{}".format(self.server.server_address[1], path)
+        return json.loads(urlopen(url).read().decode("utf-8"))
+
+    def test_rendering(self):
+        response = self.request("/render?chapter=sample.txt")
+
+        self.assertEqual(response["output"], open("tests/sample-expanded.txt").read())
+
+    def test_resolving_and_invalidating(self):
+        response = self.request("/resolve?query=sourceB")
+
+        self.assertEqual(response["output"], "This file is not committed to the test repo.")
+
+        # change the file on disk, and make sure the change is picked up
+        with open(os.path.join(REPO_DIR, "sourceB.txt"), "w") as tagged:
+            tagged.write("// BEGIN sourceB\nChanged!\n// END sourceB\n")
+        os.utime(os.path.join(REPO_DIR, "sourceB.txt"), (0, 0))
+
+        response = self.request("/resolve?query=sourceB")
+
+        self.assertEqual(response["output"], "Changed!")
+
+    def test_refreshing(self):
+        processor = Processor(self.book_dir, self.repo.working_dir, tagged_extensions=["txt"], language="swift")
+        daemon = RenderDaemon(processor, refresh_interval=60)
+
+        self.assertEqual(daemon.handle("/resolve", {"query": ["sourceA"], "ref": ["later"]})["output"], "")
+
+        # a tag made after it was asked for is found
+        self.repo.create_tag("later", ref="sourceA-v1.txt")
+
+        self.assertTrue(processor.refresh())
+        self.assertEqual(daemon.handle("/resolve", {"query": ["sourceA"], "ref": ["later"]})["output"].split("\n")[0], "This is version 1 of source A.")
+
+        # the daemon only looks for changes once a minute, so this one
+        # isn't noticed yet
+        with open(os.path.join(REPO_DIR, "sourceB.txt"), "w") as tagged:
+            tagged.write("// BEGIN sourceB\nChanged!\n// END sourceB\n")
+        os.utime(os.path.join(REPO_DIR, "sourceB.txt"), (0, 0))
+
+        self.assertEqual(daemon.handle("/resolve", {"query": ["sourceB"]})["output"], "This file is not committed to the test repo.")
+
+        self.assertTrue(processor.refresh())
+        self.assertEqual(daemon.handle("/resolve", {"query": ["sourceB"]})["output"], "Changed!")
+
+    def test_refreshing_many_edits(self):
+        processor = Processor(self.book_dir, self.repo.working_dir, tagged_extensions=["txt"], language="swift")
+        daemon = RenderDaemon(processor)
+
+        source_a = [doc for doc in processor.tagged_documents if doc.path == "sourceA.txt"][0]
+
+        # every edit is saved and committed, so both the working copy and
+        # HEAD keep changing; old versions mustn't pile up
+        for number in range(10):
+            with open(os.path.join(REPO_DIR, "sourceA.txt"), "w") as tagged:
+                tagged.write("// BEGIN sourceA\nEdit {}.\n// END sourceA\n".format(number))
+            os.utime(os.path.join(REPO_DIR, "sourceA.txt"), (number, number))
+
+            self.assertTrue(processor.refresh())
+            self.assertEqual(daemon.handle("/resolve", {"query": ["sourceA"]})["output"], "Edit {}.".format(number))
+
+            self.repo.index.add(["sourceA.txt"])
+            self.repo.index.commit("Edit {}".format(number))
+
+            self.assertTrue(processor.refresh())
+            self.assertEqual(daemon.handle("/resolve", {"query": ["sourceA"], "ref": ["HEAD"]})["output"], "Edit {}.".format(number))
+
+            self.assertTrue(len(source_a.versions_by_blob) <= 2)
+
+    def test_listing_tags(self):
+        response = self.request("/tags?ref=sourceA-v1.txt")
+
+        self.assertEqual(response["tags"], ["sourceA"])
@@ -0,0 +1,99 @@
+import unittest
+import random
+
+import differential
+from differential import Case, reference_query, optimized_query, query_mismatches, render_mismatches, shrink, smaller_cases, shrink_query
+
+class DifferentialTests(unittest.TestCase):
+
+    def test_reference_queries(self):
+        data = "\n".join([
+            "// BEGIN alpha",
+            "    one",
+            "    // BEGIN beta",
+            "    two",
+            "    // END beta",
+            "// END alpha",
+            ])
+
+        self.assertEqual(reference_query(data, "alpha"), "one\ntwo")
+        self.assertEqual(reference_query(data, "alpha except beta"), "one")
+        self.assertEqual(reference_query(data, "isolating beta"), "two")
+        self.assertEqual(reference_query(data, "missing"), None)
+
+    def test_queries_match_the_reference(self):
+        for seed in range(5):
+            rng = random.Random(seed)
+            case = differential.random_case(rng)
+
+            self.assertEqual(query_mismatches(case, rng, 20), [])
+
+    def test_engines_match_the_reference(self):
+        case = Case(
+            [("v1", {"code.swift": "// BEGIN alpha\nold\n// END alpha\n"})],
+            {"code.swift": "// BEGIN alpha\nnew\n// END alpha\n"},
+            {"chapter.txt": "// snip: alpha\n\n// tag: v1\n\n// snip: alpha\n"},
+            {"language": None, "show_query": False, "as_inline_list_items": False},
+            )
+
+        engines = differential.engines_named(differential.EXACT_ENGINE_NAMES)
+
+        self.assertEqual(render_mismatches(case, engines), [])
+
+        # a mismatch is found when an engine renders something different
+        broken = differential.Engine("broken", language="ruby")
+
+        mismatches = render_mismatches(case, [engines[0], broken])
+
+        self.assertEqual([(name, chapter) for (name, chapter, expected, actual) in mismatches], [("broken", "chapter.txt")])
+
+    def test_blank_regions(self):
+        # a tag that only wraps a blank line is left out of snippets, as it
+        # always was
+        blank = "// BEGIN alpha\n    \n// END alpha\n"
+        code = "// BEGIN alpha\none\n// END alpha\n"
+
+        self.assertEqual(differential.baseline_render("// snip: alpha\n", lambda ref: [blank, code], show_query=False), ("// snip: alpha\n----\none\n----\n", True))
+        self.assertTrue("No code found" in differential.baseline_render("// snip: alpha\n", lambda ref: [blank], show_query=False)[0])
+
+        case = Case(
+            [("v1", {"blank.swift": blank, "code.swift": code})],
+            {"blank.swift": blank, "code.swift": code},
+            {"chapter.txt": "// snip: alpha\n"},
+            {"language": None, "show_query": False, "as_inline_list_items": False},
+            )
+
+        self.assertEqual(render_mismatches(case, differential.engines_named(differential.EXACT_ENGINE_NAMES)), [])
+
+    def test_shrinking_cases(self):
+        rng = random.Random(1)
+        case = differential.random_case(rng)
+
+        # pretend that anything containing this line fails
+        line = "// the bug"
+        path = sorted(case.working_copy)[0]
+        case.working_copy[path] += "\n" + line
+
+        fails = lambda candidate: any(line in text for text in candidate.working_copy.values())
+
+        shrunk = shrink(case, smaller_cases, fails)
+
+        self.assertEqual(shrunk.working_copy, {path: line})
+        self.assertEqual(shrunk.versions, [])
+        self.assertEqual(shrunk.chapters, {})
+
+    def test_shrinking_queries(self):
+        # an implementation that forgets about 'except'
+        def careless_query(data, query_string):
+            return reference_query(data, query_string.split(" except ")[0])
+
+        data = "\n".join(["// BEGIN alpha", "one", "// BEGIN beta", "two", "// END beta", "three", "// END alpha"])
+
+        (text, query) = shrink_query(data, "alpha gamma except beta", careless_query)
+
+        self.assertEqual(query, "alpha except beta")
+        # only the tags, and one line that's in beta, are needed
+        lines = text.split("\n")
+
+        self.assertEqual(lines[:2], ["// BEGIN alpha", "// BEGIN beta"])
+        self.assertEqual(len(lines), 3)
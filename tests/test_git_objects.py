@@ -0,0 +1,101 @@
+import unittest
+import os
+import shutil
+import git
+
+import git_objects
+from git_objects import GitPythonObjects, PackedObjects, apply_delta
+from tagged_document import TaggedDocument, RefResolver
+from test_tagged_document import create_test_repo, REPO_DIR
+
+class GitObjectsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = create_test_repo()
+
+        # add some history in a subdirectory, with versions that are
+        # similar enough for git to store them as deltas once packed
+        committer = git.Actor("Test Committer", "test@example.com")
+        os.mkdir(os.path.join(REPO_DIR, "nested"))
+
+        for version in range(5):
+            with open(os.path.join(REPO_DIR, "nested", "code.swift"), "w") as code:
+                code.write("".join("let value{} = {}\n".format(line, line * version) for line in range(200)))
+
+            self.repo.index.add([os.path.join("nested", "code.swift")])
+            self.repo.index.commit("Nested version {}".format(version), author=committer)
+
+    def tearDown(self):
+        shutil.rmtree(REPO_DIR)
+
+    def assertSourcesAgree(self, expected, actual):
+        commits = list(self.repo.iter_commits("--all"))
+        self.assertTrue(len(commits) > 5)
+
+        for commit in commits:
+            self.assertEqual(actual.tree_id(commit.hexsha), expected.tree_id(commit.hexsha))
+
+            paths = [item.path for item in commit.tree.traverse() if item.type == "blob"]
+
+            for path in paths:
+                blob = expected.find_blob(commit.hexsha, path)
+                self.assertEqual(actual.find_blob(commit.hexsha, path), blob)
+                self.assertEqual(actual.read_blob(blob), expected.read_blob(blob))
+
+            # directories and missing files aren't blobs
+            for path in ["nested", "missing.txt", "nested/missing.txt", "sourceA.txt/inside"]:
+                self.assertEqual(expected.find_blob(commit.hexsha, path), None)
+                self.assertEqual(actual.find_blob(commit.hexsha, path), None)
+
+    def test_loose_and_packed_objects(self):
+        expected = GitPythonObjects(self.repo)
+        native = PackedObjects(self.repo.git_dir)
+
+        self.assertEqual(native.packs, [])
+        self.assertSourcesAgree(expected, native)
+
+        # pack everything, with deltas; the native reader should notice the
+        # new pack, even though it was opened before it existed
+        self.repo.git.repack("-a", "-d", "-f", "--depth=50", "--window=250")
+        self.repo.git.prune_packed()
+
+        pack_dir = os.path.join(self.repo.git_dir, "objects", "pack")
+        self.assertTrue(any(name.endswith(".idx") for name in os.listdir(pack_dir)))
+
+        native.trees.clear()
+        self.assertSourcesAgree(expected, native)
+        self.assertEqual(len(native.packs), 1)
+
+        self.assertSourcesAgree(expected, PackedObjects(self.repo.git_dir))
+
+        native.close()
+        expected.close()
+
+    def test_documents_with_native_objects(self):
+        self.repo.git.repack("-a", "-d", "-f", "--depth=50", "--window=250")
+        self.repo.git.prune_packed()
+
+        resolver = RefResolver(self.repo, git_objects.object_source(self.repo, git_objects.NATIVE))
+        documents = [TaggedDocument(self.repo, path, resolver) for path in ["sourceA.txt", "nested/code.swift"]]
+
+        TaggedDocument.prewarm(documents, ["sourceA-v1.txt", "sourceA-v3.txt", "HEAD"], jobs=2)
+
+        reference = TaggedDocument(self.repo, "sourceA.txt")
+
+        for ref in ["sourceA-v1.txt", "sourceA-v2.txt", "sourceA-v3.txt"]:
+            self.assertEqual(documents[0][ref].data, reference[ref].data)
+
+        self.assertEqual(documents[1]["sourceA-v1.txt"], None)
+        self.assertEqual(documents[1]["HEAD"].data, TaggedDocument(self.repo, "nested/code.swift")["HEAD"].data)
+
+        self.assertRaises(ValueError, git_objects.object_source, self.repo, "svn")
+
+    def test_applying_deltas(self):
+        base = b"0123456789" * 10
+
+        # copy 10 bytes from offset 20, insert "abc", copy 5 bytes from 0
+        delta = bytearray([100, 18, 0x91, 20, 10, 3]) + b"abc" + bytearray([0x90, 5])
+
+        self.assertEqual(apply_delta(base, bytes(delta)), b"0123456789abc01234")
+
+        self.assertRaises(ValueError, apply_delta, base[:50], bytes(delta))
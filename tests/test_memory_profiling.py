@@ -0,0 +1,61 @@
+import unittest
+import shutil
+import tempfile
+import json
+import os
+from collections import OrderedDict
+
+from memory_profiling import MemoryProfiler, version_sizes
+from processor import Processor
+from source_document import WORKSPACE_REF
+from test_tagged_document import create_test_repo, REPO_DIR
+
+class MemoryProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = create_test_repo()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+        shutil.rmtree(REPO_DIR)
+
+    def test_writing_reports(self):
+        report_path = os.path.join(self.output_dir, "memory.json")
+
+        profiler = MemoryProfiler(report_path, top=2)
+
+        processor = Processor("tests", self.repo.working_dir, tagged_extensions=["txt"], profiler=profiler)
+        processor.source_documents = [doc for doc in processor.source_documents if doc.path.endswith("sample.txt")]
+
+        profiler.watch(processor)
+
+        processor.process(dry_run=True)
+
+        self.assertEqual(profiler.write(), [report_path])
+
+        with open(report_path) as report_file:
+            report = json.load(report_file, object_pairs_hook=OrderedDict)
+
+        self.assertEqual(list(report["phases"]), ["discovery", "parse", "history", "render"])
+        self.assertEqual(report["phases"]["render"]["entries"], 1)
+        self.assertTrue(report["peak"] > 0)
+
+        # sourceA.txt at sourceA-v2.txt and in the working copy, and
+        # sourceB.txt in the working copy
+        totals = report["totals"]
+        self.assertEqual(totals["versions"], 3)
+        self.assertEqual(totals["version_bytes"], sum(totals["version_" + field + "_bytes"] for field in ("text", "lines", "tags", "indexes")))
+        self.assertEqual(totals["source_documents"], 1)
+
+        self.assertEqual(sorted(report["refs"]), ["sourceA-v2.txt", WORKSPACE_REF])
+
+        largest = report["largest_versions"]
+        self.assertEqual(len(largest), 2)
+        self.assertTrue(largest[0]["bytes"] >= largest[1]["bytes"])
+
+        version = processor.tagged_documents[0][WORKSPACE_REF]
+        sizes = version_sizes(version)
+
+        self.assertEqual(list(sizes), ["text", "lines", "tags", "indexes"])
+        self.assertTrue(sizes["text"] >= len(version.data))
@@ -0,0 +1,46 @@
+import unittest
+import shutil
+import tempfile
+import os
+
+from output_writer import OutputWriter
+
+class OutputWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_writing_files(self):
+        writer = OutputWriter(jobs=2, fsync=True)
+
+        paths = [os.path.join(self.output_dir, "file{}.txt".format(i)) for i in range(10)]
+
+        for (i, path) in enumerate(paths):
+            writer.write(path, "contents {}\n".format(i))
+
+        self.assertEqual(writer.close(), [])
+
+        for (i, path) in enumerate(paths):
+            self.assertEqual(open(path).read(), "contents {}\n".format(i))
+
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.output_dir)), sorted(os.path.basename(path) for path in paths))
+
+    def test_reporting_errors(self):
+        writer = OutputWriter(jobs=2)
+
+        missing_dir = os.path.join(self.output_dir, "missing")
+
+        writer.write(os.path.join(missing_dir, "b.txt"), "b")
+        writer.write(os.path.join(self.output_dir, "ok.txt"), "ok")
+        writer.write(os.path.join(missing_dir, "a.txt"), "a")
+
+        errors = writer.close()
+
+        # errors come back sorted by path, regardless of which finished first
+        self.assertEqual([path for (path, error) in errors], [os.path.join(missing_dir, "a.txt"), os.path.join(missing_dir, "b.txt")])
+
+        self.assertEqual(open(os.path.join(self.output_dir, "ok.txt")).read(), "ok")
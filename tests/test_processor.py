@@ -1,10 +1,14 @@
 import unittest
-from processor import Processor
+from processor import Processor, load_profiles
 from source_document import SourceDocument
 from tagged_document import TaggedDocument
 from test_tagged_document import create_test_repo
 
 import os
+import json
+import zipfile
+import shutil
+import tempfile
 
 class ProcessorTests(unittest.TestCase):
 
@@ -29,13 +33,317 @@ class ProcessorTests(unittest.TestCase):
 
         self.assertEqual(reference_text, processed_text)
 
+    def test_extracting_archives(self):
+
+        new_repo = create_test_repo()
+
+        processor = Processor("tests", new_repo.working_dir, tagged_extensions=["txt"], language="swift")
+
+        processor.source_documents = [doc for doc in processor.source_documents if doc.path.endswith("sample.txt")]
+
+        manifest = processor.extract_snippet_archive("tests/snippets.zip")
+
+        # 'snip sourceA' and 'snip: sourceA' at the working copy are the same
+        # query, so they share a hash
+        self.assertEqual(len(manifest), 5)
+        self.assertEqual(manifest[0]["hash"], manifest[3]["hash"])
+        self.assertNotEqual(manifest[0]["hash"], manifest[2]["hash"])
+
+        with zipfile.ZipFile("tests/snippets.zip") as archive:
+            self.assertEqual(json.loads(archive.read("manifest.json").decode("utf-8")), manifest)
+
+            content = archive.read("snippets/{}.txt".format(manifest[1]["hash"])).decode("utf-8")
+            self.assertEqual(content, "This file is not committed to the test repo.")
+
+        processor.extract_snippet_archive("tests/snippets.jsonl")
+
+        with open("tests/snippets.jsonl") as archive:
+            records = [json.loads(line) for line in archive]
+
+        self.assertEqual([record["hash"] for record in records if record["type"] == "use"], [entry["hash"] for entry in manifest])
+
+    def test_incremental_processing(self):
+
+        new_repo = create_test_repo()
+
+        # commit everything, so that only the changes we make below count
+        new_repo.index.add(["sourceA.txt", "sourceB.txt"])
+        new_repo.index.commit("Committed everything")
+
+        book_dir = tempfile.mkdtemp()
+
+        try:
+            chapter_a = os.path.join(book_dir, "a.txt")
+            chapter_b = os.path.join(book_dir, "b.txt")
+
+            with open(chapter_a, "w") as chapter:
+                chapter.write("// snip: sourceA\n")
+            with open(chapter_b, "w") as chapter:
+                chapter.write("// snip: python-quotes\n")
+
+            state_path = os.path.join(book_dir, "state.json")
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"], language="swift")
+            processor.process(suffix=".out", state_path=state_path)
+
+            self.assertEqual(json.load(open(state_path))["chapters"][chapter_b]["documents"], ["sourceB.txt"])
+
+            # change the file that defines 'python-quotes'
+            with open(os.path.join(new_repo.working_dir, "sourceB.txt"), "a") as tagged:
+                tagged.write("# begin python-quotes\nA new line.\n# end python-quotes\n")
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"], language="swift", lazy=True)
+
+            plan = processor.plan_changes("HEAD", json.load(open(state_path)), suffix=".out")
+
+            self.assertEqual(list(plan), [chapter_b])
+            self.assertEqual([doc.path for doc in plan[chapter_b]], ["sourceB.txt"])
+
+            # the unaffected chapter's code file was never read
+            sourceA = [doc for doc in processor.tagged_documents if doc.path == "sourceA.txt"][0]
+            self.assertFalse("working-copy" in sourceA.versions)
+
+            processor.process(suffix=".out", since="HEAD", state_path=state_path)
+
+            self.assertTrue("A new line." in open(chapter_b + ".out").read())
+        finally:
+            shutil.rmtree(book_dir)
+
+    def test_incremental_processing_with_snip_files(self):
+
+        new_repo = create_test_repo()
+
+        with open(os.path.join(new_repo.working_dir, "notes.json"), "w") as notes:
+            notes.write('{"version": 1}\n')
+
+        new_repo.index.add(["sourceA.txt", "sourceB.txt", "notes.json"])
+        new_repo.index.commit("Committed everything")
+
+        book_dir = tempfile.mkdtemp()
+
+        try:
+            chapter = os.path.join(book_dir, "a.txt")
+
+            with open(chapter, "w") as chapter_file:
+                chapter_file.write("// snip-file: notes.json\n")
+
+            state_path = os.path.join(book_dir, "state.json")
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"], language="swift")
+
+            # if a chapter can't be written, the state isn't saved, so that
+            # it's rendered again next time
+            os.mkdir(chapter + ".out")
+
+            self.assertEqual([path for (path, error) in processor.process(suffix=".out", state_path=state_path)], [chapter + ".out"])
+            self.assertFalse(os.path.exists(state_path))
+
+            os.rmdir(chapter + ".out")
+
+            processor.process(suffix=".out", state_path=state_path)
+
+            self.assertEqual(json.load(open(state_path))["chapters"][chapter]["documents"], ["notes.json"])
+
+            with open(os.path.join(new_repo.working_dir, "notes.json"), "w") as notes:
+                notes.write('{"version": 2}\n')
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"], language="swift")
+
+            self.assertEqual(list(processor.plan_changes("HEAD", json.load(open(state_path)), suffix=".out")), [chapter])
+
+            processor.process(suffix=".out", since="HEAD", state_path=state_path)
+
+            self.assertTrue('{"version": 2}' in open(chapter + ".out").read())
+        finally:
+            shutil.rmtree(book_dir)
+
+    def test_processing_profiles(self):
+
+        new_repo = create_test_repo()
+
+        book_dir = tempfile.mkdtemp()
+
+        try:
+            for edition in ["print", "web"]:
+                os.mkdir(os.path.join(book_dir, edition))
+                shutil.copy("tests/sample.txt", os.path.join(book_dir, edition, "sample.txt"))
+
+            profiles_path = os.path.join(book_dir, "profiles.json")
+
+            with open(profiles_path, "w") as profiles_file:
+                json.dump([
+                    {"source_path": os.path.join(book_dir, "print"), "name": "print"},
+                    {"source_path": os.path.join(book_dir, "web"), "name": "web", "language": "csharp", "show_query": True, "suffix": ".web"},
+                    ], profiles_file)
+
+            processor = Processor("tests", new_repo.working_dir, tagged_extensions=["txt"], language="swift")
+
+            profiles = load_profiles(profiles_path, processor.profile(".print"))
+
+            self.assertEqual([(profile.language, profile.suffix) for profile in profiles], [("swift", ".print"), ("csharp", ".web")])
+
+            errors = processor.process_profiles(profiles)
+
+            self.assertEqual(errors, [])
+
+            reference_text = open("tests/sample-expanded.txt", "r").read()
+
+            self.assertEqual(open(os.path.join(book_dir, "print", "sample.txt.print")).read(), reference_text)
+
+            web_text = open(os.path.join(book_dir, "web", "sample.txt.web")).read()
+            self.assertTrue("[source,csharp]" in web_text)
+            self.assertTrue("// Snippet: 0-" in web_text)
+
+            # both editions have the same four distinct snippets, which
+            # were only rendered once
+            self.assertEqual(len(processor.render_cache), 4)
+
+            # both editions have a sample.txt, so their timings are told
+            # apart by edition
+            self.assertEqual([stats["key"] for stats in processor.chapter_stats.values()], ["print:sample.txt", "web:sample.txt"])
+        finally:
+            shutil.rmtree(book_dir)
+
+    def test_sparse_history(self):
+
+        new_repo = create_test_repo()
+
+        # a file that used to define a tag, but doesn't any more
+        other_path = os.path.join(new_repo.working_dir, "other.txt")
+
+        with open(other_path, "w") as other:
+            other.write("// BEGIN old\nold code\n// END old\n")
+
+        new_repo.index.add(["other.txt"])
+        new_repo.index.commit("Added other.txt")
+        new_repo.create_tag("with-other")
+
+        with open(other_path, "w") as other:
+            other.write("// BEGIN new\nnew code\n// END new\n")
+
+        book_dir = tempfile.mkdtemp()
+
+        try:
+            chapter_path = os.path.join(book_dir, "chapter.txt")
+
+            with open(chapter_path, "w") as chapter:
+                chapter.write("// tag: with-other\n// snip: sourceA\n\n// snip: old\n")
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"], sparse_history=True)
+
+            processor.prewarm()
+
+            documents = {doc.path: doc for doc in processor.tagged_documents}
+
+            # only the file that defines 'sourceA' now was loaded from
+            # history
+            self.assertTrue("with-other" in documents["sourceA.txt"].versions)
+            self.assertFalse("with-other" in documents["other.txt"].versions)
+
+            processor.process(suffix=".out")
+
+            rendered = open(chapter_path + ".out").read()
+
+            self.assertTrue("This is version 3 of source A." in rendered)
+
+            # 'old' wasn't where we expected, so every file was searched
+            self.assertTrue("old code" in rendered)
+        finally:
+            shutil.rmtree(book_dir)
+
+    def test_cleaning_without_code(self):
+
+        book_dir = tempfile.mkdtemp()
+
+        try:
+            expanded = open("tests/sample-expanded.txt").read()
+
+            for number in range(3):
+                with open(os.path.join(book_dir, "chapter{}.txt".format(number)), "w") as chapter:
+                    chapter.write(expanded)
+
+            with open(os.path.join(book_dir, "plain.txt"), "w") as chapter:
+                chapter.write("No snippets here.\n")
+
+            # there's no code repo at all
+            processor = Processor(book_dir, None, clean=True, jobs=4)
+
+            self.assertEqual(processor.repo, None)
+            self.assertEqual(processor.tagged_documents, [])
+
+            plain_time = os.path.getmtime(os.path.join(book_dir, "plain.txt"))
+
+            self.assertEqual(processor.process_profiles([processor.profile()]), [])
+
+            reference_text = open("tests/sample.txt").read()
+
+            for number in range(3):
+                self.assertEqual(open(os.path.join(book_dir, "chapter{}.txt".format(number))).read(), reference_text)
+
+            # chapters with nothing to clean aren't written
+            self.assertEqual(processor.chapter_stats[os.path.join(book_dir, "plain.txt")]["output"], None)
+            self.assertEqual(os.path.getmtime(os.path.join(book_dir, "plain.txt")), plain_time)
+        finally:
+            shutil.rmtree(book_dir)
+
+    def test_checking(self):
+
+        new_repo = create_test_repo()
+
+        book_dir = tempfile.mkdtemp()
+
+        try:
+            chapter_path = os.path.join(book_dir, "chapter.txt")
+
+            with open(chapter_path, "w") as chapter:
+                chapter.write("// snip: sourceA\n\n// snip: no-such-tag\n\n// snip-file: sourceB.txt\n\n// tag: sourceA-v1.txt\n// snip: sourceA\n")
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"])
+
+            report = processor.check(width_limit=25)
+
+            self.assertFalse(report["ok"])
+            self.assertEqual((report["chapters"], report["snippets"]), (1, 3))
+
+            self.assertEqual([(entry["line"], entry["query"]) for entry in report["missing_snippets"]], [(3, "no-such-tag")])
+            self.assertEqual(report["missing_files"], [])
+            self.assertEqual(report["duplicate_tags"], {})
+
+            # the overlong lines are exactly the ones rendering finds
+            processor.process(dry_run=True, width_limit=25)
+
+            self.assertEqual(len(report["width_report"]), 3)
+            self.assertEqual(report["width_report"], processor.width_report)
+
+            with open(chapter_path, "w") as chapter:
+                chapter.write("// snip: sourceA\n\n// snip-file: missing.txt\n")
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"])
+
+            report = processor.check(width_limit=100)
+
+            self.assertEqual([(entry["line"], entry["file"]) for entry in report["missing_files"]], [(3, "missing.txt")])
+            self.assertFalse(report["ok"])
+
+            with open(chapter_path, "w") as chapter:
+                chapter.write("// snip: sourceA\n")
+
+            processor = Processor(book_dir, new_repo.working_dir, tagged_extensions=["txt"])
+
+            self.assertTrue(processor.check(width_limit=100)["ok"])
+
+            # nothing was written
+            self.assertEqual(os.listdir(book_dir), ["chapter.txt"])
+        finally:
+            shutil.rmtree(book_dir)
+
     def tearDown(self):
         # remove the processed file, if it exists
 
-        path = "tests/sample.txt.processed"
+        for path in ["tests/sample.txt.processed", "tests/snippets.zip", "tests/snippets.jsonl"]:
 
-        if os.path.isfile(path):
-            os.remove(path)
+            if os.path.isfile(path):
+                os.remove(path)
 
 
 
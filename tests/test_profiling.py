@@ -0,0 +1,36 @@
+import unittest
+import shutil
+import tempfile
+import os
+
+from profiling import PhaseProfiler
+
+class PhaseProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_writing_profiles(self):
+        profiler = PhaseProfiler(os.path.join(self.output_dir, "run.prof"), sample_interval=0.0001)
+
+        with profiler.phase("parse"):
+            sum(i * i for i in range(100000))
+
+        with profiler.phase("render"):
+            sorted(str(i) for i in range(100000))
+
+        written = [os.path.basename(path) for path in profiler.write()]
+
+        self.assertEqual(written, ["run-parse.prof", "run-render.prof", "run.prof", "run.collapsed"])
+
+        # every sampled stack is rooted at the phase it was taken in
+        with open(os.path.join(self.output_dir, "run.collapsed")) as collapsed_file:
+            stacks = collapsed_file.read().splitlines()
+
+        self.assertTrue(stacks)
+
+        for stack in stacks:
+            self.assertTrue(stack.split(";")[0] in ("parse", "render"))
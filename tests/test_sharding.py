@@ -0,0 +1,126 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+import sharding
+from processor import Processor
+from source_document import SourceDocument
+from test_tagged_document import create_test_repo
+
+class ShardingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.book_dir = tempfile.mkdtemp()
+
+        # chapters of very different sizes, which all use the same snippet
+        for (number, paragraphs) in enumerate([1, 2, 3, 20, 1, 1]):
+            with open(os.path.join(self.book_dir, "chapter{}.txt".format(number)), "w") as chapter:
+                chapter.write("Some text.\n\n" * paragraphs + "// snip: sourceA\n")
+
+        self.documents = SourceDocument.find(self.book_dir, ["txt"])
+
+    def tearDown(self):
+        shutil.rmtree(self.book_dir)
+
+    def test_parsing_shards(self):
+        self.assertEqual(sharding.parse_shard("2/4"), (2, 4))
+
+        for text in ["0/4", "5/4", "1/0", "two/four", "1"]:
+            self.assertRaises(ValueError, sharding.parse_shard, text)
+
+    def test_planning_shards(self):
+
+        def paths(shards):
+            return [sorted(document.path for document in shard) for shard in shards]
+
+        by_hash = sharding.plan_shards(self.documents, self.book_dir, 3)
+
+        # every chapter is in exactly one shard, and the plan doesn't
+        # depend on where the book is
+        self.assertEqual(sorted(sum(paths(by_hash), [])), sorted(document.path for document in self.documents))
+
+        moved_dir = self.book_dir + "-moved"
+        shutil.copytree(self.book_dir, moved_dir)
+        try:
+            moved = sharding.plan_shards(SourceDocument.find(moved_dir, ["txt"]), moved_dir, 3)
+            self.assertEqual([[os.path.basename(path) for path in shard] for shard in paths(moved)], [[os.path.basename(path) for path in shard] for shard in paths(by_hash)])
+        finally:
+            shutil.rmtree(moved_dir)
+
+        # with timings from a previous run, the slow chapter gets a shard
+        # to itself
+        stats = {"chapter0.txt": 1.0, "chapter1.txt": 1.0, "chapter2.txt": 1.0, "chapter3.txt": 5.0}
+
+        balanced = paths(sharding.plan_shards(self.documents, self.book_dir, 2, stats))
+
+        self.assertTrue([os.path.join(self.book_dir, "chapter3.txt")] in balanced)
+
+        # with several editions, only the timings of this one are used
+        stats = {}
+        for number in range(6):
+            stats["print:chapter{}.txt".format(number)] = 5.0 if number == 0 else 1.0
+            stats["web:chapter{}.txt".format(number)] = 5.0 if number == 3 else 1.0
+
+        balanced = paths(sharding.plan_shards(self.documents, self.book_dir, 2, stats, "print"))
+
+        self.assertTrue([os.path.join(self.book_dir, "chapter0.txt")] in balanced)
+
+    def test_non_ascii_paths(self):
+        # "cafe.txt" with an acute accent, in UTF-8
+        name = "caf\xc3\xa9.txt"
+
+        with open(os.path.join(self.book_dir, name), "w") as chapter:
+            chapter.write("// snip: sourceA\n")
+
+        documents = SourceDocument.find(self.book_dir, ["txt"])
+
+        by_hash = sharding.plan_shards(documents, self.book_dir, 3)
+
+        self.assertEqual(sorted(document.path for shard in by_hash for document in shard), sorted(document.path for document in documents))
+
+        # timings for it are found again after a round trip through a
+        # manifest
+        manifest_path = os.path.join(self.book_dir, "manifest.json")
+        chapters = [{"key": "chapter{}.txt".format(number), "seconds": 1.0} for number in range(6)]
+        sharding.write_manifest(manifest_path, {"chapters": chapters + [{"key": name, "seconds": 50.0}]})
+
+        stats = sharding.load_stats(manifest_path)
+
+        self.assertEqual(stats[name], 50.0)
+
+        balanced = sharding.plan_shards(documents, self.book_dir, 2, stats)
+
+        self.assertTrue([os.path.join(self.book_dir, name)] in [[document.path for document in shard] for shard in balanced])
+
+    def test_merging_manifests(self):
+
+        repo = create_test_repo()
+
+        manifest_paths = []
+
+        for index in [1, 2]:
+            processor = Processor(self.book_dir, repo.working_dir, tagged_extensions=["txt"], language="swift")
+            processor.source_documents = sharding.select_shard(processor.source_documents, self.book_dir, index, 2)
+
+            processor.process(dry_run=True, width_limit=60)
+
+            manifest_paths.append(os.path.join(self.book_dir, "shard{}.json".format(index)))
+            sharding.write_manifest(manifest_paths[-1], sharding.build_manifest(processor, (index, 2)))
+
+        merged_path = os.path.join(self.book_dir, "merged.json")
+
+        manifest = sharding.merge(manifest_paths, merged_path)
+
+        self.assertEqual(manifest["shards"], 2)
+        self.assertEqual(len(manifest["chapters"]), 6)
+
+        # one overlong line per chapter, sorted by chapter
+        self.assertEqual([entry["chapter"] for entry in manifest["width_report"]], sorted(document.path for document in self.documents))
+
+        # the merged manifest can balance the next build
+        self.assertEqual(sorted(sharding.load_stats(merged_path)), ["chapter{}.txt".format(number) for number in range(6)])
+
+        # a missing shard is an error
+        self.assertRaises(ValueError, sharding.merge, manifest_paths[:1])
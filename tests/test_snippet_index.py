@@ -0,0 +1,142 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from processor import Processor
+from snippet_index import SnippetIndex, write_index
+from source_document import WORKSPACE_REF
+from tagged_document import TaggedDocument, RefResolver
+from test_tagged_document import create_test_repo, REPO_DIR
+
+class SnippetIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = create_test_repo()
+
+        self.index_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.index_dir, "snippets.idx")
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+        if os.path.isdir(REPO_DIR):
+            shutil.rmtree(REPO_DIR)
+
+        if os.path.isfile("tests/sample.txt.processed"):
+            os.remove("tests/sample.txt.processed")
+
+    def test_reading_and_writing(self):
+        resolver = RefResolver(self.repo)
+        documents = [TaggedDocument(self.repo, path, resolver) for path in ["sourceA.txt", "sourceB.txt"]]
+
+        refs = [WORKSPACE_REF, "HEAD", "sourceA-v1.txt", "sourceA-v2.txt", "sourceA-v3.txt"]
+        commits = dict((ref, resolver.commit(ref)) for ref in refs if ref != WORKSPACE_REF)
+
+        # HEAD and sourceA-v3.txt are the same version, so it's only stored
+        # once; sourceB.txt only exists in the working copy
+        self.assertEqual(write_index(self.index_path, documents, refs, commits, self.repo.working_dir), 5)
+
+        index = SnippetIndex(self.index_path)
+
+        self.assertEqual(index.root, self.repo.working_dir)
+        self.assertEqual([doc.path for doc in index.documents], ["sourceA.txt", "sourceB.txt"])
+
+        for (expected, actual) in zip(documents, index.documents):
+            for ref in refs:
+                self.assertEqual(index.commit(ref), commits.get(ref))
+
+                if expected[ref] is None:
+                    self.assertEqual(actual[ref], None)
+                    continue
+
+                self.assertEqual(actual[ref].data, expected[ref].data)
+                self.assertEqual(actual[ref].tags, expected[ref].tags)
+                self.assertEqual(actual[ref].tag_ranges, expected[ref].tag_ranges)
+                self.assertEqual(list(actual[ref].widths), list(expected[ref].widths))
+                self.assertEqual(list(actual[ref].stack_ids), list(expected[ref].stack_ids))
+                self.assertEqual(actual[ref].indents, expected[ref].indents)
+                self.assertEqual(
+                    [(line.line_number, line.text, line.tags) for line in actual[ref].lines],
+                    [(line.line_number, line.text, line.tags) for line in expected[ref].lines])
+
+                for query in ["sourceA", "sourceB", "sourceA except python-quotes", "python-*"]:
+                    self.assertEqual(actual[ref].query(query), expected[ref].query(query))
+
+            self.assertEqual(actual.known_tags, expected.known_tags)
+
+        self.assertTrue(index.documents[0]["HEAD"] is index.documents[0]["sourceA-v3.txt"])
+
+        # refs that weren't indexed don't exist
+        self.assertEqual(index.documents[0]["sourceA-v4.txt"], None)
+        self.assertEqual(index.commit("sourceA-v4.txt"), None)
+
+        index.close()
+
+        with open(self.index_path, "wb") as index_file:
+            index_file.write(b"not an index" * 10)
+
+        self.assertRaises(ValueError, SnippetIndex, self.index_path)
+
+    def test_processing_from_index(self):
+        processor = Processor("tests", self.repo.working_dir, tagged_extensions=["txt"], language="swift")
+        processor.build_index(self.index_path)
+
+        # the code repo isn't needed any more
+        shutil.rmtree(REPO_DIR)
+
+        processor = Processor("tests", None, tagged_extensions=["txt"], language="swift", index_path=self.index_path)
+
+        self.assertEqual(processor.repo, None)
+        self.assertFalse(processor.refresh())
+
+        processor.source_documents = [doc for doc in processor.source_documents if doc.path.endswith("sample.txt")]
+
+        processor.process(suffix=".processed")
+
+        reference_text = open("tests/sample-expanded.txt", "r").read()
+
+        processed_text = open("tests/sample.txt.processed").read()
+
+        self.assertEqual(reference_text, processed_text)
+
+        processor.index.close()
+
+    def test_snip_files_from_index(self):
+        with open(os.path.join(REPO_DIR, "notes.json"), "w") as notes:
+            notes.write('{"version": 1}\n')
+
+        book_dir = tempfile.mkdtemp()
+
+        try:
+            chapter = os.path.join(book_dir, "chapter.txt")
+
+            with open(chapter, "w") as chapter_file:
+                chapter_file.write("// snip-file: notes.json\n")
+
+            Processor(book_dir, self.repo.working_dir, tagged_extensions=["txt"]).build_index(self.index_path)
+
+            # the code repo isn't needed for snip-files either
+            shutil.rmtree(REPO_DIR)
+
+            processor = Processor(book_dir, None, tagged_extensions=["txt"], index_path=self.index_path)
+
+            self.assertTrue(processor.check()["ok"])
+
+            processor.process(suffix=".out")
+
+            self.assertTrue(open(chapter + ".out").read().startswith('// snip-file: notes.json\n----\n{"version": 1}\n\n----\n'))
+
+            processor.index.close()
+
+            # files that weren't included when the index was built are missing
+            with open(chapter, "w") as chapter_file:
+                chapter_file.write("// snip-file: other.json\n")
+
+            processor = Processor(book_dir, None, tagged_extensions=["txt"], index_path=self.index_path)
+
+            self.assertEqual([entry["file"] for entry in processor.check()["missing_files"]], ["other.json"])
+
+            processor.index.close()
+        finally:
+            shutil.rmtree(book_dir)
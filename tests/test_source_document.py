@@ -1,5 +1,5 @@
 import unittest
-from source_document import SourceDocument
+from source_document import SourceDocument, CollapsedLines
 from test_tagged_document import create_test_repo
 from tagged_document import TaggedDocument
 
@@ -23,6 +23,25 @@ class SourceDocumentTests(unittest.TestCase):
 
         self.assertTrue(len(found_documents) == 7)
 
+    def test_directives(self):
+
+        document = SourceDocument("tests/sample.txt")
+
+        snippets = [(directive.line_number, directive.ref, directive.argument.strip()) for directive in document.directives]
+
+        self.assertEqual(snippets, [
+            (3, "working-copy", "sourceA"),
+            (7, "working-copy", "sourceB"),
+            (12, "sourceA-v2.txt", "sourceA"),
+            (17, "working-copy", "sourceA"),
+            (23, "working-copy", "python-quotes"),
+            ])
+
+    def test_refs_used(self):
+
+        document = SourceDocument("tests/sample.txt")
+
+        self.assertEqual(document.refs_used, {"sourceA-v2.txt", "working-copy"})
 
 
     def test_processing(self):
@@ -43,7 +62,79 @@ class SourceDocumentTests(unittest.TestCase):
 
         self.assertEqual(rendered_output, (reference_text, True))
 
+    def test_width_report(self):
+        # Tests checking the width of rendered lines
+        repo = create_test_repo()
+
+        tagged_documents = TaggedDocument.find(repo, ["txt"])
+
+        reference_text = open("tests/sample-expanded.txt", "r").read()
+
+        source = SourceDocument("tests/sample.txt")
+
+        render_cache = {}
+        width_report = []
+
+        rendered_output = source.render(tagged_documents, language="swift", show_query=False, render_cache=render_cache, width_limit=60, width_report=width_report)
+
+        self.assertEqual(rendered_output, (reference_text, True))
+
+        # both 'sourceA' snippets in the working copy share a cache entry
+        self.assertEqual(len(render_cache), 4)
+
+        # only the first line of version 4 is too long, and it's reported
+        # for each chapter line that uses it
+        self.assertEqual([(entry["line"], entry["snippet"], entry["offset"], entry["file"], entry["width"]) for entry in width_report], [
+            (3, 0, 1, "sourceA.txt", 90),
+            (17, 3, 1, "sourceA.txt", 90),
+            ])
+
+    def test_blank_snippets(self):
+        # Tests that a document whose only matching line is blank doesn't
+        # contribute to a snippet
+        import os
+        from test_tagged_document import REPO_DIR
+
+        repo = create_test_repo()
+
+        with open(os.path.join(REPO_DIR, "blank.txt"), "w") as tagged:
+            tagged.write("// BEGIN sourceB\n    \n// END sourceB\n// BEGIN blank\n\n// END blank\n")
+
+        tagged_documents = TaggedDocument.find(repo, ["txt"])
+
+        used_documents = set()
+
+        source = SourceDocument("tests/sample.txt")
+        rendered_output = source.render(tagged_documents, language="swift", show_query=False, used_documents=used_documents)
+
+        self.assertEqual(rendered_output, (open("tests/sample-expanded.txt").read(), True))
+        self.assertFalse("blank.txt" in used_documents)
+
+        # a query that only matches blank lines finds no code
+        (lines, paths, long_lines) = SourceDocument.render_query("blank", "working-copy", tagged_documents)
+
+        self.assertEqual((lines, paths), ([], []))
+
+        # but several blank lines do
+        with open(os.path.join(REPO_DIR, "blank.txt"), "w") as tagged:
+            tagged.write("// BEGIN blank\n\n  \n// END blank\n")
+
+        tagged_documents = TaggedDocument.find(repo, ["txt"])
+
+        (lines, paths, long_lines) = SourceDocument.render_query("blank", "working-copy", tagged_documents)
+
+        self.assertEqual((lines, paths), (["", ""], ["blank.txt"]))
+
+    def test_collapsing_lines(self):
+        # Tests that chains of empty lines collapse the same way the
+        # regular expression they replace does
+        import re
+
+        empty_lines = re.compile(r"(\s*?\n){2,}")
 
+        for lines in [[], [""], ["", "", "", "a"], ["a", "  ", "", "\tb", "c"], ["a  ", "\t", "b"], ["a", " ", " "], ["a", "", "b\n\n\nc"]]:
+            collapsed = CollapsedLines()
+            collapsed.extend(lines)
 
-        
+            self.assertEqual(collapsed.text(), re.sub(empty_lines, "\n\n", "\n".join(lines)))
 
@@ -2,8 +2,11 @@ import unittest
 import shutil
 import os
 import git
+import time
 
-from tagged_document import TaggedDocument
+from tagged_document import TaggedDocument, RefResolver, TagQuery, TagPattern, VersionCache, tags_matching
+from git_objects import GitPythonObjects
+import tagged_version
 
 dir_path = os.getcwd()
 
@@ -132,4 +135,221 @@ class SourceDocumentTests(unittest.TestCase):
         reference_text = "This is version 3 of source A."
 
         self.assertEqual(tagged_text, reference_text)
-        
\ No newline at end of file
+        
+    def test_compiled_queries(self):
+        version = TaggedDocument(self.repo, "sourceA.txt")["HEAD"]
+
+        # two lines, in two different stacks of tags
+        self.assertEqual(list(version.stack_ids), [0, 1])
+        self.assertEqual(version.stacks, [(1, 1), (3, 2)])
+
+        self.assertEqual(TagQuery.parse("sourceA except sourceA-1").masks(version.tag_bits), (1, 2, 0))
+
+        # queries that differ only in spacing share their results
+        self.assertEqual(version.matching_indices(" sourceA  except sourceA-1"), (0,))
+        self.assertEqual(list(version.matches), ["sourceA except sourceA-1"])
+
+        self.assertEqual(version.matching_indices("no-such-tag"), ())
+
+    def test_parsed_query_cache(self):
+        max_parsed = tagged_version.MAX_PARSED
+        tagged_version.MAX_PARSED = 2
+
+        try:
+            tagged_version.PARSED_QUERIES.clear()
+
+            first = TagQuery.parse("first")
+            TagQuery.parse("second")
+
+            # using 'first' again makes 'second' the least recently used
+            self.assertTrue(TagQuery.parse("first") is first)
+
+            TagQuery.parse("third")
+
+            self.assertEqual(list(tagged_version.PARSED_QUERIES), ["first", "third"])
+        finally:
+            tagged_version.MAX_PARSED = max_parsed
+
+    def test_wildcard_queries(self):
+        with open(os.path.join(REPO_DIR, "inputs.txt"), "w") as inputs:
+            inputs.write("\n".join([
+                "// BEGIN input_name", "name", "// END input_name",
+                "// BEGIN input_age", "age",
+                "// BEGIN input_age_debug", "debug", "// END input_age_debug",
+                "// END input_age",
+                "// BEGIN output", "output", "// END output",
+                "// BEGIN chapter3/setup", "setup", "// END chapter3/setup",
+                ]))
+
+        version = TaggedDocument(self.repo, "inputs.txt")["working-copy"]
+
+        self.assertEqual(version.query("input_*"), "name\nage\ndebug")
+        self.assertEqual(version.query("input_* except *_debug"), "name\nage")
+        self.assertEqual(version.query("isolating input_a?e"), "age")
+        self.assertEqual(version.query("output chapter3/*"), "output\nsetup")
+        self.assertEqual(version.query("missing_*"), None)
+
+        # expansions are looked up once, and remembered
+        self.assertEqual(version.expansions["input_*"], ("input_age", "input_age_debug", "input_name"))
+        self.assertEqual(version.expand("*"), tuple(sorted(version.tag_bits)))
+
+        pattern = TagPattern.parse("input_*_debug")
+        self.assertTrue(pattern is TagPattern.parse("input_*_debug"))
+        self.assertEqual(pattern.prefix, "input_")
+        self.assertEqual(pattern.expand(["input_", "input__debug", "input_age_debug", "input_debug", "inputs_debug"]), ["input__debug", "input_age_debug"])
+
+        self.assertEqual(tags_matching(["input_*", "output"], ["input_age", "output", "chapter3/setup"]), {"input_age", "output"})
+
+    def test_loading_working_copies_in_parallel(self):
+        for number in range(5):
+            with open(os.path.join(REPO_DIR, "extra{}.txt".format(number)), "w") as extra:
+                extra.write("// BEGIN extra\n\tline {}\r\n// BEGIN inner\n  inner\n// END extra\n".format(number))
+
+        paths = TaggedDocument.find_paths(self.repo, ["txt"]) + ["missing.txt"]
+
+        sequential = [TaggedDocument(self.repo, path) for path in paths]
+        TaggedDocument.load_working_copies(sequential, jobs=1)
+
+        parallel = [TaggedDocument(self.repo, path) for path in paths]
+        TaggedDocument.load_working_copies(parallel, jobs=2, processes=2, chunk_size=2)
+
+        def summary(document):
+            version = document["working-copy"]
+            if version is None:
+                return None
+            return ([(line.line_number, line.text, line.tags) for line in version.lines], list(version.widths), version.indents, version.stacks, version.tag_ranges)
+
+        self.assertEqual([summary(document) for document in parallel], [summary(document) for document in sequential])
+
+        self.assertEqual(summary(parallel[-1]), None)
+        self.assertEqual(summary(parallel[paths.index("extra0.txt")])[0], [(1, "\tline 0", ["extra"]), (3, "  inner", ["extra", "inner"]), (5, "", ["inner"])])
+
+    def test_version_cache(self):
+        cache = VersionCache(2)
+
+        document = TaggedDocument(self.repo, "sourceA.txt", cache=cache)
+
+        for ref in ["sourceA-v1.txt", "sourceA-v2.txt", "sourceA-v1.txt", "sourceA-v3.txt"]:
+            document[ref]
+
+        # v2 was the least recently used
+        self.assertEqual(sorted(document.versions), ["sourceA-v1.txt", "sourceA-v3.txt"])
+        self.assertEqual(len(document.versions_by_blob), 2)
+
+        # versions at refs that are still to come are kept in preference
+        cache.future_refs = {"sourceA-v1.txt"}
+
+        document["sourceA-v2.txt"]
+
+        self.assertEqual(sorted(document.versions), ["sourceA-v1.txt", "sourceA-v2.txt"])
+        self.assertEqual(cache.evictions, 2)
+
+        # and forgotten versions are loaded again when they're needed
+        self.assertEqual(document["sourceA-v3.txt"].query("sourceA").split("\n")[0], "This is version 3 of source A.")
+
+    def test_prewarming_with_version_cache(self):
+        # reading blobs is slowed down, so that the worker that looks for v1
+        # finds it already loaded, and then loading v2 pushes it out of the
+        # cache before its turn comes
+        class SlowObjects(GitPythonObjects):
+            def read_blob(self, blob):
+                time.sleep(0.2)
+                return GitPythonObjects.read_blob(self, blob)
+
+            def for_thread(self):
+                return SlowObjects(git.Repo(self.repo.working_dir))
+
+        cache = VersionCache(1)
+        resolver = RefResolver(self.repo, objects=SlowObjects(self.repo))
+
+        document = TaggedDocument(self.repo, "sourceA.txt", resolver=resolver, cache=cache)
+        document["sourceA-v1.txt"]
+
+        TaggedDocument.prewarm([document], ["sourceA-v2.txt", "refs/tags/sourceA-v1.txt"], jobs=2)
+
+        self.assertEqual(document.versions["refs/tags/sourceA-v1.txt"].data, open("tests/sourceA-v1.txt").read())
+        self.assertEqual(len(document.versions_by_blob), 1)
+
+    def test_prewarming(self):
+        documents = [TaggedDocument(self.repo, "sourceA.txt"), TaggedDocument(self.repo, "sourceB.txt")]
+
+        refs = ["sourceA-v1.txt", "sourceA-v2.txt", "refs/tags/sourceA-v2.txt", "no-such-ref"]
+
+        TaggedDocument.prewarm(documents, refs, jobs=2)
+
+        (document_a, document_b) = documents
+
+        # both names for v2 point at the same tree, so they share a version
+        self.assertTrue(document_a.versions["sourceA-v2.txt"] is document_a.versions["refs/tags/sourceA-v2.txt"])
+
+        self.assertEqual(document_a.versions["sourceA-v1.txt"].data, open("tests/sourceA-v1.txt").read())
+
+        # sourceB was never committed, so it doesn't exist at any ref
+        self.assertEqual(document_b.versions["sourceA-v1.txt"], None)
+        self.assertEqual(document_b["sourceA-v1.txt"], None)
+
+        self.assertFalse("no-such-ref" in document_a.versions)
+
+    def test_sharing_unchanged_versions(self):
+        # commit an unrelated file on top of v3, so that sourceA.txt is the
+        # same at HEAD and at the v3 tag, even though they're different trees
+        with open(os.path.join(REPO_DIR, "other.txt"), "w") as other_file:
+            other_file.write("unrelated\n")
+        self.repo.index.add(["other.txt"])
+        self.repo.index.commit("Added other.txt")
+
+        document = TaggedDocument(self.repo, "sourceA.txt")
+
+        self.assertTrue(document["HEAD"] is document["sourceA-v3.txt"])
+        self.assertFalse(document["HEAD"] is document["sourceA-v2.txt"])
+
+        # the working copy is shared with HEAD when the two are identical
+        shutil.copy("tests/sourceA-v3.txt", os.path.join(REPO_DIR, "sourceA.txt"))
+
+        document = TaggedDocument(self.repo, "sourceA.txt")
+
+        self.assertTrue(document["HEAD"] is document["working-copy"])
+
+    def test_resolving_refs(self):
+        resolver = RefResolver(self.repo)
+
+        tag = resolver.commit("sourceA-v2.txt")
+        full_name = resolver.commit("refs/tags/sourceA-v2.txt")
+        short_id = resolver.commit(tag[:7])
+
+        self.assertEqual(tag, self.repo.commit("sourceA-v2.txt").hexsha)
+        self.assertEqual(tag, full_name)
+        self.assertEqual(tag, short_id)
+
+        # every name for the commit shares the same tree
+        self.assertTrue(resolver.tree("sourceA-v2.txt") is resolver.tree(tag[:7]))
+
+        # unknown refs are remembered, and documents treat them as missing
+        self.assertEqual(resolver.commit("no-such-ref"), None)
+        self.assertTrue("no-such-ref" in resolver.commits)
+
+        document = TaggedDocument(self.repo, "sourceA.txt", resolver)
+
+        self.assertEqual(document["no-such-ref"], None)
+
+    def test_tag_ranges(self):
+        document = TaggedDocument(self.repo, "sourceA.txt")
+
+        self.assertEqual(document["HEAD"].tag_ranges, {"sourceA": [(1, 6)], "sourceA-1": [(3, 5)]})
+
+    def test_lines_over_limit(self):
+        with open(os.path.join(REPO_DIR, "indented.txt"), "w") as indented:
+            indented.write("// BEGIN outer\n        short\n// BEGIN inner\n        " + "x" * 20 + "\n\t" + "y" * 10 + "\n// END inner\n// END outer\n")
+
+        version = TaggedDocument(self.repo, "indented.txt")["working-copy"]
+
+        # before dedenting, the 8-space and 1-tab lines are 28 and 18 wide
+        self.assertEqual([width for (line, width) in version.lines_over_limit(17)], [28, 18])
+
+        # 'inner' alone has no common indent, since tabs and spaces differ
+        self.assertEqual([width for (line, width) in version.lines_over_limit(17, "inner")], [28, 18])
+
+        # 'outer except inner' is just the 'short' line, which loses its
+        # 8 spaces of indent when dedented
+        self.assertEqual(version.margin(version.matching_indices("outer except inner")), " " * 8)
+        self.assertEqual([width for (line, width) in version.lines_over_limit(4, "outer except inner")], [5])